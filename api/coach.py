@@ -1,9 +1,9 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Any, Dict, Optional
 import html
 import logging
-import httpx
 import uuid
 
 logger = logging.getLogger(__name__)
@@ -16,9 +16,14 @@ except Exception:
     bleach = None
 
 try:
-    from src.agents.agents_factory import run_agent_flow
+    from src.agents.agents_factory import run_agent_flow, run_agent_flow_stream
 except ImportError:
     run_agent_flow = None
+    run_agent_flow_stream = None
+
+from src.executors import ExecutorBusyError, run_blocking
+from src.sse import sse_event
+from src import pdf_service
 
 try:
     from src.prediction_session import (
@@ -53,16 +58,8 @@ class CoachResponse(BaseModel):
     is_question: bool = False  # Indica si es una pregunta de evaluación
     question_progress: Optional[str] = None  # Progreso de preguntas (ej: "3/12")
 
-@router.post("/", response_model=CoachResponse)
-async def coach_endpoint(request: CoachRequest):
-    """
-    Endpoint principal del coach que maneja:
-    1. Conversación normal con el agente
-    2. Inicio de evaluación de riesgo
-    3. Recopilación de variables para predicción
-    4. Predicción y recomendaciones personalizadas
-    """
-    
+def is_conversational(request: CoachRequest) -> bool:
+    """True si la petición va al agente conversacional (no es parte de una evaluación)."""
     # Detectar palabras clave para iniciar evaluación
     query_lower = request.query.lower()
     keywords_assessment = [
@@ -80,14 +77,67 @@ async def coach_endpoint(request: CoachRequest):
     if request.session_id:
         session = get_session(request.session_id)
         if session and not session.completed:
-            return await handle_assessment_flow(request, session)
+            return False
     
     # Si se solicita iniciar evaluación
-    if should_start_assessment and get_or_create_session is not None:
-        return await start_assessment()
-    
-    # Flujo normal del agente conversacional
-    return await handle_normal_conversation(request)
+    return not (should_start_assessment and get_or_create_session is not None)
+
+
+@router.post("/", response_model=CoachResponse)
+async def coach_endpoint(request: CoachRequest):
+    """
+    Endpoint principal del coach que maneja:
+    1. Conversación normal con el agente
+    2. Inicio de evaluación de riesgo
+    3. Recopilación de variables para predicción
+    4. Predicción y recomendaciones personalizadas
+    """
+    if is_conversational(request):
+        # Flujo normal del agente conversacional
+        return await handle_normal_conversation(request)
+
+    # Si hay una sesión activa, continuar con el flujo de preguntas
+    if request.session_id:
+        session = get_session(request.session_id)
+        if session and not session.completed:
+            return await handle_assessment_flow(request, session)
+
+    return await start_assessment()
+
+
+@router.post("/stream")
+async def coach_stream(request: CoachRequest):
+    """
+    Versión SSE del coach. La conversación normal emite eventos `meta`, `token`
+    (texto en bruto a medida que se genera) y `done` con el mismo contenido que
+    `CoachResponse`. Los pasos de la evaluación no pasan por el LLM en streaming
+    y se emiten como un único evento `done`.
+    """
+    if not is_conversational(request) or run_agent_flow_stream is None:
+        response = await coach_endpoint(request)
+        return StreamingResponse(iter([sse_event({'type': 'done', **response.model_dump()})]),
+                                 media_type="text/event-stream")
+
+    def events():
+        try:
+            for event in run_agent_flow_stream(request.query):
+                if event['type'] == 'done':
+                    out = {k: v for k, v in event.items() if k != 'type'}
+                    event = {'type': 'done', **CoachResponse(
+                        risk=out.get('risk', 'medio'),
+                        retrieved_count=len(out.get('retrieved', [])),
+                        draft=out.get('draft', '') or '',
+                        final=render_markdown_to_safe_html(out.get('final', '')),
+                        details={k: v for k, v in out.items() if k not in ('draft', 'final')},
+                    ).model_dump()}
+                yield sse_event(event)
+        except Exception as e:
+            logger.exception('Error en el streaming del coach')
+            yield sse_event({'type': 'error', 'detail': str(e)})
+
+    # el generador es síncrono: Starlette lo itera en un hilo sin bloquear el event loop
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 async def start_assessment() -> CoachResponse:
@@ -179,7 +229,7 @@ async def handle_assessment_flow(request: CoachRequest, session) -> CoachRespons
 
 async def generate_assessment_pdf(html_content: str, risk_level: str, risk_score: float, session) -> Optional[Dict[str, Any]]:
     """
-    Genera un PDF del informe de evaluación usando la API interna.
+    Encola la generación del PDF del informe de evaluación (en proceso, sin pasar por HTTP).
     
     Args:
         html_content: Contenido HTML del informe
@@ -188,7 +238,7 @@ async def generate_assessment_pdf(html_content: str, risk_level: str, risk_score
         session: Objeto de sesión con variables del usuario
         
     Returns:
-        Diccionario con información del PDF generado o None si falla
+        Diccionario con el trabajo encolado (job_id, status_url) o None si falla
     """
     try:
         # Generar título basado en el nivel de riesgo (sin emojis para compatibilidad con headers HTTP)
@@ -204,30 +254,19 @@ async def generate_assessment_pdf(html_content: str, risk_level: str, risk_score
         # Convertir risk_score (0-1) a porcentaje (0-100)
         percentage = risk_score * 100
         
-        # Preparar el payload para la API
-        pdf_payload = {
-            "html_content": html_content,
-            "title": title,
-            "description": description,
-            "percentage": percentage
-        }
-        
-        # Llamar a la API local de creación de PDF
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://localhost:8000/api/pdf/create",
-                json=pdf_payload,
-                timeout=30.0
-            )
-            
-            if response.status_code == 200:
-                pdf_data = response.json()
-                logger.info(f"PDF generado exitosamente: {pdf_data.get('pdf_id')}")
-                return pdf_data
-            else:
-                logger.error(f"Error al generar PDF: {response.status_code} - {response.text}")
-                return None
-                
+        # Encolar el PDF: vuelve en el acto, el PDF se genera en segundo plano
+        job = pdf_service.submit_pdf(
+            html_content=html_content,
+            title=title,
+            description=description,
+            percentage=percentage
+        )
+        logger.info(f"PDF encolado: {job.job_id}")
+        return job.as_dict()
+    
+    except ExecutorBusyError:
+        logger.warning("Cola de PDFs llena; la evaluación se entrega sin PDF")
+        return None
     except Exception as e:
         logger.error(f"Error generando PDF: {e}")
         return None
@@ -240,8 +279,8 @@ async def complete_assessment(session) -> CoachResponse:
         # Calcular BMI
         calculate_bmi(session)
         
-        # Realizar predicción
-        risk_score, risk_level = predict_diabetes_risk(session.variables)
+        # Realizar predicción (la primera carga el modelo desde disco: fuera del event loop)
+        risk_score, risk_level = await run_blocking('agent', predict_diabetes_risk, session.variables)
         
         # Guardar en sesión
         session.risk_prediction = risk_score
@@ -268,7 +307,8 @@ Genera recomendaciones específicas y motivadoras basadas en su perfil.
         agent_recommendations = ""
         if run_agent_flow:
             try:
-                agent_out = run_agent_flow(context_for_agent)
+                # el contexto incluye el perfil del usuario: no compartir respuestas en caché
+                agent_out = await run_blocking('agent', run_agent_flow, context_for_agent, use_cache=False)
                 agent_recommendations = agent_out.get('final', '')
             except Exception as e:
                 logger.error(f"Error en agente: {e}")
@@ -292,26 +332,20 @@ Genera recomendaciones específicas y motivadoras basadas en su perfil.
         
         final_html = render_markdown_to_safe_html(final_response)
         
-        # Generar PDF con el informe
-        pdf_data = await generate_assessment_pdf(
+        # Encolar el PDF con el informe (no se espera a que termine)
+        pdf_job = await generate_assessment_pdf(
             html_content=final_html,
             risk_level=risk_level,
             risk_score=risk_score,
             session=session
         )
         
-        # Agregar enlace del PDF a la respuesta
-        if pdf_data:
+        # Aviso del PDF en preparación: la página consulta el trabajo y pone el enlace al terminar
+        if pdf_job:
             pdf_link_html = f"""
-<div style="margin-top: 30px; padding: 20px; background-color: #f0f9ff; border-left: 4px solid #3b82f6; border-radius: 8px;">
-    <h3 style="margin: 0 0 10px 0; color: #1e40af;">📄 Tu Informe está Listo</h3>
-    <p style="margin: 0 0 15px 0;">Hemos generado un PDF completo con tu evaluación y recomendaciones personalizadas.</p>
-    <div>
-        <a href="{pdf_data.get('download_url')}" 
-           style="display: inline-block; padding: 12px 24px; background-color: #3b82f6; color: white; text-decoration: none; border-radius: 8px; font-weight: 600; font-size: 16px;">
-            ⬇️ Descargar Informe en PDF
-        </a>
-    </div>
+<div data-pdf-job="{html.escape(pdf_job.get('job_id', ''))}" style="margin-top: 30px; padding: 20px; background-color: #f0f9ff; border-left: 4px solid #3b82f6; border-radius: 8px;">
+    <h3 style="margin: 0 0 10px 0; color: #1e40af;">📄 Preparando tu Informe</h3>
+    <p style="margin: 0;">Estamos generando un PDF completo con tu evaluación y recomendaciones personalizadas. El enlace de descarga aparecerá aquí en unos segundos.</p>
 </div>
 """
             final_html += pdf_link_html
@@ -328,7 +362,7 @@ Genera recomendaciones específicas y motivadoras basadas en su perfil.
                 "risk_score": risk_score,
                 "variables": session.variables,
                 "bmi": session.variables.get("BMI"),
-                "pdf_data": pdf_data
+                "pdf_job": pdf_job
             }
         )
         
@@ -357,7 +391,8 @@ async def handle_normal_conversation(request: CoachRequest) -> CoachResponse:
         raise HTTPException(status_code=500, detail="run_agent_flow no disponible")
     
     try:
-        out = run_agent_flow(request.query)
+        # flujo síncrono: en el pool de agentes para no bloquear el event loop
+        out = await run_blocking('agent', run_agent_flow, request.query)
         final_html = render_markdown_to_safe_html(out.get('final', ''))
         draft_text = out.get('draft', '') or ''
         
@@ -368,6 +403,8 @@ async def handle_normal_conversation(request: CoachRequest) -> CoachResponse:
             final=final_html,
             details={k: v for k, v in out.items() if k not in ('draft', 'final')}
         )
+    except ExecutorBusyError:
+        raise HTTPException(status_code=503, detail="Servidor ocupado, inténtalo de nuevo en unos segundos.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -4,11 +4,16 @@ Módulo para cargar y ejecutar el modelo de predicción de diabetes.
 import numpy as np
 from pathlib import Path
 from typing import Dict, Any, Tuple
+import importlib.util
 import logging
-from xgboost import XGBClassifier
 
 logger = logging.getLogger(__name__)
 
+# xgboost se importa con la primera predicción, pero su ausencia se detecta al
+# importar el módulo para que el coach no ofrezca la evaluación sin modelo
+if importlib.util.find_spec("xgboost") is None:
+    raise ImportError("xgboost no está instalado")
+
 # Ruta al modelo
 MODEL_PATH = Path(__file__).parent.parent / "model" / "modelo"
 
@@ -42,6 +47,9 @@ DEFAULT_VALUES = {
 
 def load_model():
     """Carga el modelo XGBoost desde disco."""
+    # importación diferida: xgboost sólo se carga con la primera predicción, no al arrancar la app
+    from xgboost import XGBClassifier
+
     try:
         model = XGBClassifier()
         model.load_model(MODEL_PATH)
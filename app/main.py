@@ -1,32 +1,66 @@
 from pathlib import Path
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 import uvicorn
 import random
-import json
-import uuid
 from datetime import datetime
-from xhtml2pdf import pisa
-from io import BytesIO
-import qrcode
-import base64
-import matplotlib.pyplot as plt
-import matplotlib
 import re
 from typing import Any, Dict
+from contextlib import asynccontextmanager
+import logging
+import os
+import sys
+
+# Agregar el directorio raíz al path de Python: `python app/main.py` también importa `src` y `api`
+root_dir = Path(__file__).parent.parent
+if str(root_dir) not in sys.path:
+	sys.path.insert(0, str(root_dir))
 
 # importar el orquestador de agentes
 try:
-	from src.agents.agents_factory import run_agent_flow
+	from src.agents.agents_factory import run_agent_flow, run_agent_flow_stream, answer_cache_stats, risk_selector_stats, prompt_stats, context_stats, coalescing_stats, model_routing_stats
 except Exception:
 	# fallback si se ejecuta desde diferente cwd
 	try:
-		from agents.agents_factory import run_agent_flow
+		from agents.agents_factory import run_agent_flow, run_agent_flow_stream, answer_cache_stats, risk_selector_stats, prompt_stats, context_stats, coalescing_stats, model_routing_stats
 	except Exception:
 		run_agent_flow = None
+		run_agent_flow_stream = None
+		answer_cache_stats = None
+		risk_selector_stats = None
+		prompt_stats = None
+		context_stats = None
+		coalescing_stats = None
+		model_routing_stats = None
+
+try:
+	from src.retrieval import get_retriever
+	from src.utils import warm_up_embedder
+except Exception:
+	get_retriever = None
+	warm_up_embedder = None
+
+try:
+	from src.embedding_cache import get_embedding_cache
+except Exception:
+	get_embedding_cache = None
+
+try:
+	from src.agents.openai_utils import llm_stats
+except Exception:
+	llm_stats = None
+
+# pools acotados para el trabajo bloqueante (flujo de agentes, generación de PDFs)
+from src.executors import ExecutorBusyError, executor_stats, run_blocking
+from src.sse import sse_event
+from src.pdf_registry import get_pdf_registry
+from src.pdf_jobs import shutdown_pdf_job_queue
+from src import pdf_service
+
+logger = logging.getLogger(__name__)
 
 
 # Rutas de directorios relativas a este archivo (app/main.py)
@@ -35,14 +69,30 @@ TEMPLATES_DIR = BASE_DIR.parent / "templates"  # ../templates
 STATIC_DIR = BASE_DIR.parent / "static"  # ../static
 PDF_DIR = BASE_DIR.parent / "generated_pdfs"  # ../generated_pdfs
 DATA_DIR = BASE_DIR.parent / "data"  # ../data
-PDF_METADATA_FILE = DATA_DIR / "pdf_metadata.json"
 
 # Crear directorios si no existen
 PDF_DIR.mkdir(exist_ok=True)
 DATA_DIR.mkdir(exist_ok=True)
 
 
-app = FastAPI(title="hackathon_ia")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+	"""Carga recursos de larga vida una sola vez por proceso (índice de retrieval, embedder local)."""
+	if get_retriever is not None:
+		try:
+			get_retriever()
+		except Exception:
+			logger.exception("No se pudo precargar el índice de retrieval")
+	if warm_up_embedder is not None and os.getenv("LOCAL_EMBEDDING_WARMUP", "1") == "1":
+		try:
+			warm_up_embedder()
+		except Exception:
+			logger.exception("No se pudo precargar el modelo local de embeddings")
+	yield
+	shutdown_pdf_job_queue()
+
+
+app = FastAPI(title="hackathon_ia", lifespan=lifespan)
 
 
 # Montar archivos estáticos si existen
@@ -68,6 +118,36 @@ async def ping():
 	return {"status": "ok"}
 
 
+@app.get("/api/metrics")
+async def metrics():
+	"""Métricas de los componentes con caché del proceso."""
+	out: Dict[str, Any] = {}
+	cache = get_embedding_cache() if get_embedding_cache is not None else None
+	if cache is not None:
+		out["embedding_cache"] = cache.stats()
+	answers = answer_cache_stats() if answer_cache_stats is not None else None
+	if answers is not None:
+		out["answer_cache"] = answers
+	if risk_selector_stats is not None:
+		out["risk_selector"] = risk_selector_stats()
+	if prompt_stats is not None:
+		out["prompts"] = prompt_stats()
+	if context_stats is not None:
+		out["context"] = context_stats()
+	coalescing = coalescing_stats() if coalescing_stats is not None else None
+	if coalescing is not None:
+		out["coalescing"] = coalescing
+	routing = model_routing_stats() if model_routing_stats is not None else None
+	if routing is not None:
+		out["model_routing"] = routing
+	llm = llm_stats() if llm_stats is not None else None
+	if llm is not None:
+		out["llm"] = llm
+	out["executors"] = executor_stats()
+	out["pdf_jobs"] = pdf_service.pdf_job_stats()
+	return out
+
+
 # Modelo para las peticiones del chat
 class ChatRequest(BaseModel):
 	message: str
@@ -105,259 +185,10 @@ class PDFListItem(BaseModel):
 	created_at: str
 
 
-# Funciones auxiliares para manejo de metadatos de PDFs
-def load_pdf_metadata():
-	"""Carga los metadatos de PDFs desde el archivo JSON"""
-	if not PDF_METADATA_FILE.exists():
-		return []
-	try:
-		with open(PDF_METADATA_FILE, 'r', encoding='utf-8') as f:
-			return json.load(f)
-	except Exception as e:
-		print(f"Error loading PDF metadata: {e}")
-		return []
-
-
-def save_pdf_metadata(metadata_list):
-	"""Guarda los metadatos de PDFs en el archivo JSON"""
-	try:
-		with open(PDF_METADATA_FILE, 'w', encoding='utf-8') as f:
-			json.dump(metadata_list, f, ensure_ascii=False, indent=2)
-		return True
-	except Exception as e:
-		print(f"Error saving PDF metadata: {e}")
-		return False
-
-
+# Metadatos de PDFs: registro SQLite (src/pdf_registry.py), migrado desde data/pdf_metadata.json
 def add_pdf_metadata(pdf_id, title, description, filename):
 	"""Agrega un nuevo registro de PDF a los metadatos"""
-	metadata_list = load_pdf_metadata()
-	new_entry = {
-		"pdf_id": pdf_id,
-		"title": title,
-		"description": description,
-		"filename": filename,
-		"download_url": f"/api/pdf/{pdf_id}/download",
-		"view_url": f"/api/pdf/{pdf_id}/view",
-		"created_at": datetime.now().isoformat()
-	}
-	metadata_list.append(new_entry)
-	save_pdf_metadata(metadata_list)
-	return new_entry
-
-
-def generate_qr_code(url: str) -> str:
-	"""
-	Genera un código QR para la URL proporcionada y lo retorna como base64.
-	
-	Args:
-		url: URL para la que se generará el código QR
-		
-	Returns:
-		String base64 del código QR en formato PNG
-	"""
-	# Crear código QR
-	qr = qrcode.QRCode(
-		version=1,
-		error_correction=qrcode.constants.ERROR_CORRECT_L,
-		box_size=10,
-		border=4,
-	)
-	qr.add_data(url)
-	qr.make(fit=True)
-	
-	# Generar imagen
-	img = qr.make_image(fill_color="black", back_color="white")
-	
-	# Convertir a base64
-	buffer = BytesIO()
-	img.save(buffer, format='PNG')
-	buffer.seek(0)
-	img_base64 = base64.b64encode(buffer.read()).decode()
-	
-	return img_base64
-
-
-def generate_circular_chart(percentage: float, title: str = "Progreso") -> str:
-	"""
-	Genera un gráfico circular (donut chart) para mostrar un porcentaje.
-	
-	Args:
-		percentage: Valor del porcentaje (0-100)
-		title: Título del gráfico
-		
-	Returns:
-		String base64 del gráfico en formato PNG
-	"""
-	# Configurar matplotlib para no usar GUI
-	matplotlib.use('Agg')
-	
-	# Asegurar que el porcentaje esté en el rango correcto
-	percentage = max(0, min(100, percentage))
-	remaining = 100 - percentage
-	
-	# Crear figura más grande y con mejor aspecto
-	fig, ax = plt.subplots(figsize=(8, 8), facecolor='white')
-	
-	# Determinar color basado en el porcentaje (semáforo de riesgo)
-	if percentage < 30:
-		main_color = '#10b981'  # Verde (bajo riesgo)
-		risk_label = 'Riesgo Bajo'
-	elif percentage < 60:
-		main_color = '#f59e0b'  # Amarillo/Naranja (riesgo medio)
-		risk_label = 'Riesgo Medio'
-	else:
-		main_color = '#ef4444'  # Rojo (riesgo alto)
-		risk_label = 'Riesgo Alto'
-	
-	# Datos para el gráfico
-	sizes = [percentage, remaining]
-	colors = [main_color, '#f0f0f0']  # Color dinámico para riesgo, gris muy claro para restante
-	
-	# Crear el gráfico circular (donut) sin explosión para aspecto más limpio
-	wedges, texts = ax.pie(
-		sizes,
-		colors=colors,
-		startangle=90,
-		wedgeprops=dict(width=0.3, edgecolor='white', linewidth=4)
-	)
-	
-	# Agregar el porcentaje en el centro del círculo (arriba)
-	ax.text(0, 0.2, f'{percentage:.1f}%', 
-			ha='center', va='center', 
-			fontsize=48, fontweight='bold', 
-			color='#1f2937')
-	
-	# Agregar etiqueta de nivel de riesgo en el centro del círculo (abajo)
-	ax.text(0, -0.2, risk_label, 
-			ha='center', va='center', 
-			fontsize=22, fontweight='600', 
-			color=main_color)
-	
-	# Agregar título FUERA y debajo del círculo
-	ax.text(0, -1.6, title, 
-			ha='center', va='center', 
-			fontsize=20, fontweight='bold', 
-			color='#374151')
-	
-	# Asegurar que el gráfico sea circular
-	ax.axis('equal')
-	
-	# Guardar en buffer con mayor resolución
-	buffer = BytesIO()
-	plt.tight_layout(pad=0.5)
-	plt.savefig(buffer, format='PNG', dpi=200, bbox_inches='tight', 
-				facecolor='white', edgecolor='none')
-	plt.close(fig)
-	
-	# Convertir a base64
-	buffer.seek(0)
-	img_base64 = base64.b64encode(buffer.read()).decode()
-	
-	return img_base64
-
-
-def add_chart_to_html(html_content: str, percentage: float, chart_title: str = "Nivel de Riesgo") -> str:
-	"""
-	Agrega un gráfico circular al inicio del contenido HTML.
-	
-	Args:
-		html_content: Contenido HTML original
-		percentage: Porcentaje para mostrar (0-100)
-		chart_title: Título del gráfico
-		
-	Returns:
-		HTML con el gráfico agregado al inicio
-	"""
-	# Generar gráfico circular
-	chart_base64 = generate_circular_chart(percentage, chart_title)
-	
-	# HTML del gráfico centrado al inicio del documento
-	chart_html = f"""
-	<!DOCTYPE html>
-	<html>
-	<head>
-		<meta charset="utf-8">
-		<style>
-			body {{
-				font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-				margin: 0;
-				padding: 20px;
-				background-color: #f9fafb;
-			}}
-			.chart-container {{
-				text-align: center;
-				margin: 40px auto 60px;
-				padding: 30px;
-				background-color: white;
-				border-radius: 12px;
-				box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-				max-width: 600px;
-			}}
-			.chart-container img {{
-				max-width: 500px;
-				width: 100%;
-				height: auto;
-				margin: 0 auto;
-			}}
-		</style>
-	</head>
-	<body>
-		<div class="chart-container">
-			<img src="data:image/png;base64,{chart_base64}" alt="Grafico de Riesgo">
-		</div>
-	"""
-	
-	# Limpiar el HTML original de etiquetas de documento si las tiene
-	content = html_content
-	if '<!DOCTYPE' in content:
-		# Extraer solo el contenido del body
-		import re
-		body_match = re.search(r'<body[^>]*>(.*?)</body>', content, re.DOTALL | re.IGNORECASE)
-		if body_match:
-			content = body_match.group(1)
-		else:
-			# Si no hay body, quitar html, head, body tags
-			content = re.sub(r'<html[^>]*>|</html>|<head[^>]*>.*?</head>|<body[^>]*>|</body>', '', content, flags=re.DOTALL | re.IGNORECASE)
-	
-	# Combinar gráfico con contenido
-	return chart_html + content
-
-
-def add_qr_to_html(html_content: str, pdf_url: str) -> str:
-	"""
-	Agrega un código QR al final del contenido HTML.
-	
-	Args:
-		html_content: Contenido HTML original
-		pdf_url: URL completa del PDF para generar el QR
-		
-	Returns:
-		HTML con el código QR agregado al final
-	"""
-	# Generar código QR
-	qr_base64 = generate_qr_code(pdf_url)
-	
-	# HTML del código QR centrado al final del documento
-	qr_html = f"""
-	<div style="page-break-before: avoid; margin-top: 50px; padding-top: 30px; border-top: 2px solid #e0e0e0; text-align: center;">
-		<h3 style="color: #666; font-size: 16px; margin-bottom: 20px;">Accede a este documento escaneando el código QR</h3>
-		<img src="data:image/png;base64,{qr_base64}" alt="QR Code" style="width: 200px; height: 200px; margin: 0 auto; display: block;">
-		<p style="margin-top: 15px; font-size: 12px; color: #888;">Escanea este código para ver el PDF en línea</p>
-	</div>
-	</body>
-	</html>
-	"""
-	
-	# Reemplazar el cierre de body y html con el QR incluido
-	if '</body>' in html_content and '</html>' in html_content:
-		html_content = html_content.replace('</body>', '').replace('</html>', '')
-		html_content += qr_html
-	else:
-		# Si no hay cierre de etiquetas, agregar al final
-		html_content += qr_html
-	
-	return html_content
+	return get_pdf_registry().add(pdf_id, title, description, filename)
 
 
 # API endpoint para el chatbot (demo hardcodeado)
@@ -472,20 +303,45 @@ async def chat(request: ChatRequest):
         return ChatResponse(response="Error: El flujo de agentes no está disponible.")
 
     try:
-        out = run_agent_flow(request.message)
+        # el flujo es síncrono (HTTP bloqueante): en el pool de agentes, fuera del event loop
+        out = await run_blocking('agent', run_agent_flow, request.message)
         raw_response = out.get('final', 'Lo siento, no pude generar una respuesta.')
         formatted_response = format_response_to_html(raw_response)
         return ChatResponse(response=formatted_response)
+    except ExecutorBusyError:
+        raise HTTPException(status_code=503, detail="Servidor ocupado, inténtalo de nuevo en unos segundos.")
     except Exception as e:
         return ChatResponse(response=f"Error: {e}")
 
 
-import sys
-from pathlib import Path
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Igual que /api/chat, pero emite la respuesta por SSE a medida que el modelo la genera:
+    eventos `meta`, `token` (texto en bruto) y `done` (con `response` ya formateada en HTML).
+    """
+    if run_agent_flow_stream is None:
+        raise HTTPException(status_code=503, detail="El flujo de agentes no está disponible.")
+
+    def events():
+        try:
+            for event in run_agent_flow_stream(request.message):
+                if event['type'] == 'done':
+                    event = {
+                        'type': 'done',
+                        'risk': event.get('risk'),
+                        'response': format_response_to_html(event.get('final', '')),
+                        'timings': event.get('timings'),
+                    }
+                yield sse_event(event)
+        except Exception as e:
+            logger.exception('Error en el streaming del chat')
+            yield sse_event({'type': 'error', 'detail': str(e)})
+
+    # el generador es síncrono: Starlette lo itera en un hilo sin bloquear el event loop
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-# Agregar el directorio raíz al path de Python
-root_dir = Path(__file__).parent.parent
-sys.path.insert(0, str(root_dir))
 
 from api import coach
 
@@ -499,63 +355,73 @@ async def create_pdf(request: PDFCreateRequest, req: Request):
 	"""
 	Crea un PDF desde contenido HTML y lo guarda.
 	Retorna URLs para descargar y visualizar el PDF.
+	Espera a que termine; `POST /api/pdf/jobs` devuelve en el acto un id de trabajo.
 	"""
 	try:
-		# Generar un ID único para el PDF
-		pdf_id = str(uuid.uuid4())
-		filename = f"{pdf_id}.pdf"
-		pdf_path = PDF_DIR / filename
-		
-		# Construir URL completa del PDF
-		base_url = str(req.base_url).rstrip('/')
-		pdf_view_url = f"{base_url}/api/pdf/{pdf_id}/view"
-		
-		# Agregar gráfico circular al inicio del HTML si se proporciona un porcentaje
-		html_content = request.html_content
-		if request.percentage > 0:
-			html_content = add_chart_to_html(html_content, request.percentage, f"{request.title} - Análisis")
-		
-		# Agregar código QR al final del HTML
-		html_with_qr = add_qr_to_html(html_content, pdf_view_url)
-		
-		# Convertir HTML a PDF usando xhtml2pdf
-		with open(pdf_path, "wb") as pdf_file:
-			pisa_status = pisa.CreatePDF(
-				html_with_qr.encode('utf-8'),
-				dest=pdf_file
-			)
-		
-		if pisa_status.err:
-			raise Exception(f"Error al generar PDF: {pisa_status.err}")
-		
-		# Guardar metadatos
-		metadata = add_pdf_metadata(
-			pdf_id=pdf_id,
-			title=request.title,
-			description=request.description,
-			filename=filename
+		metadata = await pdf_service.create_pdf(
+			request.html_content, request.title, request.description, request.percentage, str(req.base_url)
 		)
 		
 		return PDFCreateResponse(
-			pdf_id=pdf_id,
+			pdf_id=metadata["pdf_id"],
 			download_url=metadata["download_url"],
 			view_url=metadata["view_url"],
-			filename=filename,
+			filename=metadata["filename"],
 			created_at=metadata["created_at"]
 		)
 	
+	except ExecutorBusyError:
+		raise HTTPException(status_code=503, detail="Demasiados PDFs en cola, inténtalo de nuevo en unos segundos.")
 	except Exception as e:
 		raise HTTPException(status_code=500, detail=f"Error al crear PDF: {str(e)}")
 
 
+@app.post("/api/pdf/jobs", status_code=202)
+async def create_pdf_job(request: PDFCreateRequest, req: Request):
+	"""
+	Encola la creación de un PDF y responde en el acto con el id del trabajo.
+	El estado (y, al terminar, las URLs del PDF) se consulta en `status_url`.
+	"""
+	try:
+		job = pdf_service.submit_pdf(
+			request.html_content, request.title, request.description, request.percentage, str(req.base_url)
+		)
+	except ExecutorBusyError:
+		raise HTTPException(status_code=503, detail="Demasiados PDFs en cola, inténtalo de nuevo en unos segundos.")
+	return job.as_dict()
+
+
+@app.get("/api/pdf/jobs/{job_id}")
+async def get_pdf_job(job_id: str):
+	"""
+	Estado de un trabajo de PDF: queued, running, done (con las URLs del PDF) o failed.
+	"""
+	status = pdf_service.pdf_job_status(job_id)
+	if status is None:
+		raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+	return status
+
+
+@app.get("/api/pdf/jobs/{job_id}/result")
+async def get_pdf_job_result(job_id: str):
+	"""
+	Devuelve el PDF de un trabajo terminado; 202 con el estado si aún no está listo.
+	"""
+	job = pdf_service.get_pdf_job(job_id)
+	if job is not None and not job.finished:
+		return JSONResponse(status_code=202, content=job.as_dict())
+	if job is not None and job.status == "failed":
+		raise HTTPException(status_code=500, detail=f"Error al crear PDF: {job.error}")
+	return await download_pdf(job_id)
+
+
 @app.get("/api/pdf/{pdf_id}/download")
 async def download_pdf(pdf_id: str):
 	"""
 	Descarga un PDF por su ID
 	"""
 	# Buscar el PDF en los metadatos
-	metadata_list = load_pdf_metadata()
-	pdf_metadata = next((item for item in metadata_list if item["pdf_id"] == pdf_id), None)
+	pdf_metadata = get_pdf_registry().get(pdf_id)
 	
 	if not pdf_metadata:
 		raise HTTPException(status_code=404, detail="PDF no encontrado")
@@ -579,8 +445,7 @@ async def view_pdf(pdf_id: str):
 	Visualiza un PDF en el navegador por su ID
 	"""
 	# Buscar el PDF en los metadatos
-	metadata_list = load_pdf_metadata()
-	pdf_metadata = next((item for item in metadata_list if item["pdf_id"] == pdf_id), None)
+	pdf_metadata = get_pdf_registry().get(pdf_id)
 	
 	if not pdf_metadata:
 		raise HTTPException(status_code=404, detail="PDF no encontrado")
@@ -603,8 +468,7 @@ async def list_pdfs():
 	"""
 	Lista todos los PDFs disponibles con sus metadatos
 	"""
-	metadata_list = load_pdf_metadata()
-	return [PDFListItem(**item) for item in metadata_list]
+	return [PDFListItem(**item) for item in get_pdf_registry().list()]
 
 
 @app.get("/api/pdf/{pdf_id}/info")
@@ -612,8 +476,7 @@ async def get_pdf_info(pdf_id: str):
 	"""
 	Obtiene información detallada de un PDF específico
 	"""
-	metadata_list = load_pdf_metadata()
-	pdf_metadata = next((item for item in metadata_list if item["pdf_id"] == pdf_id), None)
+	pdf_metadata = get_pdf_registry().get(pdf_id)
 	
 	if not pdf_metadata:
 		raise HTTPException(status_code=404, detail="PDF no encontrado")
@@ -634,21 +497,16 @@ async def delete_pdf(pdf_id: str):
 	"""
 	Elimina un PDF y sus metadatos
 	"""
-	metadata_list = load_pdf_metadata()
-	pdf_metadata = next((item for item in metadata_list if item["pdf_id"] == pdf_id), None)
+	# Eliminar de metadatos (transaccional) y después el archivo físico
+	pdf_metadata = get_pdf_registry().delete(pdf_id)
 	
 	if not pdf_metadata:
 		raise HTTPException(status_code=404, detail="PDF no encontrado")
 	
-	# Eliminar archivo físico
 	pdf_path = PDF_DIR / pdf_metadata["filename"]
 	if pdf_path.exists():
 		pdf_path.unlink()
 	
-	# Eliminar de metadatos
-	updated_metadata = [item for item in metadata_list if item["pdf_id"] != pdf_id]
-	save_pdf_metadata(updated_metadata)
-	
 	return {"message": "PDF eliminado exitosamente", "pdf_id": pdf_id}
 
 
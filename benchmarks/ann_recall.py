@@ -0,0 +1,75 @@
+"""Benchmark de recall@k y latencia de los índices ANN frente al escaneo exacto.
+
+Uso:
+    python benchmarks/ann_recall.py                      # datos sintéticos
+    python benchmarks/ann_recall.py --index kb/db/index.npz
+    python benchmarks/ann_recall.py --kind hnsw --params 16 32 64 128
+"""
+from pathlib import Path
+import argparse
+import sys
+import time
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from src import utils  # noqa: E402
+from src.ann import ANN_INDEX_TYPES, normalize_rows  # noqa: E402
+from src.retrieval import VectorRetriever  # noqa: E402
+
+
+def synthetic_corpus(n: int, dim: int, n_clusters: int, seed: int = 0) -> np.ndarray:
+    """Embeddings agrupados en clusters, parecido a un corpus de papers por tema."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    labels = rng.integers(n_clusters, size=n)
+    return (centers[labels] + 0.6 * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--index', type=Path, default=None, help='Índice real (.npz); si no, datos sintéticos')
+    parser.add_argument('--n', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--kind', choices=sorted(ANN_INDEX_TYPES), default='ivf')
+    parser.add_argument('--params', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                        help='Valores de nprobe (IVF) o ef (HNSW) a evaluar')
+    args = parser.parse_args()
+
+    if args.index:
+        emb, _ = utils.load_index(args.index)
+        emb = np.asarray(emb, dtype=np.float32)
+    else:
+        emb = synthetic_corpus(args.n, args.dim, n_clusters=max(8, args.n // 500))
+    matrix = normalize_rows(emb)
+    rng = np.random.default_rng(1)
+    queries = matrix[rng.choice(len(matrix), size=args.queries)] + 0.3 * rng.normal(size=(args.queries, matrix.shape[1])).astype(np.float32)
+
+    exact = VectorRetriever(matrix, [{}] * len(matrix))
+    t0 = time.perf_counter()
+    truth = [set(i for i, _ in exact.search_vector(q, args.top_k)) for q in queries]
+    exact_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+
+    t0 = time.perf_counter()
+    ann = ANN_INDEX_TYPES[args.kind].build(matrix)
+    build_s = time.perf_counter() - t0
+    print(f"n={len(matrix)} dim={matrix.shape[1]} top_k={args.top_k} kind={args.kind} build={build_s:.2f}s")
+    print(f"{'exacto':>10}  recall@{args.top_k}=1.000  {exact_ms:.3f} ms/query")
+
+    approx = VectorRetriever(matrix, [{}] * len(matrix), ann=ann)
+    for param in args.params:
+        approx.search_param = param
+        t0 = time.perf_counter()
+        found = [set(i for i, _ in approx.search_vector(q, args.top_k)) for q in queries]
+        ms = (time.perf_counter() - t0) * 1000 / len(queries)
+        recall = np.mean([len(f & t) / len(t) for f, t in zip(found, truth)])
+        print(f"{'param=' + str(param):>10}  recall@{args.top_k}={recall:.3f}  {ms:.3f} ms/query  ({exact_ms / ms:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Gráficos de riesgo por segundo y memoria, con y sin la caché de PNG de src/pdf_render.py.
+
+Simula los informes del coach: porcentajes de riesgo con un decimal (distribución
+beta, como las probabilidades del modelo) y el título según el nivel de riesgo.
+Sin caché cada gráfico es una figura de matplotlib. Modos con caché:
+
+- `lru`: sólo la LRU en memoria del proceso.
+- `disco frío`: LRU y directorio de caché vacío (primer arranque).
+- `disco`: la misma carga con la LRU vacía, como otro proceso de la cola de PDFs
+  o tras un reinicio.
+
+El directorio de caché es temporal y se borra al terminar.
+
+Uso:
+    python benchmarks/chart_cache.py
+    python benchmarks/chart_cache.py --charts 1000 --cache-size 256
+"""
+from pathlib import Path
+import argparse
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+
+def rss_mb() -> float:
+    """RSS actual (Linux); si no hay /proc, el máximo del proceso."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def workload(charts: int, seed: int):
+    rng = random.Random(seed)
+    for _ in range(charts):
+        pct = round(rng.betavariate(2, 5) * 100, 1)
+        level = 'BAJO' if pct < 30 else 'MEDIO' if pct < 60 else 'ALTO'
+        yield pct, f'Informe de Evaluacion de Riesgo de Diabetes - Riesgo {level} - Análisis'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--charts', type=int, default=400, help='Gráficos pedidos en cada modo con caché')
+    parser.add_argument('--uncached-sample', type=int, default=20, help='Gráficos dibujados sin caché')
+    parser.add_argument('--cache-size', type=int, default=128, help='CHART_CACHE_SIZE')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp(prefix='chart_cache_')
+    os.environ['CHART_CACHE_SIZE'] = str(args.cache_size)
+    os.environ['CHART_CACHE_DIR'] = ''
+    rss_start = rss_mb()
+    from src import pdf_render
+
+    pdf_render.generate_circular_chart(50.0, 'calentamiento')  # carga de fuentes y backend
+    rss_loaded = rss_mb()
+
+    started = time.perf_counter()
+    for pct, title in workload(args.uncached_sample, args.seed + 1):
+        with pdf_render._PLOT_LOCK:
+            pdf_render._generate_circular_chart(pct, title)
+    uncached = args.uncached_sample / (time.perf_counter() - started)
+    rss_uncached = rss_mb()
+
+    def run(mode: str, disk_dir: str) -> dict:
+        pdf_render.CHART_CACHE_DIR = disk_dir
+        with pdf_render._CHART_CACHE_LOCK:
+            pdf_render._CHART_CACHE.clear()
+        before = pdf_render.chart_cache_stats()
+        started = time.perf_counter()
+        for pct, title in workload(args.charts, args.seed):
+            pdf_render.generate_circular_chart(pct, title)
+        rate = args.charts / (time.perf_counter() - started)
+        after = pdf_render.chart_cache_stats()
+        hits = sum(after[k] - before[k] for k in ('hits', 'disk_hits'))
+        return {'mode': mode, 'rate': rate, 'hit_ratio': hits / args.charts, 'rss': rss_mb(),
+                'lru_mb': after['bytes'] / 1024 / 1024}
+
+    try:
+        results = [run('lru', ''), run('disco frío', cache_dir), run('disco', cache_dir)]
+        disk_mb = sum(f.stat().st_size for f in Path(cache_dir).iterdir()) / 1024 / 1024
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print(f"RSS: {rss_start:.0f} MB al inicio, {rss_loaded:.0f} MB con matplotlib cargado\n")
+    header = f"{'modo':<11} {'gráficos':>9} {'gráficos/s':>11} {'aciertos':>9} {'RSS':>9} {'LRU':>8}"
+    print(header)
+    print('-' * len(header))
+    print(f"{'sin caché':<11} {args.uncached_sample:>9} {uncached:>11.1f} {'-':>9} {rss_uncached:>6.0f} MB {'-':>8}")
+    for r in results:
+        print(f"{r['mode']:<11} {args.charts:>9} {r['rate']:>11.1f} {r['hit_ratio']:>9.1%} {r['rss']:>6.0f} MB "
+              f"{r['lru_mb']:>5.1f} MB")
+    print(f"\nDirectorio de caché: {disk_mb:.1f} MB; con la caché en disco caliente, "
+          f"{results[-1]['rate'] / uncached:.0f}x gráficos/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Ráfaga de consultas idénticas simultáneas, con y sin coalescencia (single-flight).
+
+Simula el tráfico de un enlace de campaña: `--users` peticiones con el mismo
+mensaje llegan a la vez. Informa de llamadas al LLM, latencia y ratio de
+coalescencia contra benchmarks/fake_openai_server.py.
+
+Uso:
+    python benchmarks/coalescing.py
+    python benchmarks/coalescing.py --users 50 --distinct 3 --latency 0.5
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import os
+import statistics
+import sys
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+QUERIES = [
+    '¿Qué alimentos ayudan a controlar la glucosa en sangre?',
+    '¿Cuánto ejercicio semanal se recomienda para prevenir la diabetes tipo 2?',
+    '¿Qué significa tener una HbA1c de 6.2%?',
+]
+
+
+def burst(users: int, distinct: int, coalesce: bool, server) -> dict:
+    from src.agents.agents_factory import run_agent_flow, coalescing_stats
+
+    os.environ['AGENT_COALESCE'] = '1' if coalesce else '0'
+    before_requests = server.config.requests
+    before = coalescing_stats() or {'coalesced': 0, 'requests': 0}
+
+    def one(i: int) -> float:
+        started = time.perf_counter()
+        # variaciones de mayúsculas y espacios: la clave es la consulta normalizada
+        query = QUERIES[i % distinct]
+        run_agent_flow(query.upper() if i % 2 else f'  {query} ', use_cache=True)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        latencies = list(pool.map(one, range(users)))
+    wall = time.perf_counter() - started
+    after = coalescing_stats() or before
+    requests = after['requests'] - before['requests']
+    return {
+        'coalesce': coalesce,
+        'wall': wall,
+        'latency_p50': statistics.median(latencies),
+        'llm_requests': server.config.requests - before_requests,
+        'coalescing_ratio': (after['coalesced'] - before['coalesced']) / requests if requests else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=30)
+    parser.add_argument('--distinct', type=int, default=1, help='Consultas distintas en la ráfaga')
+    parser.add_argument('--latency', type=float, default=0.3, help='Servidor falso: latencia por petición (s)')
+    parser.add_argument('--tokens-per-sec', type=float, default=200.0)
+    args = parser.parse_args()
+
+    from fake_openai_server import start_fake_server
+    server, base_url = start_fake_server(latency=args.latency, tokens_per_sec=args.tokens_per_sec, default_tokens=100)
+    os.environ['OPENAI_BASE_URL'] = base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'fake')
+    os.environ.setdefault('RETRIEVAL_MODE', 'lexical')
+    # sin caché de respuestas: sólo se mide la coalescencia de ejecuciones en curso
+    os.environ['ANSWER_CACHE'] = '0'
+    os.environ['RISK_CLASSIFIER'] = '0'
+    os.environ['RISK_SELECTOR_LOG'] = '0'
+
+    distinct = max(1, min(args.distinct, len(QUERIES)))
+    results = [burst(args.users, distinct, coalesce, server) for coalesce in (False, True)]
+    header = f"{'coalescencia':<13} {'tiempo total':>13} {'lat. p50':>9} {'peticiones LLM':>15} {'ratio':>6}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{'sí' if r['coalesce'] else 'no':<13} {r['wall']:>12.2f}s {r['latency_p50']:>8.2f}s "
+              f"{r['llm_requests']:>15} {r['coalescing_ratio']:>6.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Arranque en frío de `app.main`: tiempo de importación, RSS y dependencias pesadas cargadas.
+
+Cada repetición importa la app en un intérprete nuevo (sin precargar el índice
+ni el embedder: no se ejecuta el lifespan). Informa de la mediana y de qué
+dependencias de informes y de ML quedan en memoria sin haber generado ningún PDF
+ni predicción.
+
+Uso:
+    python benchmarks/cold_start.py
+    python benchmarks/cold_start.py --runs 10 --module api.coach
+"""
+from pathlib import Path
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+ROOT = Path(__file__).resolve().parent.parent
+
+HEAVY_MODULES = ('matplotlib', 'matplotlib.pyplot', 'xhtml2pdf', 'reportlab', 'qrcode', 'PIL', 'xgboost')
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+rss = 0.0
+with open('/proc/self/status') as f:
+    for line in f:
+        if line.startswith('VmRSS:'):
+            rss = int(line.split()[1]) / 1024
+print(json.dumps({{'seconds': elapsed, 'rss_mb': rss, 'modules': len(sys.modules),
+                  'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def probe(module: str) -> dict:
+    out = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                         cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--module', default='app.main', help='Módulo a importar')
+    args = parser.parse_args()
+
+    probe(args.module)  # calentamiento: bytecode compilado y page cache
+    runs = [probe(args.module) for _ in range(args.runs)]
+    print(f"import {args.module} ({args.runs} arranques en frío)")
+    print(f"  tiempo: mediana {statistics.median(r['seconds'] for r in runs):.2f}s, "
+          f"mín {min(r['seconds'] for r in runs):.2f}s")
+    print(f"  RSS:    mediana {statistics.median(r['rss_mb'] for r in runs):.0f} MB")
+    print(f"  módulos cargados: {runs[-1]['modules']}")
+    print(f"  dependencias pesadas en memoria: {', '.join(runs[-1]['heavy']) or 'ninguna'}")
+
+
+if __name__ == '__main__':
+    main()
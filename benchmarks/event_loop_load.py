@@ -0,0 +1,137 @@
+"""Prueba de carga: peticiones concurrentes a /api/chat y /api/pdf/create sin bloquear el event loop.
+
+Lanza `--users` peticiones simultáneas contra la app (en proceso, con
+httpx.ASGITransport: un único event loop, como un worker de uvicorn) mientras
+sondea `/ping`. Compara el modo actual (trabajo bloqueante en pools acotados)
+con el anterior (`inline`: la llamada síncrona dentro del endpoint). Con
+solapamiento real, el tiempo total se acerca al de una sola petición y `/ping`
+responde en milisegundos. Además comprueba que, con los pools, ninguna etapa del
+flujo de agentes vence su timeout por esperar en la cola del pool de etapas
+(sale con código 1 si alguna lo hace).
+
+Uso:
+    python benchmarks/event_loop_load.py
+    python benchmarks/event_loop_load.py --users 20 --latency 0.5 --pdfs 4
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+PDF_HTML = '<h1>Informe</h1>' + '<p>La actividad física regular ayuda a controlar la glucosa.</p>' * 40
+
+
+async def _inline(name, fn, *args, **kwargs):
+    # comportamiento anterior: la función síncrona se ejecuta en el propio event loop
+    return fn(*args, **kwargs)
+
+
+async def run_load(users: int, pdfs: int, inline: bool) -> dict:
+    import httpx
+    import app.main as main
+    from api import coach
+
+    original = main.run_blocking
+    original_flow = main.run_agent_flow
+    timed_out = []
+
+    def traced_flow(*args, **kwargs):
+        out = original_flow(*args, **kwargs)
+        timed_out.extend(out.get('timings', {}).get('timed_out', []))
+        return out
+
+    main.run_agent_flow = traced_flow
+    if inline:
+        main.run_blocking = coach.run_blocking = _inline
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=300) as client:
+            ping_latencies = []
+            stop = asyncio.Event()
+
+            async def probe():
+                # latencia desde que el sondeo debía salir: incluye el tiempo con el loop bloqueado
+                while not stop.is_set():
+                    due = time.perf_counter() + 0.02
+                    await asyncio.sleep(0.02)
+                    await client.get('/ping')
+                    ping_latencies.append(time.perf_counter() - due)
+
+            async def timed(coro):
+                started = time.perf_counter()
+                response = await coro
+                return time.perf_counter() - started, response
+
+            probe_task = asyncio.create_task(probe())
+            started = time.perf_counter()
+            jobs = [timed(client.post('/api/chat', json={'message': f'Consulta de carga número {i} sobre la glucosa'}))
+                    for i in range(users)]
+            jobs += [timed(client.post('/api/pdf/create', json={'html_content': PDF_HTML, 'title': f'Carga {i}',
+                                                                 'percentage': 42.0}))
+                     for i in range(pdfs)]
+            results = await asyncio.gather(*jobs)
+            wall = time.perf_counter() - started
+            stop.set()
+            await probe_task
+            # borrar los PDFs de prueba
+            for _, response in results:
+                pdf_id = response.json().get('pdf_id') if response.status_code == 200 else None
+                if pdf_id:
+                    await client.delete(f'/api/pdf/{pdf_id}')
+    finally:
+        main.run_blocking = coach.run_blocking = original
+        main.run_agent_flow = original_flow
+
+    latencies = [lat for lat, _ in results]
+    return {
+        'mode': 'inline' if inline else 'pools',
+        'wall': wall,
+        'sum_latency': sum(latencies),
+        'overlap': sum(latencies) / wall if wall else 0.0,
+        'errors': sum(1 for _, response in results if response.status_code >= 400),
+        'ping_max': max(ping_latencies) if ping_latencies else 0.0,
+        'ping_p50': statistics.median(ping_latencies) if ping_latencies else 0.0,
+        'pings': len(ping_latencies),
+        'timed_out': len(timed_out),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=12, help='Peticiones /api/chat simultáneas')
+    parser.add_argument('--pdfs', type=int, default=2, help='Peticiones /api/pdf/create simultáneas')
+    parser.add_argument('--latency', type=float, default=0.3, help='Servidor falso: latencia por petición (s)')
+    parser.add_argument('--tokens-per-sec', type=float, default=200.0)
+    args = parser.parse_args()
+
+    from fake_openai_server import start_fake_server
+    _, base_url = start_fake_server(latency=args.latency, tokens_per_sec=args.tokens_per_sec, default_tokens=60)
+    os.environ['OPENAI_BASE_URL'] = base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'fake')
+    os.environ.setdefault('RETRIEVAL_MODE', 'lexical')
+    os.environ['ANSWER_CACHE'] = '0'
+    os.environ['RISK_SELECTOR_LOG'] = '0'
+    os.environ['EMBEDDING_CACHE'] = '0'
+
+    results = [asyncio.run(run_load(args.users, args.pdfs, inline)) for inline in (True, False)]
+    header = (f"{'modo':<7} {'tiempo total':>13} {'suma latencias':>15} {'solapamiento':>13} {'errores':>8} "
+              f"{'/ping p50':>10} {'/ping máx':>10} {'timeouts':>9}")
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['mode']:<7} {r['wall']:>12.2f}s {r['sum_latency']:>14.2f}s {r['overlap']:>12.1f}x {r['errors']:>8} "
+              f"{r['ping_p50'] * 1000:>8.0f}ms {r['ping_max'] * 1000:>8.0f}ms {r['timed_out']:>9}")
+    if results[-1]['timed_out']:
+        sys.exit(f"{results[-1]['timed_out']} etapas vencieron su timeout con {args.users} usuarios simultáneos")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""Servidor local compatible con la API de OpenAI, para pruebas y benchmarks.
+
+Implementa `POST /v1/chat/completions` (con y sin `stream`) y
+`POST /v1/embeddings` con latencia, velocidad de generación y tasa de errores
+configurables. Las respuestas de chat son texto de relleno cuya longitud
+depende de `max_tokens`; los embeddings son deterministas por texto.
+
+Uso:
+    python benchmarks/fake_openai_server.py --port 8100 --latency 0.3 --tokens-per-sec 80
+    OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=fake uvicorn app.main:app
+
+Desde Python:
+    server, base_url = start_fake_server(latency=0.2)
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from typing import Tuple
+
+WORDS = ('la alimentación equilibrada y la actividad física regular ayudan a controlar la glucosa '
+         'y reducir el riesgo cardiovascular consulta a tu médico ante cualquier síntoma').split()
+
+
+class FakeOpenAIConfig:
+    def __init__(self, latency: float = 0.2, tokens_per_sec: float = 100.0, fail_rate: float = 0.0,
+                 default_tokens: int = 200, embedding_dim: int = 64):
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.fail_rate = fail_rate
+        self.default_tokens = default_tokens
+        self.embedding_dim = embedding_dim
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+
+def _prompt_tokens(body: dict) -> int:
+    return sum(len(str(m.get('content', ''))) // 4 for m in body.get('messages', []))
+
+
+def make_handler(config: FakeOpenAIConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status: int, payload: dict, headers: dict = None):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('content-type', 'application/json')
+            self.send_header('content-length', str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('content-length', 0))) or b'{}')
+            with config.lock:
+                config.requests += 1
+                config.in_flight += 1
+                config.max_in_flight = max(config.max_in_flight, config.in_flight)
+            try:
+                self._handle(body)
+            finally:
+                with config.lock:
+                    config.in_flight -= 1
+
+        def _handle(self, body: dict):
+            if config.fail_rate and random.random() < config.fail_rate:
+                self._send_json(503, {'error': {'message': 'fake overload', 'type': 'server_error'}},
+                                {'retry-after': '0.05'})
+                return
+            time.sleep(config.latency)
+            if self.path.endswith('/embeddings'):
+                self._embeddings(body)
+            elif self.path.endswith('/chat/completions'):
+                self._chat(body)
+            else:
+                self._send_json(404, {'error': {'message': f'ruta desconocida {self.path}'}})
+
+        def _embeddings(self, body: dict):
+            inputs = body.get('input', [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            data = []
+            for i, text in enumerate(inputs):
+                seed = int(hashlib.sha256(str(text).encode()).hexdigest()[:8], 16)
+                rng = random.Random(seed)
+                data.append({'object': 'embedding', 'index': i,
+                             'embedding': [rng.uniform(-1, 1) for _ in range(config.embedding_dim)]})
+            self._send_json(200, {'object': 'list', 'data': data, 'model': body.get('model'),
+                                  'usage': {'prompt_tokens': len(inputs), 'total_tokens': len(inputs)}})
+
+        def _chat(self, body: dict):
+            n_tokens = min(body.get('max_tokens') or config.default_tokens, config.default_tokens)
+            words = [WORDS[i % len(WORDS)] for i in range(n_tokens)]
+            usage = {'prompt_tokens': _prompt_tokens(body), 'completion_tokens': n_tokens,
+                     'total_tokens': _prompt_tokens(body) + n_tokens}
+            base = {'id': 'chatcmpl-fake', 'created': int(time.time()), 'model': body.get('model')}
+            delay = 1.0 / config.tokens_per_sec if config.tokens_per_sec > 0 else 0.0
+            if not body.get('stream'):
+                time.sleep(delay * n_tokens)
+                self._send_json(200, {**base, 'object': 'chat.completion', 'usage': usage, 'choices': [{
+                    'index': 0, 'finish_reason': 'stop',
+                    'message': {'role': 'assistant', 'content': ' '.join(words)}}]})
+                return
+            self.send_response(200)
+            self.send_header('content-type', 'text/event-stream')
+            self.send_header('transfer-encoding', 'chunked')
+            self.end_headers()
+
+            def send(payload: dict):
+                chunk = f'data: {json.dumps(payload)}\n\n'.encode()
+                self.wfile.write(f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n')
+                self.wfile.flush()
+
+            for i, word in enumerate(words):
+                time.sleep(delay)
+                send({**base, 'object': 'chat.completion.chunk', 'choices': [{
+                    'index': 0, 'finish_reason': None, 'delta': {'content': (' ' if i else '') + word}}]})
+            send({**base, 'object': 'chat.completion.chunk', 'choices': [{
+                'index': 0, 'finish_reason': 'stop', 'delta': {}}]})
+            if (body.get('stream_options') or {}).get('include_usage'):
+                send({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})
+            done = b'data: [DONE]\n\n'
+            self.wfile.write(f'{len(done):x}\r\n'.encode() + done + b'\r\n0\r\n\r\n')
+            self.wfile.flush()
+
+    return Handler
+
+
+def start_fake_server(host: str = '127.0.0.1', port: int = 0, **config) -> Tuple[ThreadingHTTPServer, str]:
+    """Arranca el servidor en un hilo de fondo; devuelve (servidor, base_url)."""
+    cfg = FakeOpenAIConfig(**config)
+    server = ThreadingHTTPServer((host, port), make_handler(cfg))
+    server.daemon_threads = True
+    server.config = cfg
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}/v1'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency', type=float, default=0.2, help='Segundos antes de la primera respuesta')
+    parser.add_argument('--tokens-per-sec', type=float, default=100.0)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Fracción de peticiones que responden 503')
+    args = parser.parse_args()
+    server, base_url = start_fake_server(args.host, args.port, latency=args.latency,
+                                         tokens_per_sec=args.tokens_per_sec, fail_rate=args.fail_rate)
+    print(f'Servidor OpenAI falso en {base_url} (Ctrl+C para salir)')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Comprobación automática de las políticas de `LLMClient` contra el servidor falso.
+
+Verifica reintentos ante 503, apertura del circuit breaker (sin tocar el
+backend mientras está abierto), el límite de concurrencia del semáforo y el
+plazo de `complete()`. Sale con código 1 si alguna comprobación falla.
+
+Uso:
+    python benchmarks/llm_client_check.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import sys
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_openai_server import start_fake_server  # noqa: E402
+from src.agents.openai_utils import CircuitBreaker, CircuitOpenError, LLMClient  # noqa: E402
+
+MODEL = 'gpt-4o-mini'
+
+
+def _client(base_url: str, **kwargs) -> LLMClient:
+    kwargs.setdefault('backoff_base', 0.01)
+    kwargs.setdefault('backoff_max', 0.05)
+    return LLMClient(api_key='fake', base_url=base_url, **kwargs)
+
+
+def check_retries(server, base_url) -> list:
+    cfg = server.config
+    cfg.fail_rate, cfg.requests = 1.0, 0
+    client = _client(base_url, max_retries=2, breaker=CircuitBreaker(failure_threshold=100))
+    try:
+        client.complete('hola', MODEL, max_tokens=5)
+        return ['reintentos: la llamada debía fallar con 503']
+    except Exception:
+        pass
+    finally:
+        cfg.fail_rate = 0.0
+    errors = []
+    if cfg.requests != 3:
+        errors.append(f'reintentos: {cfg.requests} peticiones, se esperaban 3 (1 + 2 reintentos)')
+    if client.metrics.stats()[MODEL]['retries'] != 2:
+        errors.append(f"reintentos: métrica retries={client.metrics.stats()[MODEL]['retries']}, se esperaba 2")
+    cfg.requests = 0
+    if client.complete('hola', MODEL, max_tokens=5) == '' or cfg.requests != 1:
+        errors.append('reintentos: una llamada sana debía resolverse en una petición')
+    return errors
+
+
+def check_breaker(server, base_url) -> list:
+    cfg = server.config
+    cfg.fail_rate = 1.0
+    client = _client(base_url, max_retries=0, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.5))
+    errors = []
+    try:
+        for _ in range(2):
+            try:
+                client.complete('hola', MODEL, max_tokens=5)
+            except CircuitOpenError:
+                errors.append('breaker: se abrió antes de alcanzar el umbral')
+            except Exception:
+                pass
+        if client.breaker.state != 'open':
+            errors.append(f'breaker: estado {client.breaker.state} tras 2 fallos, se esperaba open')
+        cfg.requests = 0
+        try:
+            client.complete('hola', MODEL, max_tokens=5)
+            errors.append('breaker: la llamada con el breaker abierto no falló')
+        except CircuitOpenError:
+            pass
+        if cfg.requests:
+            errors.append('breaker: con el breaker abierto la llamada llegó al backend')
+    finally:
+        cfg.fail_rate = 0.0
+    time.sleep(0.6)
+    try:
+        client.complete('hola', MODEL, max_tokens=5)
+    except Exception as e:
+        errors.append(f'breaker: la llamada de prueba en semiabierto falló ({e})')
+    if client.breaker.state != 'closed':
+        errors.append(f'breaker: estado {client.breaker.state} tras la prueba correcta, se esperaba closed')
+    return errors
+
+
+def check_semaphore(server, base_url, max_concurrency: int = 3, calls: int = 12) -> list:
+    cfg = server.config
+    cfg.latency, cfg.max_in_flight = 0.1, 0
+    client = _client(base_url, max_concurrency=max_concurrency)
+    with ThreadPoolExecutor(max_workers=calls) as pool:
+        list(pool.map(lambda i: client.complete(f'consulta {i}', MODEL, max_tokens=5), range(calls)))
+    cfg.latency = 0.0
+    if cfg.max_in_flight > max_concurrency:
+        return [f'semáforo: {cfg.max_in_flight} peticiones simultáneas, límite {max_concurrency}']
+    if cfg.max_in_flight < max_concurrency:
+        return [f'semáforo: sólo {cfg.max_in_flight} simultáneas; las llamadas no se solaparon']
+    return []
+
+
+def check_deadline(server, base_url) -> list:
+    cfg = server.config
+    cfg.latency = 1.0
+    client = _client(base_url, max_concurrency=1, timeout=5.0, max_retries=0)
+    client.call_deadline = lambda: 0.3
+    started = time.perf_counter()
+    try:
+        client.complete('hola', MODEL, max_tokens=5)
+        return ['plazo: complete() no respetó call_deadline()']
+    except TimeoutError:
+        elapsed = time.perf_counter() - started
+        return [] if elapsed < 0.8 else [f'plazo: TimeoutError tras {elapsed:.2f}s, se esperaba ~0.3s']
+    finally:
+        cfg.latency = 0.0
+
+
+def main() -> int:
+    server, base_url = start_fake_server(latency=0.0, tokens_per_sec=0, default_tokens=5)
+    failures = []
+    for check in (check_retries, check_breaker, check_semaphore, check_deadline):
+        errors = check(server, base_url)
+        print(f"{check.__name__:<16} {'OK' if not errors else 'FALLO'}")
+        for error in errors:
+            print(f'  - {error}')
+        failures += errors
+    server.shutdown()
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
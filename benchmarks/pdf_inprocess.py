@@ -0,0 +1,121 @@
+"""Coste de encolar el PDF del coach por HTTP a la propia app frente a la llamada en proceso.
+
+El coach enviaba el informe con un `httpx.AsyncClient` nuevo a
+`http://localhost:8000/api/pdf/...`: serialización JSON del HTML, conexión TCP,
+validación de FastAPI y una segunda petición en el mismo servidor. Ahora llama
+a `src.pdf_service.submit_pdf`. Para medir sólo ese trayecto, la cola de PDFs
+del benchmark da los trabajos por terminados sin renderizar.
+
+La app se sirve con uvicorn en un hilo y un puerto libre; el cliente HTTP corre
+en el event loop principal.
+
+Uso:
+    python benchmarks/pdf_inprocess.py
+    python benchmarks/pdf_inprocess.py --requests 500 --concurrency 20
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+# informe de tamaño parecido al de una evaluación completa
+REPORT_HTML = ('<h2>📊 Resultados de tu Evaluación</h2>'
+               + '<p>Tu nivel de riesgo es <strong>MEDIO</strong>. Mantener una actividad física regular '
+                 'y una alimentación equilibrada ayuda a controlar la glucosa.</p>' * 30)
+
+
+def start_server(app) -> str:
+    import uvicorn
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning', lifespan='off'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f'http://127.0.0.1:{port}'
+
+
+async def via_http(base_url: str, payload: dict) -> None:
+    import httpx
+
+    # como el coach anterior: un cliente nuevo por informe
+    async with httpx.AsyncClient() as client:
+        response = await client.post(f'{base_url}/api/pdf/jobs', json=payload, timeout=30.0)
+        response.raise_for_status()
+
+
+async def in_process(base_url: str, payload: dict) -> None:
+    from src import pdf_service
+
+    pdf_service.submit_pdf(**payload)
+
+
+async def run(call, base_url: str, payload: dict, requests: int, concurrency: int) -> dict:
+    latencies = []
+
+    async def one():
+        started = time.perf_counter()
+        await call(base_url, payload)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for i in range(0, requests, concurrency):
+        await asyncio.gather(*(one() for _ in range(min(concurrency, requests - i))))
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'wall': wall,
+        'mean': statistics.mean(latencies),
+        'p50': latencies[len(latencies) // 2],
+        'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='Informes encolados por modo')
+    parser.add_argument('--concurrency', type=int, default=1, help='Informes simultáneos')
+    args = parser.parse_args()
+
+    os.environ['PDF_JOB_MAX_PENDING'] = str(args.requests * 4)
+    os.environ.setdefault('LOCAL_EMBEDDING_WARMUP', '0')
+    import app.main as main_module
+    from src import pdf_service
+    from src.pdf_jobs import get_pdf_job_queue
+
+    queue = get_pdf_job_queue(pdf_service.PDF_DIR)
+    # sin renderizar: sólo se mide el camino hasta la cola
+    queue._dispatch = lambda job: queue._finish(job, result={'pdf_id': job.job_id})
+
+    base_url = start_server(main_module.app)
+    payload = {'html_content': REPORT_HTML, 'title': 'Informe de Evaluacion de Riesgo de Diabetes - Riesgo MEDIO',
+               'description': 'Evaluacion de riesgo de diabetes. Nivel: MEDIO (42.0%).', 'percentage': 42.0}
+    print(f"HTML del informe: {len(REPORT_HTML.encode('utf-8')) / 1024:.1f} KB, "
+          f"{args.requests} informes, concurrencia {args.concurrency}\n")
+
+    header = f"{'modo':<11} {'tiempo total':>13} {'media':>10} {'p50':>10} {'p95':>10}"
+    print(header)
+    print('-' * len(header))
+    results = {}
+    for name, call in (('http', via_http), ('en proceso', in_process)):
+        asyncio.run(run(call, base_url, payload, min(10, args.requests), 1))  # calentamiento
+        r = results[name] = asyncio.run(run(call, base_url, payload, args.requests, args.concurrency))
+        print(f"{name:<11} {r['wall']:>12.3f}s {r['mean'] * 1000:>8.2f}ms {r['p50'] * 1000:>8.2f}ms "
+              f"{r['p95'] * 1000:>8.2f}ms")
+    saved = results['http']['mean'] - results['en proceso']['mean']
+    print(f"\nSobrecoste eliminado por informe: {saved * 1000:.2f} ms de media")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Compara latencia y tokens de los modos de pipeline `two_stage` y `fused`.
+
+Por defecto arranca benchmarks/fake_openai_server.py (latencia y velocidad de
+generación configurables), así que no consume la API real. Con `--real` usa
+OPENAI_API_KEY / OPENAI_BASE_URL del entorno.
+
+Uso:
+    python benchmarks/pipeline_modes.py
+    python benchmarks/pipeline_modes.py --runs 10 --latency 0.4 --tokens-per-sec 60 --stream
+"""
+from pathlib import Path
+import argparse
+import os
+import statistics
+import sys
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+QUERIES = [
+    '¿Qué alimentos ayudan a controlar la glucosa en sangre?',
+    'Tengo sed constante y visión borrosa, ¿puede ser diabetes?',
+    '¿Cuánto ejercicio semanal se recomienda para prevenir la diabetes tipo 2?',
+    '¿Qué significa tener una HbA1c de 6.2%?',
+]
+
+
+def token_totals(stats: dict) -> dict:
+    totals = {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+    for model_stats in (stats or {}).get('models', {}).values():
+        for key in totals:
+            totals[key] += model_stats.get(key, 0)
+    return totals
+
+
+def run_mode(mode: str, runs: int, stream: bool) -> dict:
+    from src.agents.agents_factory import run_agent_flow, run_agent_flow_stream
+    from src.agents.openai_utils import llm_stats
+
+    os.environ['PIPELINE_MODE'] = mode
+    before = token_totals(llm_stats())
+    latencies, first_tokens = [], []
+    for i in range(runs):
+        query = QUERIES[i % len(QUERIES)]
+        started = time.perf_counter()
+        if stream:
+            for event in run_agent_flow_stream(query, use_cache=False):
+                if event['type'] == 'done':
+                    first_tokens.append(event['timings'].get('first_token', 0.0))
+        else:
+            run_agent_flow(query, use_cache=False)
+        latencies.append(time.perf_counter() - started)
+    after = token_totals(llm_stats())
+    out = {
+        'mode': mode,
+        'latency_mean': statistics.mean(latencies),
+        'latency_p50': statistics.median(latencies),
+        'calls_per_query': (after['calls'] - before['calls']) / runs,
+        'prompt_tokens_per_query': (after['prompt_tokens'] - before['prompt_tokens']) / runs,
+        'completion_tokens_per_query': (after['completion_tokens'] - before['completion_tokens']) / runs,
+    }
+    if first_tokens:
+        out['first_token_mean'] = statistics.mean(first_tokens)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=8)
+    parser.add_argument('--stream', action='store_true', help='Medir también el tiempo al primer token')
+    parser.add_argument('--real', action='store_true', help='Usar la API configurada en el entorno')
+    parser.add_argument('--latency', type=float, default=0.3, help='Servidor falso: latencia por petición (s)')
+    parser.add_argument('--tokens-per-sec', type=float, default=80.0, help='Servidor falso: velocidad de generación')
+    parser.add_argument('--max-tokens', type=int, default=500, help='Servidor falso: tokens por respuesta como máximo')
+    args = parser.parse_args()
+
+    if not args.real:
+        from fake_openai_server import start_fake_server
+        _, base_url = start_fake_server(latency=args.latency, tokens_per_sec=args.tokens_per_sec,
+                                        default_tokens=args.max_tokens)
+        os.environ['OPENAI_BASE_URL'] = base_url
+        os.environ.setdefault('OPENAI_API_KEY', 'fake')
+        os.environ.setdefault('LLM_STREAM_USAGE', '1')
+    # la recuperación léxica evita llamadas de embeddings ajenas a lo que se mide
+    os.environ.setdefault('RETRIEVAL_MODE', 'lexical')
+    os.environ['ANSWER_CACHE'] = '0'
+    # comparar los modos tal cual, sin que el enrutado de modelos los cambie por consulta
+    os.environ['MODEL_ROUTING'] = '0'
+
+    results = [run_mode(mode, args.runs, args.stream) for mode in ('two_stage', 'fused')]
+    header = f"{'modo':<10} {'lat. media':>11} {'p50':>8} {'1er token':>10} {'llamadas':>9} {'tok. entrada':>13} {'tok. salida':>12}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        first = f"{r['first_token_mean']:.2f}s" if 'first_token_mean' in r else '-'
+        print(f"{r['mode']:<10} {r['latency_mean']:>10.2f}s {r['latency_p50']:>7.2f}s {first:>10} "
+              f"{r['calls_per_query']:>9.1f} {r['prompt_tokens_per_query']:>13.0f} {r['completion_tokens_per_query']:>12.0f}")
+    two, fused = results
+    print(f"\nfused vs two_stage: latencia {fused['latency_mean'] / two['latency_mean']:.0%}, "
+          f"tokens de salida {fused['completion_tokens_per_query'] / max(two['completion_tokens_per_query'], 1):.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Evaluación offline del clasificador local de riesgo frente a las etiquetas del selector LLM.
+
+Validación cruzada estratificada sobre el registro del selector
+(kb/db/risk_selector_log.jsonl). Informa exactitud, precisión/recall por clase,
+matriz de confusión, cobertura (consultas resueltas sin LLM) y exactitud por
+umbral de confianza, y latencia de predicción.
+
+Uso:
+    python benchmarks/risk_classifier_eval.py
+    python benchmarks/risk_classifier_eval.py --log otra_ruta.jsonl --folds 10
+    python benchmarks/risk_classifier_eval.py --synthetic 600   # sin registro, datos de juguete
+"""
+from pathlib import Path
+import argparse
+import random
+import sys
+import time
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from src.agents.risk_classifier import DEFAULT_LOG_PATH, LABELS, RiskClassifier, load_labeled_log  # noqa: E402
+
+THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95)
+
+_SYNTHETIC = {
+    'bajo': ['qué alimentos tienen más fibra', 'recetas de desayuno saludable', 'cuántos pasos debo caminar al día',
+             'beneficios del ejercicio aeróbico', 'qué frutas tienen menos azúcar', 'cómo mejorar mis hábitos de sueño'],
+    'medio': ['tengo la glucosa en ayunas en 115', 'me duelen los pies y soy diabético', 'mi presión está en 145/95',
+              'olvidé tomar la metformina dos días', 'tengo sed constante desde hace semanas', 'mi hba1c salió 6.4'],
+    'alto': ['tengo dolor de pecho y me falta el aire', 'glucosa de 450 y vómitos', 'me desmayé y no siento el brazo',
+             'confusión y aliento a frutas', 'sangrado abundante que no para', 'convulsiones después de la insulina'],
+}
+_FILLERS = ['hola', 'por favor', 'necesito ayuda', 'desde ayer', 'mi mamá', 'urgente?', 'gracias', '']
+
+
+def synthetic_dataset(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    texts, labels = [], []
+    for _ in range(n):
+        label = rng.choices(LABELS, weights=(0.5, 0.35, 0.15))[0]
+        texts.append(' '.join(filter(None, [rng.choice(_FILLERS), rng.choice(_SYNTHETIC[label]), rng.choice(_FILLERS)])))
+        labels.append(label)
+    return texts, labels
+
+
+def stratified_folds(labels, k: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    folds = [[] for _ in range(k)]
+    for label in LABELS:
+        idx = [i for i, l in enumerate(labels) if l == label]
+        rng.shuffle(idx)
+        for j, i in enumerate(idx):
+            folds[j % k].append(i)
+    return folds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--log', type=Path, default=DEFAULT_LOG_PATH)
+    parser.add_argument('--synthetic', type=int, default=0, help='Generar N consultas de juguete en vez de leer el registro')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--features', type=int, default=1 << 14)
+    parser.add_argument('--epochs', type=int, default=30)
+    args = parser.parse_args()
+
+    texts, labels = synthetic_dataset(args.synthetic) if args.synthetic else load_labeled_log(args.log)
+    if len(texts) < args.folds * 2:
+        print(f'Datos insuficientes ({len(texts)} consultas etiquetadas en {args.log}).')
+        sys.exit(1)
+    print(f'{len(texts)} consultas:', {l: labels.count(l) for l in LABELS})
+
+    pred_labels, confidences, latencies = [None] * len(texts), np.zeros(len(texts)), []
+    for fold in stratified_folds(labels, args.folds):
+        test = set(fold)
+        train_idx = [i for i in range(len(texts)) if i not in test]
+        model = RiskClassifier.train([texts[i] for i in train_idx], [labels[i] for i in train_idx],
+                                     n_features=args.features, epochs=args.epochs)
+        for i in fold:
+            started = time.perf_counter()
+            pred_labels[i], confidences[i] = model.predict(texts[i])
+            latencies.append(time.perf_counter() - started)
+
+    truth = np.array([LABELS.index(l) for l in labels])
+    pred = np.array([LABELS.index(l) for l in pred_labels])
+    print(f'\nExactitud ({args.folds}-fold): {np.mean(truth == pred):.3f}')
+    print('\nclase   precisión  recall  soporte')
+    for c, label in enumerate(LABELS):
+        tp = np.sum((pred == c) & (truth == c))
+        precision = tp / max(np.sum(pred == c), 1)
+        recall = tp / max(np.sum(truth == c), 1)
+        print(f'{label:<7} {precision:>9.3f} {recall:>7.3f} {np.sum(truth == c):>8}')
+
+    print('\nMatriz de confusión (filas = LLM, columnas = local):')
+    print('        ' + ' '.join(f'{l:>6}' for l in LABELS))
+    for c, label in enumerate(LABELS):
+        print(f'{label:<7} ' + ' '.join(f'{np.sum((truth == c) & (pred == p)):>6}' for p in range(len(LABELS))))
+
+    print('\numbral  cobertura  exactitud  alto→otro')
+    for t in THRESHOLDS:
+        local = confidences >= t
+        acc = np.mean(truth[local] == pred[local]) if local.any() else float('nan')
+        # casos de riesgo alto que el modelo local resolvería con otra etiqueta (los más costosos)
+        missed_high = np.sum(local & (truth == LABELS.index('alto')) & (pred != LABELS.index('alto')))
+        print(f'{t:>6.2f} {np.mean(local):>10.1%} {acc:>10.3f} {missed_high:>10}')
+
+    lat = np.array(latencies) * 1e6
+    print(f'\nLatencia de predicción: p50 {np.percentile(lat, 50):.0f} µs, p95 {np.percentile(lat, 95):.0f} µs')
+
+
+if __name__ == '__main__':
+    main()
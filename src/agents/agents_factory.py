@@ -3,28 +3,51 @@ import os
 import sys
 import json
 import logging
-from typing import List, Optional, Callable
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Iterator, List, Optional, Callable, Tuple
 from functools import lru_cache
 
-import numpy as np
-
 # Intento robusto de importar `utils` desde `src` o como módulo plano
 try:
     from src import utils
-    from src.agents.openai_utils import get_call_model
-    from src.retrieval import retrieve_relevant
+    from src.agents.openai_utils import get_call_model, get_stream_model
+    from src.retrieval import INDEX_PATH, embed_query, retrieve_hybrid, get_retriever
+    from src.agents.answer_cache import get_answer_cache, normalize_query
+    from src.agents.single_flight import get_single_flight
+    from src.agents.model_router import RouteDecision, get_model_router, retrieval_confidence
+    from src.agents.prompts import PromptRegistry, count_tokens, get_prompt_registry
+    from src.agents.risk_classifier import get_risk_classifier, log_selector_output
+    from src.agents.context_budget import assemble_context, context_stats
+    from src.executors import EXECUTOR_SETTINGS
 except ImportError:
     project_root = Path(__file__).parent.parent
     if str(project_root) not in sys.path:
         sys.path.insert(0, str(project_root))
     try:
         from src import utils
-        from src.agents.openai_utils import get_call_model
-        from src.retrieval import retrieve_relevant
+        from src.agents.openai_utils import get_call_model, get_stream_model
+        from src.retrieval import INDEX_PATH, embed_query, retrieve_hybrid, get_retriever
+        from src.agents.answer_cache import get_answer_cache, normalize_query
+        from src.agents.single_flight import get_single_flight
+        from src.agents.model_router import RouteDecision, get_model_router, retrieval_confidence
+        from src.agents.prompts import PromptRegistry, count_tokens, get_prompt_registry
+        from src.agents.risk_classifier import get_risk_classifier, log_selector_output
+        from src.agents.context_budget import assemble_context, context_stats
+        from src.executors import EXECUTOR_SETTINGS
     except ImportError:
         import utils  # type: ignore
-        from openai_utils import get_call_model # type: ignore
-        from retrieval import retrieve_relevant # type: ignore
+        from openai_utils import get_call_model, get_stream_model # type: ignore
+        from retrieval import INDEX_PATH, embed_query, retrieve_hybrid, get_retriever # type: ignore
+        from answer_cache import get_answer_cache, normalize_query # type: ignore
+        from single_flight import get_single_flight # type: ignore
+        from model_router import RouteDecision, get_model_router, retrieval_confidence # type: ignore
+        from prompts import PromptRegistry, count_tokens, get_prompt_registry # type: ignore
+        from risk_classifier import get_risk_classifier, log_selector_output # type: ignore
+        from context_budget import assemble_context, context_stats # type: ignore
+        from executors import EXECUTOR_SETTINGS # type: ignore
 
 
 logger = logging.getLogger(__name__)
@@ -34,19 +57,7 @@ if not logger.handlers:
 
 
 # Directorio con instrucciones de agentes (markdown)
-KB_AGENTS_DIR = Path(__file__).resolve().parent.parent / 'kb' / 'agents'
-
-# Cache del índice en memoria para evitar lecturas repetidas desde disco
-_INDEX_CACHE: Optional[tuple] = None  # (emb_arr, metadatas)
-
-
-def _load_index_cached(index_path: Path):
-    global _INDEX_CACHE
-    if _INDEX_CACHE is None:
-        emb_arr, metadatas = utils.load_index(index_path)
-        _INDEX_CACHE = (emb_arr, metadatas)
-    return _INDEX_CACHE
-
+KB_AGENTS_DIR = Path(__file__).resolve().parent.parent.parent / 'kb' / 'agents'
 
 @lru_cache(maxsize=256)
 def _embed_query_cached(query: str):
@@ -58,178 +69,688 @@ def _embed_query_cached(query: str):
         return [0.0]
 
 
+def _answer_cache_watched_files() -> list:
+    """Archivos cuyo cambio invalida las respuestas cacheadas: índice e instrucciones."""
+    layout = utils.index_layout(INDEX_PATH)
+    return [layout['meta'], Path(INDEX_PATH), *KB_AGENTS_DIR.glob('*.md')]
+
+
+def coalescing_stats() -> Optional[dict]:
+    flight = get_single_flight()
+    return flight.stats() if flight is not None else None
+
+
+def answer_cache_stats() -> Optional[dict]:
+    cache = get_answer_cache(_answer_cache_watched_files)
+    return cache.stats() if cache is not None else None
+
+
+def _prompts() -> PromptRegistry:
+    return get_prompt_registry(KB_AGENTS_DIR)
+
+
 def _read_agent_instructions(name: str) -> str:
-    path = KB_AGENTS_DIR / f"{name}.md"
-    if not path.exists():
-        return ""
-    text = path.read_text(encoding='utf-8')
-    # eliminar fences de código para evitar confundir prompts
-    lines = []
-    skip = False
-    for ln in text.splitlines():
-        if ln.strip().startswith('```'):
-            skip = not skip
-            continue
-        if not skip:
-            lines.append(ln)
-    return '\n'.join(lines)
-
-
-def run_risk_selector(user_input: str, call_model: Callable, model_default: str) -> str:
-    risk_prompt = _read_agent_instructions('risk_selector_agent') + f"\n\nUser query:\n{user_input}\n\nPor favor responde solo con 'bajo', 'medio' o 'alto'."
+    """Instrucciones compiladas del agente `name` (registro en memoria, recarga en caliente)."""
+    return _prompts().get(name)
+
+
+def prompt_stats() -> dict:
+    """Tokens por plantilla y recargas del registro de prompts."""
+    return _prompts().stats()
+
+
+# Decisiones del selector de riesgo: clasificador local vs. LLM
+_RISK_DECISIONS = {'local': 0, 'llm': 0, 'llm_errors': 0}
+
+
+def risk_selector_stats() -> dict:
+    total = _RISK_DECISIONS['local'] + _RISK_DECISIONS['llm']
+    return {**_RISK_DECISIONS, 'local_rate': _RISK_DECISIONS['local'] / total if total else 0.0}
+
+
+def run_risk_selector(user_input: str, call_model: Callable, model_default: str, log: bool = True) -> str:
+    """Nivel de riesgo de la consulta: 'bajo', 'medio' o 'alto'.
+
+    Si hay un clasificador local entrenado y su confianza supera
+    RISK_CLASSIFIER_THRESHOLD, no se llama al LLM. Con `log` (y RISK_SELECTOR_LOG=1),
+    las respuestas válidas del LLM se registran para reentrenar el clasificador;
+    las consultas con datos personales no deben registrarse.
+    """
+    classifier = get_risk_classifier()
+    if classifier is not None:
+        label, confidence = classifier.predict(user_input)
+        if confidence >= float(os.getenv('RISK_CLASSIFIER_THRESHOLD', '0.85')):
+            _RISK_DECISIONS['local'] += 1
+            return label
+
+    _RISK_DECISIONS['llm'] += 1
+    risk_prompt = f"User query:\n{user_input}\n\nPor favor responde solo con 'bajo', 'medio' o 'alto'."
     try:
-        risk_out = call_model(risk_prompt, model=model_default, max_tokens=10)
+        risk_out = call_model(risk_prompt, model=model_default, max_tokens=10,
+                              system=_read_agent_instructions('risk_selector_agent'))
         if risk_out:
-            risk = (risk_out or '').strip().lower().split()[0]
+            risk = (risk_out or '').strip().lower().split()[0].strip('.,;:"\'*')
             if risk not in ('bajo', 'medio', 'alto'):
                 risk = 'medio'
+            elif log:
+                log_selector_output(user_input, risk)
         else:
             risk = 'medio'
     except Exception:
         logger.exception('Risk selector failed, defaulting to medio')
+        _RISK_DECISIONS['llm_errors'] += 1
         risk = 'medio'
     return risk
 
-def run_retrieval(user_input: str) -> tuple[list[dict], str]:
-    # Parametrizar top_k y tamaño de snippet por ENV para ajustes rápidos
+def run_retrieval(user_input: str) -> tuple[list[dict], str, dict]:
+    """Recupera candidatos y ensambla el contexto: (fragmentos, contexto, informe de tokens).
+
+    - RETRIEVAL_TOP_K: fragmentos como máximo en el contexto (3)
+    - RETRIEVAL_CANDIDATES: candidatos entre los que elige MMR (3 * top_k)
+    - RETRIEVAL_SNIPPET_CHARS: caracteres por fragmento como máximo, en final de oración (350)
+    - CONTEXT_TOKEN_BUDGET: tokens del contexto completo (600)
+    - CONTEXT_MMR_LAMBDA / CONTEXT_DEDUP_THRESHOLD: peso de la relevancia frente a la
+      diversidad (0.7) y similitud a partir de la cual un fragmento es duplicado (0.85)
+    """
     top_k_env = int(os.getenv('RETRIEVAL_TOP_K', '3'))  # Reducido de 5 a 3 para mayor velocidad
     snippet_chars = int(os.getenv('RETRIEVAL_SNIPPET_CHARS', '350'))  # Reducido de 500 a 350
+    n_candidates = int(os.getenv('RETRIEVAL_CANDIDATES', str(3 * top_k_env)))
 
-    # retrieve_relevant internamente puede ser una función que lee desde disco;
-    # si existe una versión local cargada (src.retrieval) la usamos, si no, usamos
-    # utils.load_index pero desde memoria (cache).
+    # retrieve_hybrid consulta el índice residente en memoria (src.retrieval):
+    # denso + BM25 (RRF), o sólo BM25 si el backend de embeddings no responde.
     try:
-        # intentar usar la función importada retrieve_relevant (si fue sobrescrita)
-        retrieved = retrieve_relevant(user_input, top_k=top_k_env)
+        candidates = retrieve_hybrid(user_input, top_k=n_candidates)
     except Exception:
-        # fallback: cargar índice en memoria y calcular similitud localmente
-        index_path = Path(__file__).parent.parent / 'kb' / 'db' / 'index.npz'
-        if not index_path.exists():
-            logger.info('No se encontró índice en %s', index_path)
-            return [], ''
-        emb_arr, metadatas = _load_index_cached(index_path)
-        if emb_arr is None or not metadatas:
-            return [], ''
-        q_emb = _embed_query_cached(user_input)
-        emb_matrix = np.array(emb_arr)
-        qv = np.array(q_emb)
-
-        def cos(a, b):
-            denom = (np.linalg.norm(a) * np.linalg.norm(b))
-            return float(np.dot(a, b) / denom) if denom != 0 else 0.0
-
-        scores = [cos(qv, emb_matrix[i]) for i in range(len(emb_matrix))]
-        idxs = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:top_k_env]
-        retrieved = []
-        for i in idxs:
-            m = dict(metadatas[i])
-            if 'text' in m and isinstance(m['text'], str):
-                m['text'] = m['text'][:snippet_chars]
-            m['score'] = scores[i]
-            retrieved.append(m)
-
-    # Construir contexto reducido para ahorrar tokens y latencia
-    context = '\n\n---\n\n'.join([f"Source: {r.get('source')}\nScore: {r.get('score'):.4f}\nText:\n{r.get('text')}" for r in retrieved])
-    return retrieved, context
+        # fallback: búsqueda léxica o, sin BM25, densa con el embedding cacheado
+        logger.exception('retrieve_hybrid falló; usando búsqueda local de respaldo')
+        retriever = get_retriever()
+        if retriever is None:
+            return [], '', {}
+        if retriever.bm25 is not None:
+            candidates = retriever.search_lexical(user_input, top_k=n_candidates)
+        else:
+            candidates = retriever.search(_embed_query_cached(user_input), top_k=n_candidates)
+    candidates = [m for m in candidates if isinstance(m.get('text'), str)]
+
+    # Empaquetar los mejores fragmentos (sin duplicados) en el presupuesto de tokens
+    retrieved, context, report = assemble_context(
+        candidates, top_k_env, int(os.getenv('CONTEXT_TOKEN_BUDGET', '600')), snippet_chars,
+        lambda_=float(os.getenv('CONTEXT_MMR_LAMBDA', '0.7')),
+        dedup_threshold=float(os.getenv('CONTEXT_DEDUP_THRESHOLD', '0.85')),
+    )
+    if report.candidates:
+        logger.info('Contexto: %d/%d fragmentos, %d tokens (%d ahorrados, %d duplicados, %d recortados)',
+                    report.selected, report.candidates, report.tokens_used, report.tokens_saved,
+                    report.duplicates, report.trimmed)
+    return retrieved, context, report.as_dict()
+
+# Pool compartido para ejecutar etapas independientes del grafo de agentes en paralelo. Cada flujo
+# del pool 'agent' lanza dos etapas a la vez (riesgo y recuperación): por defecto, el doble de hilos
+_AGENT_WORKERS_ENV, _AGENT_WORKERS = EXECUTOR_SETTINGS['agent'][:2]
+_STAGE_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv('AGENT_STAGE_WORKERS', str(2 * int(os.getenv(_AGENT_WORKERS_ENV, str(_AGENT_WORKERS)))))),
+    thread_name_prefix='agent-stage')
+
+# Tiempo máximo (segundos) de cada etapa; al vencer se usa el valor por defecto de la etapa
+STAGE_TIMEOUTS = {
+    'risk': float(os.getenv('AGENT_RISK_TIMEOUT', '10')),
+    'retrieval': float(os.getenv('AGENT_RETRIEVAL_TIMEOUT', '8')),
+    'draft': float(os.getenv('AGENT_DRAFT_TIMEOUT', '60')),
+    'formatter': float(os.getenv('AGENT_FORMATTER_TIMEOUT', '60')),
+    'fused': float(os.getenv('AGENT_FUSED_TIMEOUT', '60')),
+}
 
+
+def _submit_stage(name: str, fn: Callable, *args, timings: dict):
+    """Lanza una etapa en el pool registrando su duración en `timings[name]`.
+
+    El futuro lleva en `stage_started` un Event que se marca cuando la etapa sale de
+    la cola del pool, y en `stage_started_at` ese instante (time.perf_counter).
+    """
+    started_event = threading.Event()
+    started_at = []
+
+    def run():
+        started = time.perf_counter()
+        started_at.append(started)
+        started_event.set()
+        try:
+            return fn(*args)
+        finally:
+            timings[name] = round(time.perf_counter() - started, 4)
+    future = _STAGE_POOL.submit(run)
+    future.stage_started, future.stage_started_at = started_event, started_at
+    return future
+
+
+def _await_stage(name: str, future, default: Any, timings: dict) -> Any:
+    """Espera el resultado de una etapa; si falla o supera STAGE_TIMEOUTS[name], `default`.
+
+    El plazo se cuenta desde que la etapa empieza a ejecutarse: la espera en la cola
+    del pool (limitada a otro plazo igual) no lo consume.
+    """
+    timeout = STAGE_TIMEOUTS[name]
+    try:
+        if not future.stage_started.wait(timeout):
+            raise FutureTimeoutError
+        return future.result(timeout=max(0.0, future.stage_started_at[0] + timeout - time.perf_counter()))
+    except FutureTimeoutError:
+        logger.warning('Etapa %s superó su timeout (%.1fs); se usa el valor por defecto', name, STAGE_TIMEOUTS[name])
+        future.cancel()
+        timings.setdefault('timed_out', []).append(name)
+    except Exception:
+        logger.exception('Etapa %s falló; se usa el valor por defecto', name)
+    return default
+
+
+def _run_stage(name: str, fn: Callable, *args, default: Any, timings: dict) -> Any:
+    future = _submit_stage(name, fn, *args, timings=timings)
+    return _await_stage(name, future, default, timings)
+
+
+def _stream_stage(name: str, tokens: Iterator[str], timings: dict) -> Iterator[str]:
+    """Itera `tokens` en el pool de etapas con el timeout STAGE_TIMEOUTS[name].
+
+    Como `_await_stage`, el plazo cuenta desde que la etapa empieza a ejecutarse. Si
+    vence, se deja de emitir (el texto queda como esté) y se anota en `timings['timed_out']`.
+    """
+    timeout = STAGE_TIMEOUTS[name]
+    events: queue.Queue = queue.Queue()
+    stop = threading.Event()
+
+    def pump():
+        events.put(('start', time.perf_counter()))
+        try:
+            for token in tokens:
+                if stop.is_set():
+                    break
+                events.put(('token', token))
+        except Exception as e:
+            events.put(('error', e))
+        finally:
+            close = getattr(tokens, 'close', None)
+            if close is not None:
+                close()
+            events.put(('end', None))
+
+    _STAGE_POOL.submit(pump)
+    deadline = None
+    try:
+        while True:
+            wait = timeout if deadline is None else deadline - time.perf_counter()
+            try:
+                kind, value = events.get(timeout=max(0.0, wait))
+            except queue.Empty:
+                logger.warning('Etapa %s superó su timeout (%.1fs); se corta el streaming', name, timeout)
+                timings.setdefault('timed_out', []).append(name)
+                return
+            if kind == 'start':
+                deadline = value + timeout
+            elif kind == 'token':
+                yield value
+            elif kind == 'error':
+                raise value
+            else:
+                return
+    finally:
+        # cliente desconectado o timeout: el hilo deja de leer en el siguiente fragmento
+        stop.set()
+
+
+FALLBACK_FINAL = 'Lo siento — no pude generar una respuesta en este momento. Intenta de nuevo más tarde.'
+GREETING_FINAL = '¡Hola! 👋 Soy MediNutrIA, tu asistente de salud y nutrición. ¿En qué puedo ayudarte hoy? Puedes preguntarme sobre alimentación, ejercicio, condiciones de salud o cualquier tema relacionado con tu bienestar.'
+MEDICAL_DISCLAIMER = "\n\n\n\n💙Recuerda: Esta información es solo para fines educativos y está basada en una recopilación de datos confiables. Sin embargo, **no reemplaza una consulta médica profesional**. Siempre es importante que consultes con tu médico o un profesional de la salud calificado para recibir un diagnóstico y tratamiento personalizado. ¡Tu salud es lo más importante! 💙"
+
+
+# Se envía a la API salvo con LLM_SEND_TEMPERATURE=0 o modelos de razonamiento
 RISK_TEMPERATURE_MAP = {
     "bajo": 0.0,
     "medio": 0.5,
     "alto": 1.0,
 }
 
-def run_draft_generator(user_input: str, context: str, risk: str, call_model: Callable, model_default: str, temperature: float) -> str:
+PIPELINE_MODES = ('two_stage', 'fused')
+
+
+def pipeline_mode() -> str:
+    """Modo del pipeline de generación (PIPELINE_MODE): `two_stage` (borrador + formateo) o `fused`."""
+    mode = os.getenv('PIPELINE_MODE', 'two_stage').strip().lower()
+    if mode not in PIPELINE_MODES:
+        logger.warning('PIPELINE_MODE desconocido %r; se usa two_stage', mode)
+        return 'two_stage'
+    return mode
+
+
+def _risk_info(risk: str) -> str:
+    return f"**NIVEL DE RIESGO DETECTADO: {risk.upper()}**\nAdapta tu respuesta según las instrucciones para riesgo {risk}."
+
+
+# Los prompts se devuelven como (system, user): el mensaje de sistema es el prefijo
+# estable (instrucciones compiladas, igual en todas las peticiones) y el de usuario,
+# la parte variable. Así el caché de prompts del proveedor reutiliza el prefijo.
+
+def _draft_prompt(user_input: str, context: str, risk: str) -> Tuple[str, str]:
+    return (_read_agent_instructions('retrieval'),
+            _risk_info(risk) + f"\n\nConsulta:\n{user_input}\n\nContexto recuperado:\n{context}")
+
+
+def _formatter_prompt(draft: str) -> Tuple[str, str]:
+    return (_read_agent_instructions('formatter'),
+            f"Borrador:\n{draft}\n\nPor favor formatea según las reglas. NO incluyas las palabras 'Borrador:' o 'Revisión:' en tu respuesta.")
+
+
+FUSED_TASK = (
+    "# Tarea\n\nRedacta directamente la respuesta FINAL para el usuario: aplica las instrucciones de"
+    " contenido y de riesgo anteriores y entrega el resultado ya estructurado según el formato de salida"
+    " (encabezados ###, listas y negritas). No escribas un borrador previo ni menciones estas instrucciones."
+)
+
+
+def _fused_prompt(user_input: str, context: str, risk: str) -> Tuple[str, str]:
+    """Instrucciones de retrieval (contenido y riesgo) y de formatter (estructura) en un único prompt."""
+    registry = _prompts()
+    system = registry.compose(
+        "# Contenido", registry.get('retrieval'), "# Formato de salida", registry.get('formatter'), FUSED_TASK,
+    )
+    return system, _risk_info(risk) + f"\n\nConsulta:\n{user_input}\n\nContexto recuperado:\n{context}"
+
+
+def run_draft_generator(user_input: str, context: str, risk: str, call_model: Callable, model_default: str, temperature: float,
+                        max_tokens: int = 800) -> str:
     """Genera el borrador de respuesta pasando el nivel de riesgo al agente de retrieval."""
     # Incluir el nivel de riesgo en el prompt para que el agente adapte su respuesta
-    risk_info = f"\n\n**NIVEL DE RIESGO DETECTADO: {risk.upper()}**\nAdapta tu respuesta según las instrucciones para riesgo {risk}."
-    retrieval_prompt = _read_agent_instructions('retrieval') + risk_info + f"\n\nConsulta:\n{user_input}\n\nContexto recuperado:\n{context}"
+    system, retrieval_prompt = _draft_prompt(user_input, context, risk)
     draft = ''
     try:
-        draft = (call_model(retrieval_prompt, model=model_default, temperature=temperature, max_tokens=800) or '').strip()
+        draft = (call_model(retrieval_prompt, model=model_default, temperature=temperature, max_tokens=max_tokens, system=system) or '').strip()
     except Exception:
         logger.exception('Draft generation failed; trying fallback prompt')
         try:
             fb_prompt = f"Responde brevemente a la consulta del usuario:\n{user_input}\n\nProvee recomendaciones prácticas y pasos a seguir."
-            draft = (call_model(fb_prompt, model=model_default, temperature=temperature, max_tokens=800) or '').strip()
+            draft = (call_model(fb_prompt, model=model_default, temperature=temperature, max_tokens=max_tokens) or '').strip()
         except Exception:
             logger.exception('Fallback draft failed')
             draft = ''
     return draft
 
-def run_formatter(draft: str, user_input: str, call_model: Callable, model_default: str, temperature: float) -> str:
-    formatter_prompt = _read_agent_instructions('formatter') + f"\n\nBorrador:\n{draft}\n\nPor favor formatea según las reglas. NO incluyas las palabras 'Borrador:' o 'Revisión:' en tu respuesta."
+def run_formatter(draft: str, user_input: str, call_model: Callable, model_default: str, temperature: float,
+                  max_tokens: int = 1000) -> str:
+    system, formatter_prompt = _formatter_prompt(draft)
     final = ''
     try:
-        final = (call_model(formatter_prompt, model=model_default, temperature=temperature, max_tokens=1000) or '').strip()
+        final = (call_model(formatter_prompt, model=model_default, temperature=temperature, max_tokens=max_tokens, system=system) or '').strip()
     except Exception:
         logger.exception('Formatter failed; trying simple response prompt')
         try:
             simple_prompt = f"Por favor, responde de forma clara y breve a esta consulta:\n{user_input}\n\nIncluye recomendaciones prácticas y próximas acciones cuando corresponda."
-            final = (call_model(simple_prompt, model=model_default, temperature=temperature, max_tokens=1000) or '').strip()
+            final = (call_model(simple_prompt, model=model_default, temperature=temperature, max_tokens=max_tokens) or '').strip()
         except Exception:
             logger.exception('Fallback final failed')
             final = ''
 
     if not final:
-        final = 'Lo siento — no pude generar una respuesta en este momento. Intenta de nuevo más tarde.'
+        final = FALLBACK_FINAL
     
     final = final.replace('<p>', '').replace('</p>', '').replace('<br>', '\n').strip()
     return final
 
-def run_agent_flow(user_input: str, run_risk_model: Optional[Callable] = None) -> dict:
-    """Orquesta el flujo de agentes y devuelve un dict con `risk`, `retrieved`, `draft`, `final`.
-
-    - run_risk_model: función opcional para ejecutar un modelo de riesgo (si aplica).
-    """
-    call_model = get_call_model()
-    model_default = os.getenv('LLM_MODEL', 'gpt-4')
-
-    # Modelos configurables: para reducir latencia podemos usar un modelo más barato
-    # para la generación del borrador. Ajusta con la variable DRAFT_MODEL.
-    draft_model = os.getenv('DRAFT_MODEL', model_default)
-    formatter_model = os.getenv('FORMATTER_MODEL', model_default)
+def run_fused_generator(user_input: str, context: str, risk: str, call_model: Callable, model_default: str, temperature: float,
+                        max_tokens: int = 1000) -> str:
+    """Modo `fused`: redacta y formatea la respuesta final en una sola llamada al modelo."""
+    final = ''
+    try:
+        system, fused_prompt = _fused_prompt(user_input, context, risk)
+        final = (call_model(fused_prompt, model=model_default, temperature=temperature, max_tokens=max_tokens, system=system) or '').strip()
+    except Exception:
+        logger.exception('Fused generation failed; trying simple response prompt')
+        try:
+            simple_prompt = f"Por favor, responde de forma clara y breve a esta consulta:\n{user_input}\n\nIncluye recomendaciones prácticas y próximas acciones cuando corresponda."
+            final = (call_model(simple_prompt, model=model_default, temperature=temperature, max_tokens=max_tokens) or '').strip()
+        except Exception:
+            logger.exception('Fallback final failed')
+            final = ''
+    return final or FALLBACK_FINAL
 
-    # Detectar si es un saludo simple o pregunta trivial (sin contenido médico)
+def _is_simple_greeting(user_input: str) -> bool:
+    """Detecta un saludo simple o pregunta trivial (sin contenido médico)."""
     user_lower = user_input.lower().strip()
     simple_greetings = ['hola', 'hi', 'hello', 'buenos días', 'buenas tardes', 'buenas noches', 
                         'hey', 'saludos', 'qué tal', 'cómo estás', 'como estas']
     
     is_simple_greeting = any(greeting == user_lower or user_lower.startswith(greeting + ' ') or user_lower.startswith(greeting + ',') 
                              for greeting in simple_greetings)
-    
-    if is_simple_greeting and len(user_input.split()) <= 3:
-        # Respuesta directa para saludos simples, sin flujo completo
-        return {
-            'risk': 'bajo',
-            'retrieved': [],
-            'draft': '',
-            'final': '¡Hola! 👋 Soy MediNutrIA, tu asistente de salud y nutrición. ¿En qué puedo ayudarte hoy? Puedes preguntarme sobre alimentación, ejercicio, condiciones de salud o cualquier tema relacionado con tu bienestar.'
-        }
-
-    risk = run_risk_selector(user_input, call_model, model_default)
-    temperature = RISK_TEMPERATURE_MAP.get(risk, 0.5)
-
-    retrieved, context = run_retrieval(user_input)
-    # Pasar el nivel de riesgo al draft generator para que adapte la respuesta
-    draft = run_draft_generator(user_input, context, risk, call_model, draft_model, temperature)
-    final = run_formatter(draft, user_input, call_model, formatter_model, temperature)
-    
+    return is_simple_greeting and len(user_input.split()) <= 3
+
+
+def _clean_final(final: str) -> str:
     # Limpiar marcadores de debug que puedan haber quedado
     final = final.replace('Borrador:', '').replace('Revisión:', '').strip()
-    final = final.replace('<p>', '').replace('</p>', '').replace('<br>', '\n').strip()
+    return final.replace('<p>', '').replace('</p>', '').replace('<br>', '\n').strip()
+
 
+def _disclaimer_for(final: str) -> str:
     # Añadir disclaimer médico solo si la respuesta contiene contenido de salud sustancial
     # (evitar disclaimer en saludos o respuestas muy cortas)
-    if len(final) > 100:  # Solo si la respuesta tiene contenido sustancial
-        disclaimer = "\n\n\n\n💙Recuerda: Esta información es solo para fines educativos y está basada en una recopilación de datos confiables. Sin embargo, **no reemplaza una consulta médica profesional**. Siempre es importante que consultes con tu médico o un profesional de la salud calificado para recibir un diagnóstico y tratamiento personalizado. ¡Tu salud es lo más importante! 💙"
-        final = final + disclaimer
+    return MEDICAL_DISCLAIMER if len(final) > 100 else ''
+
+
+def _models() -> tuple:
+    model_default = os.getenv('LLM_MODEL', 'gpt-4')
+    # Modelos configurables: para reducir latencia podemos usar un modelo más barato
+    # para la generación del borrador. Ajusta con la variable DRAFT_MODEL.
+    draft_model = os.getenv('DRAFT_MODEL', model_default)
+    formatter_model = os.getenv('FORMATTER_MODEL', model_default)
+    return model_default, draft_model, formatter_model
+
+
+def _route(risk: str, user_input: str, retrieved: list) -> RouteDecision:
+    """Modelos, max_tokens y pipeline de esta petición (sin MODEL_ROUTING=1: los del entorno)."""
+    model_default, draft_model, formatter_model = _models()
+    router = get_model_router()
+    if router is None:
+        return RouteDecision('default', pipeline_mode(), draft_model, formatter_model, 1000, 800,
+                             round(retrieval_confidence(retrieved), 4))
+    return router.select(risk, user_input, retrieved, model_default, draft_model, formatter_model, pipeline_mode())
+
+
+def _estimate_usage(decision: RouteDecision, user_input: str, context: str, risk: str, draft: str, final: str) -> dict:
+    """Tokens estimados por modelo, (entrada, salida), de las etapas de generación."""
+    def tokens(*texts: str) -> int:
+        return sum(count_tokens(t) for t in texts if t)
+
+    usage: dict = {}
+
+    def add(model: str, prompt_tokens: int, completion_tokens: int):
+        p, c = usage.get(model, (0, 0))
+        usage[model] = (p + prompt_tokens, c + completion_tokens)
+
+    if decision.pipeline == 'fused':
+        add(decision.formatter_model, tokens(*_fused_prompt(user_input, context, risk)), tokens(final))
+    else:
+        add(decision.draft_model, tokens(*_draft_prompt(user_input, context, risk)), tokens(draft))
+        add(decision.formatter_model, tokens(*_formatter_prompt(draft)), tokens(final))
+    return usage
+
+
+def _record_route(decision: RouteDecision, timings: dict, user_input: str, context: str, risk: str, draft: str, final: str):
+    router = get_model_router()
+    if router is not None:
+        router.record(decision, timings['total'], _estimate_usage(decision, user_input, context, risk, draft, final))
+
+
+def model_routing_stats() -> Optional[dict]:
+    router = get_model_router()
+    return router.stats() if router is not None else None
+
+
+def _cached_answer(user_input: str, use_cache: bool, flow_started: float) -> tuple:
+    """Devuelve (caché, embedding de la consulta, respuesta cacheada o None)."""
+    cache = get_answer_cache(_answer_cache_watched_files) if use_cache else None
+    if cache is None:
+        return None, None, None
+    # el embedding queda en la caché de embeddings y la recuperación lo reutiliza
+    query_vector = embed_query(user_input)
+    cached = cache.get(user_input, query_vector)
+    if cached is not None:
+        cached['cached'] = True
+        cached['timings'] = {'total': round(time.perf_counter() - flow_started, 4), 'critical_path': ['answer_cache']}
+    return cache, query_vector, cached
 
-    return {
+
+def _run_context_stages(user_input: str, call_model: Callable, model_default: str, timings: dict,
+                        log_risk: bool = True) -> tuple:
+    """Selector de riesgo y recuperación en paralelo: (risk, temperature, retrieved, context, context_report).
+
+    `log_risk=False` evita que la consulta acabe en el registro del selector (datos personales).
+    """
+    risk_future = _submit_stage('risk', run_risk_selector, user_input, call_model, model_default, log_risk,
+                                timings=timings)
+    retrieval_future = _submit_stage('retrieval', run_retrieval, user_input, timings=timings)
+    retrieved, context, context_report = _await_stage('retrieval', retrieval_future, ([], '', {}), timings)
+    risk = _await_stage('risk', risk_future, 'medio', timings)
+    return risk, RISK_TEMPERATURE_MAP.get(risk, 0.5), retrieved, context, context_report
+
+
+def _finish_timings(timings: dict, flow_started: float, pipeline: str) -> dict:
+    slowest_parallel = max(('risk', 'retrieval'), key=lambda name: timings.get(name, STAGE_TIMEOUTS[name]))
+    stages = ['fused'] if pipeline == 'fused' else ['draft', 'formatter']
+    timings['critical_path'] = [slowest_parallel, *stages]
+    timings['total'] = round(time.perf_counter() - flow_started, 4)
+    logger.info('Agent flow (%s): %.2fs (riesgo %.2fs | recuperación %.2fs, %s)', pipeline,
+                timings['total'], timings.get('risk', -1), timings.get('retrieval', -1),
+                ', '.join(f'{name} {timings.get(name, -1):.2f}s' for name in stages))
+    # copia: una etapa que venció su timeout aún puede escribir en `timings`
+    return dict(timings)
+
+
+def _store_answer(cache, user_input: str, result: dict, query_vector):
+    # no cachear respuestas de error: el siguiente intento debe volver a generar
+    generated = result['draft'] or result.get('pipeline') == 'fused'
+    if cache is not None and generated and result['final'] != FALLBACK_FINAL:
+        cache.put(user_input, result, query_vector)
+
+
+def run_agent_flow(user_input: str, run_risk_model: Optional[Callable] = None, use_cache: bool = True) -> dict:
+    """Orquesta el flujo de agentes y devuelve un dict con `risk`, `retrieved`, `draft`, `final`,
+    `pipeline`, `context` (informe de tokens del contexto) y `timings` (segundos por
+    etapa, total y camino crítico).
+
+    El selector de riesgo y la recuperación no dependen entre sí y se ejecutan en
+    paralelo. Después, según PIPELINE_MODE, se genera borrador + formateo
+    (`two_stage`, por defecto) o la respuesta final en una sola llamada (`fused`).
+    Cada etapa tiene su timeout (AGENT_*_TIMEOUT) y, si vence, el flujo sigue con
+    un valor por defecto.
+
+    Las consultas idénticas (normalizadas) que llegan mientras otra está en curso
+    esperan a esa ejecución y reciben una copia de su resultado con `coalesced=True`.
+
+    - run_risk_model: función opcional para ejecutar un modelo de riesgo (si aplica).
+    - use_cache: consultar/guardar en la caché semántica de respuestas y compartir
+      ejecuciones en curso. Desactívala cuando la consulta incluye datos personales
+      (p. ej. el perfil de la evaluación).
+    """
+    flow_started = time.perf_counter()
+
+    if _is_simple_greeting(user_input):
+        # Respuesta directa para saludos simples, sin flujo completo
+        return {'risk': 'bajo', 'retrieved': [], 'draft': '', 'final': GREETING_FINAL}
+
+    flight = get_single_flight() if use_cache else None
+    if flight is None:
+        return _run_agent_flow(user_input, use_cache, flow_started)
+    result, shared = flight.do(normalize_query(user_input), _run_agent_flow, user_input, use_cache, flow_started)
+    if shared:
+        result['coalesced'] = True
+    return result
+
+
+def _run_agent_flow(user_input: str, use_cache: bool, flow_started: float) -> dict:
+    call_model = get_call_model()
+    model_default = _models()[0]
+    cache, query_vector, cached = _cached_answer(user_input, use_cache, flow_started)
+    if cached is not None:
+        return cached
+
+    timings: dict = {}
+    risk, temperature, retrieved, context, context_report = _run_context_stages(
+        user_input, call_model, model_default, timings, log_risk=use_cache)
+    # con riesgo y recuperación ya resueltos, elegir modelos, max_tokens y pipeline
+    route = _route(risk, user_input, retrieved)
+    pipeline = route.pipeline
+    if pipeline == 'fused':
+        draft = ''
+        final = _run_stage('fused', run_fused_generator, user_input, context, risk, call_model, route.formatter_model,
+                           temperature, route.max_tokens, default=FALLBACK_FINAL, timings=timings)
+    else:
+        # Pasar el nivel de riesgo al draft generator para que adapte la respuesta
+        draft = _run_stage('draft', run_draft_generator, user_input, context, risk, call_model, route.draft_model,
+                           temperature, route.draft_max_tokens, default='', timings=timings)
+        final = _run_stage('formatter', run_formatter, draft, user_input, call_model, route.formatter_model,
+                           temperature, route.max_tokens, default=FALLBACK_FINAL, timings=timings)
+    final = _clean_final(final)
+    final = final + _disclaimer_for(final)
+
+    result = {
         'risk': risk,
         'retrieved': retrieved,
         'draft': draft,
         'final': final,
+        'pipeline': pipeline,
+        'route': route.as_dict(),
+        'context': context_report,
+        'timings': _finish_timings(timings, flow_started, pipeline),
+    }
+    _record_route(route, result['timings'], user_input, context, risk, draft, final)
+    _store_answer(cache, user_input, result, query_vector)
+    return result
+
+
+def _stream_with_fallback(prompt: Tuple[str, str], stream_model: Callable, model: str, temperature: float,
+                          fallback: Callable[[], str], max_tokens: int = 1000) -> Iterator[str]:
+    """Emite los fragmentos de `prompt` (system, user); si el streaming falla antes
+    del primer fragmento, emite de una vez el resultado de `fallback()`."""
+    system, user = prompt
+    emitted = False
+    try:
+        for token in stream_model(user, model=model, temperature=temperature, max_tokens=max_tokens, system=system):
+            emitted = True
+            yield token
+    except Exception:
+        if emitted:
+            logger.exception('El streaming se interrumpió')
+            return
+        logger.exception('Streaming failed; usando la llamada sin streaming')
+    if not emitted:
+        yield fallback()
+
+
+def run_formatter_stream(draft: str, user_input: str, stream_model: Callable, call_model: Callable,
+                         model_default: str, temperature: float, max_tokens: int = 1000) -> Iterator[str]:
+    """Versión en streaming de `run_formatter`: emite los fragmentos del texto final."""
+    return _stream_with_fallback(
+        _formatter_prompt(draft), stream_model, model_default, temperature,
+        lambda: run_formatter(draft, user_input, call_model, model_default, temperature, max_tokens), max_tokens,
+    )
+
+
+def run_fused_stream(user_input: str, context: str, risk: str, stream_model: Callable, call_model: Callable,
+                     model_default: str, temperature: float, max_tokens: int = 1000) -> Iterator[str]:
+    """Versión en streaming de `run_fused_generator`."""
+    return _stream_with_fallback(
+        _fused_prompt(user_input, context, risk), stream_model, model_default, temperature,
+        lambda: run_fused_generator(user_input, context, risk, call_model, model_default, temperature, max_tokens), max_tokens,
+    )
+
+
+def _replay(result: dict) -> Iterator[dict]:
+    """Eventos de una respuesta ya generada (caché o ejecución compartida)."""
+    yield {'type': 'meta', 'risk': result.get('risk'), 'retrieved_count': len(result.get('retrieved', []))}
+    yield {'type': 'token', 'text': result.get('final', '')}
+    yield {'type': 'done', **result}
+
+
+def run_agent_flow_stream(user_input: str, use_cache: bool = True) -> Iterator[dict]:
+    """Igual que `run_agent_flow`, pero emite eventos a medida que avanza el flujo:
+
+    - {'type': 'meta', 'risk', 'retrieved_count'} antes de la etapa que genera el texto final
+    - {'type': 'token', 'text'} por cada fragmento del texto final
+    - {'type': 'done', ...} con el mismo dict que devuelve `run_agent_flow`
+
+    `timings['first_token']` mide el tiempo hasta el primer fragmento. Si ya hay
+    una ejecución en curso de la misma consulta, se espera a ella y su respuesta
+    se emite de una vez.
+    """
+    flow_started = time.perf_counter()
+
+    if _is_simple_greeting(user_input):
+        yield {'type': 'token', 'text': GREETING_FINAL}
+        yield {'type': 'done', 'risk': 'bajo', 'retrieved': [], 'draft': '', 'final': GREETING_FINAL}
+        return
+
+    flight = get_single_flight() if use_cache else None
+    if flight is None:
+        yield from _run_agent_flow_stream(user_input, use_cache, flow_started)
+        return
+    key = normalize_query(user_input)
+    call, leader = flight.begin(key)
+    if not leader:
+        shared = flight.wait(call)
+        if shared is not None:
+            shared['coalesced'] = True
+            yield from _replay(shared)
+        else:
+            yield from _run_agent_flow_stream(user_input, use_cache, flow_started)
+        return
+    # si el cliente se desconecta antes de 'done', los seguidores ejecutan su propio flujo
+    result, error = None, None
+    try:
+        for event in _run_agent_flow_stream(user_input, use_cache, flow_started):
+            if event['type'] == 'done':
+                result = {k: v for k, v in event.items() if k != 'type'}
+            yield event
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        flight.finish(key, call, result, error)
+
+
+def _run_agent_flow_stream(user_input: str, use_cache: bool, flow_started: float) -> Iterator[dict]:
+    cache, query_vector, cached = _cached_answer(user_input, use_cache, flow_started)
+    if cached is not None:
+        yield from _replay(cached)
+        return
+
+    call_model = get_call_model()
+    stream_model = get_stream_model()
+    model_default = _models()[0]
+    timings: dict = {}
+    risk, temperature, retrieved, context, context_report = _run_context_stages(
+        user_input, call_model, model_default, timings, log_risk=use_cache)
+    route = _route(risk, user_input, retrieved)
+    pipeline = route.pipeline
+    if pipeline == 'fused':
+        draft = ''
+        final_stage = 'fused'
+        tokens = run_fused_stream(user_input, context, risk, stream_model, call_model, route.formatter_model,
+                                  temperature, route.max_tokens)
+    else:
+        draft = _run_stage('draft', run_draft_generator, user_input, context, risk, call_model, route.draft_model,
+                           temperature, route.draft_max_tokens, default='', timings=timings)
+        final_stage = 'formatter'
+        tokens = run_formatter_stream(draft, user_input, stream_model, call_model, route.formatter_model,
+                                      temperature, route.max_tokens)
+    yield {'type': 'meta', 'risk': risk, 'retrieved_count': len(retrieved)}
+
+    stage_started = time.perf_counter()
+    parts: List[str] = []
+    for token in _stream_stage(final_stage, tokens, timings):
+        if not parts:
+            timings['first_token'] = round(time.perf_counter() - flow_started, 4)
+        parts.append(token)
+        yield {'type': 'token', 'text': token}
+    timings[final_stage] = round(time.perf_counter() - stage_started, 4)
+
+    final = _clean_final(''.join(parts)) or FALLBACK_FINAL
+    disclaimer = _disclaimer_for(final)
+    if disclaimer:
+        yield {'type': 'token', 'text': disclaimer}
+
+    result = {
+        'risk': risk,
+        'retrieved': retrieved,
+        'draft': draft,
+        'final': final + disclaimer,
+        'pipeline': pipeline,
+        'route': route.as_dict(),
+        'context': context_report,
+        'timings': _finish_timings(timings, flow_started, pipeline),
     }
+    _record_route(route, result['timings'], user_input, context, risk, draft, final)
+    if final_stage not in result['timings'].get('timed_out', []):
+        # una respuesta cortada por el timeout no se cachea
+        _store_answer(cache, user_input, result, query_vector)
+    yield {'type': 'done', **result}
 
 
 if __name__ == '__main__':
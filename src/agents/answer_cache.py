@@ -0,0 +1,182 @@
+"""Caché semántica de respuestas para `run_agent_flow`.
+
+Las preguntas casi idénticas ("¿qué es la diabetes tipo 2?") se responden
+desde memoria si el embedding de la consulta supera un umbral de similitud
+con una pregunta ya respondida. Las entradas caducan por TTL, se expulsan por
+LRU y se invalidan en bloque cuando cambia el índice de conocimiento o las
+instrucciones de los agentes (`kb/agents/*.md`).
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+import copy
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    """Forma canónica de una consulta para coincidencias exactas."""
+    return ' '.join(query.lower().split()).strip(' ¿?¡!.')
+
+
+def files_fingerprint(paths: Iterable[Path]) -> Tuple:
+    """Huella barata (ruta, mtime, tamaño) de un conjunto de archivos."""
+    out = []
+    for p in sorted(paths):
+        try:
+            st = p.stat()
+            out.append((str(p), st.st_mtime_ns, st.st_size))
+        except OSError:
+            out.append((str(p), None, None))
+    return tuple(out)
+
+
+@dataclass
+class _Entry:
+    query: str
+    vector: Optional[np.ndarray]
+    result: dict
+    created: float
+
+
+class SemanticAnswerCache:
+    """Caché LRU con TTL indexada por texto normalizado y por embedding."""
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 3600.0, threshold: float = 0.95,
+                 fingerprint_fn: Optional[Callable[[], Tuple]] = None, fingerprint_interval: float = 2.0):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.threshold = threshold
+        self.fingerprint_fn = fingerprint_fn
+        self.fingerprint_interval = fingerprint_interval
+        self._entries: 'OrderedDict[str, _Entry]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._fingerprint = fingerprint_fn() if fingerprint_fn else None
+        self._fingerprint_checked = time.monotonic()
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_keys: list = []
+        self.metrics = {
+            'exact_hits': 0, 'semantic_hits': 0, 'misses': 0, 'stores': 0,
+            'evictions': 0, 'expirations': 0, 'invalidations': 0,
+        }
+
+    def _check_fingerprint(self):
+        if self.fingerprint_fn is None:
+            return
+        now = time.monotonic()
+        if now - self._fingerprint_checked < self.fingerprint_interval:
+            return
+        self._fingerprint_checked = now
+        fingerprint = self.fingerprint_fn()
+        if fingerprint != self._fingerprint:
+            if self._entries:
+                logger.info('Caché de respuestas invalidada: cambió el índice o las instrucciones de agentes')
+            self._fingerprint = fingerprint
+            self._entries.clear()
+            self._matrix = None
+            self.metrics['invalidations'] += 1
+
+    def _expire(self):
+        now = time.time()
+        expired = [k for k, e in self._entries.items() if now - e.created > self.ttl]
+        for k in expired:
+            del self._entries[k]
+        if expired:
+            self._matrix = None
+            self.metrics['expirations'] += len(expired)
+
+    def _semantic_match(self, vector: np.ndarray) -> Optional[str]:
+        if self._matrix is None:
+            self._matrix_keys = [k for k, e in self._entries.items() if e.vector is not None]
+            vectors = [self._entries[k].vector for k in self._matrix_keys]
+            self._matrix = np.stack(vectors) if vectors else np.zeros((0, vector.shape[0]), dtype=np.float32)
+        if not len(self._matrix_keys) or self._matrix.shape[1] != vector.shape[0]:
+            return None
+        scores = self._matrix @ vector
+        best = int(np.argmax(scores))
+        return self._matrix_keys[best] if scores[best] >= self.threshold else None
+
+    def get(self, query: str, vector: Optional[Sequence[float]] = None) -> Optional[dict]:
+        """Respuesta cacheada para `query` (exacta o semánticamente similar), o None."""
+        key = normalize_query(query)
+        qv = _unit(vector)
+        with self._lock:
+            self._check_fingerprint()
+            self._expire()
+            kind = 'exact_hits'
+            if key not in self._entries:
+                key = self._semantic_match(qv) if qv is not None else None
+                kind = 'semantic_hits'
+            if key is None:
+                self.metrics['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.metrics[kind] += 1
+            return copy.deepcopy(self._entries[key].result)
+
+    def put(self, query: str, result: dict, vector: Optional[Sequence[float]] = None):
+        key = normalize_query(query)
+        with self._lock:
+            self._check_fingerprint()
+            self._entries[key] = _Entry(query, _unit(vector), copy.deepcopy(result), time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.metrics['evictions'] += 1
+            self._matrix = None
+            self.metrics['stores'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.metrics['exact_hits'] + self.metrics['semantic_hits']
+            lookups = hits + self.metrics['misses']
+            return {
+                **self.metrics,
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hit_rate': hits / lookups if lookups else 0.0,
+            }
+
+
+def _unit(vector: Optional[Sequence[float]]) -> Optional[np.ndarray]:
+    if vector is None:
+        return None
+    v = np.asarray(vector, dtype=np.float32).ravel()
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm > 0 else None
+
+
+_CACHE: Optional[SemanticAnswerCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_answer_cache(watched_files: Callable[[], Iterable[Path]]) -> Optional[SemanticAnswerCache]:
+    """Caché del proceso configurada por entorno (None si ANSWER_CACHE=0).
+
+    `watched_files` devuelve los archivos cuyo cambio invalida la caché.
+    """
+    global _CACHE
+    if os.getenv('ANSWER_CACHE', '1') == '0':
+        return None
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = SemanticAnswerCache(
+                    max_entries=int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '512')),
+                    ttl_seconds=float(os.getenv('ANSWER_CACHE_TTL', '3600')),
+                    threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95')),
+                    fingerprint_fn=lambda: files_fingerprint(watched_files()),
+                )
+    return _CACHE
@@ -0,0 +1,199 @@
+"""Ensamblado del contexto recuperado dentro de un presupuesto de tokens.
+
+`run_retrieval` pide más candidatos de los que envía al modelo y este módulo
+decide cuáles entran: los ordena con MMR (relevancia menos redundancia con lo
+ya elegido), descarta los casi duplicados (fragmentos solapados o repetidos
+entre documentos), recorta cada uno en el último final de oración que cabe y
+se detiene al agotar el presupuesto. Cada ensamblado informa de los tokens
+ahorrados frente a concatenar los `top_k` fragmentos completos.
+"""
+from collections import Counter
+from dataclasses import asdict, dataclass
+import math
+import re
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+try:
+    from src.bm25 import tokenize
+    from src.agents.prompts import count_tokens
+except ImportError:
+    from bm25 import tokenize  # type: ignore
+    from prompts import count_tokens  # type: ignore
+
+CHUNK_SEPARATOR = '\n\n---\n\n'
+
+# fin de oración (., !, ?, …) seguido de espacio, o salto de línea (listas, encabezados)
+_SENTENCE_RE = re.compile(r'(?<=[.!?…])\s+|\n+')
+
+
+def format_chunk(chunk: dict, text: str = None) -> str:
+    return f"Source: {chunk.get('source')}\nScore: {chunk.get('score') or 0.0:.4f}\nText:\n{chunk.get('text') if text is None else text}"
+
+
+def _sentence_spans(text: str) -> List[Tuple[int, int]]:
+    spans, start = [], 0
+    for m in _SENTENCE_RE.finditer(text):
+        if text[start:m.start()].strip():
+            spans.append((start, m.start()))
+        start = m.end()
+    if text[start:].strip():
+        spans.append((start, len(text)))
+    return spans
+
+
+def trim_to_sentences(text: str, max_tokens: int, max_chars: int = 0, continuation: bool = False) -> str:
+    """Prefijo de `text` formado por oraciones completas que caben en `max_tokens` (y `max_chars`).
+
+    Si ni la primera oración cabe, se corta en el último espacio y se marca con '…'.
+    `continuation` indica que `text` no es el primer fragmento de su documento
+    (`chunk_id` > 0): sólo entonces se descarta una primera oración en minúscula,
+    que puede ser la cola de la oración cortada al fragmentar.
+    """
+    if count_tokens(text) <= max_tokens and (not max_chars or len(text) <= max_chars):
+        return text
+    spans = _sentence_spans(text)
+    if continuation and len(spans) > 1 and text[spans[0][0]:spans[0][0] + 1].islower():
+        spans = spans[1:]
+    if not spans:
+        return ''
+    first = spans[0][0]
+    end = None
+    for _, stop in spans:
+        if max_chars and stop - first > max_chars:
+            break
+        if count_tokens(text[first:stop]) > max_tokens:
+            break
+        end = stop
+    if end is not None:
+        return text[first:end]
+    limit = min(max_tokens * 4, max_chars or len(text))
+    cut = text[first:first + limit].rsplit(' ', 1)[0]
+    return cut + '…' if cut else ''
+
+
+def _term_vector(text: str) -> Tuple[Counter, float]:
+    counts = Counter(tokenize(text))
+    return counts, math.sqrt(sum(v * v for v in counts.values()))
+
+
+def _cosine(a: Tuple[Counter, float], b: Tuple[Counter, float]) -> float:
+    (ca, na), (cb, nb) = a, b
+    if not na or not nb:
+        return 0.0
+    if len(ca) > len(cb):
+        ca, cb = cb, ca
+    return sum(v * cb.get(t, 0) for t, v in ca.items()) / (na * nb)
+
+
+def mmr_order(chunks: Sequence[dict], k: int, lambda_: float = 0.7,
+              dedup_threshold: float = 0.85) -> Tuple[List[int], int]:
+    """Índices de hasta `k` fragmentos en orden MMR y número de casi duplicados descartados.
+
+    La relevancia es el `score` de la recuperación normalizado a [0, 1] y la
+    redundancia, el coseno de las bolsas de términos (vale igual para
+    resultados densos, BM25 o RRF, sin volver a calcular embeddings).
+    """
+    if not chunks:
+        return [], 0
+    scores = [float(c.get('score') or 0.0) for c in chunks]
+    lo, hi = min(scores), max(scores)
+    relevance = [(s - lo) / (hi - lo) if hi > lo else 1.0 for s in scores]
+    vectors = [_term_vector(c.get('text') or '') for c in chunks]
+    max_sim = [0.0] * len(chunks)
+    remaining = list(range(len(chunks)))
+    selected: List[int] = []
+    duplicates = 0
+    while remaining and len(selected) < k:
+        best = max(remaining, key=lambda i: lambda_ * relevance[i] - (1.0 - lambda_) * max_sim[i])
+        remaining.remove(best)
+        if max_sim[best] >= dedup_threshold:
+            duplicates += 1
+            continue
+        selected.append(best)
+        for i in remaining:
+            max_sim[i] = max(max_sim[i], _cosine(vectors[best], vectors[i]))
+    # los que quedan por encima del umbral también se habrían descartado
+    duplicates += sum(1 for i in remaining if max_sim[i] >= dedup_threshold)
+    return selected, duplicates
+
+
+@dataclass
+class ContextReport:
+    candidates: int = 0
+    selected: int = 0
+    duplicates: int = 0
+    trimmed: int = 0
+    budget: int = 0
+    tokens_raw: int = 0
+    tokens_used: int = 0
+    tokens_saved: int = 0
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def assemble_context(chunks: Sequence[dict], top_k: int, budget_tokens: int, max_chunk_chars: int = 0,
+                     lambda_: float = 0.7, dedup_threshold: float = 0.85) -> Tuple[List[dict], str, ContextReport]:
+    """Empaqueta los mejores `chunks` en `budget_tokens`: (seleccionados, contexto, informe).
+
+    `chunks` llega ordenado por relevancia. `tokens_raw` es lo que costaría el
+    contexto sin ensamblar (los `top_k` primeros completos).
+    """
+    report = ContextReport(candidates=len(chunks), budget=budget_tokens)
+    report.tokens_raw = count_tokens(CHUNK_SEPARATOR.join(format_chunk(c) for c in chunks[:top_k])) if chunks else 0
+    order, report.duplicates = mmr_order(chunks, top_k, lambda_, dedup_threshold)
+    separator_tokens = count_tokens(CHUNK_SEPARATOR)
+    selected: List[dict] = []
+    parts: List[str] = []
+    used = 0
+    for i in order:
+        chunk = chunks[i]
+        text = chunk.get('text') or ''
+        header_tokens = count_tokens(format_chunk(chunk, ''))
+        room = budget_tokens - used - header_tokens - (separator_tokens if parts else 0)
+        if room <= 0:
+            break
+        continuation = bool(chunk.get('chunk_id'))
+        trimmed = trim_to_sentences(text, room, max_chunk_chars, continuation)
+        # el recuento por partes es aproximado: se comprueba sobre el contexto unido
+        while trimmed:
+            overshoot = count_tokens(CHUNK_SEPARATOR.join(parts + [format_chunk(chunk, trimmed)])) - budget_tokens
+            if overshoot <= 0:
+                break
+            room -= overshoot
+            # el primer recorte ya quitó la oración incompleta
+            trimmed = trim_to_sentences(trimmed, room, max_chunk_chars) if room > 0 else ''
+        if not trimmed:
+            continue
+        if trimmed != text:
+            report.trimmed += 1
+        chunk = dict(chunk, text=trimmed)
+        parts.append(format_chunk(chunk))
+        selected.append(chunk)
+        used = count_tokens(CHUNK_SEPARATOR.join(parts))
+    context = CHUNK_SEPARATOR.join(parts)
+    report.selected = len(selected)
+    report.tokens_used = count_tokens(context) if context else 0
+    report.tokens_saved = max(report.tokens_raw - report.tokens_used, 0)
+    _record(report)
+    return selected, context, report
+
+
+_TOTALS: Dict[str, int] = {'requests': 0, 'duplicates': 0, 'trimmed': 0, 'tokens_raw': 0, 'tokens_used': 0, 'tokens_saved': 0}
+_TOTALS_LOCK = threading.Lock()
+
+
+def _record(report: ContextReport):
+    with _TOTALS_LOCK:
+        _TOTALS['requests'] += 1
+        for key in ('duplicates', 'trimmed', 'tokens_raw', 'tokens_used', 'tokens_saved'):
+            _TOTALS[key] += getattr(report, key)
+
+
+def context_stats() -> dict:
+    """Totales del proceso: tokens de contexto enviados y ahorrados, duplicados y recortes."""
+    with _TOTALS_LOCK:
+        out = dict(_TOTALS)
+    out['saved_ratio'] = round(out['tokens_saved'] / out['tokens_raw'], 4) if out['tokens_raw'] else 0.0
+    return out
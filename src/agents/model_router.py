@@ -0,0 +1,219 @@
+"""Enrutado de modelos por petición según riesgo, longitud de la consulta y confianza de la recuperación.
+
+Tras el selector de riesgo y la recuperación, `ModelRouter.select` elige una
+ruta: modelo del borrador y del texto final, `max_tokens` y profundidad del
+pipeline (`two_stage` o `fused`). Las políticas son una lista ordenada de
+rutas con condiciones; gana la primera que se cumple y la última suele ser la
+ruta por defecto, sin condiciones. Se activa con MODEL_ROUTING=1.
+
+Políticas (JSON en MODEL_ROUTES o en el archivo MODEL_ROUTES_PATH):
+
+    [{"name": "simple", "when": {"risk": ["bajo"], "max_query_chars": 120,
+                                 "min_retrieval_confidence": 0.5},
+      "model": "gpt-4o-mini", "pipeline": "fused", "max_tokens": 500},
+     {"name": "default"}]
+
+Condiciones: `risk`, `min_query_chars`, `max_query_chars`,
+`min_retrieval_confidence`, `max_retrieval_confidence`. Campos de la ruta:
+`model` (ambas etapas), `draft_model`, `formatter_model`, `pipeline`,
+`max_tokens` (texto final) y `draft_max_tokens`; los que faltan toman
+LLM_MODEL / DRAFT_MODEL / FORMATTER_MODEL / PIPELINE_MODE.
+
+Cada ruta acumula peticiones, latencia y tokens estimados por modelo. Con
+precios en MODEL_PRICES (`{"gpt-4": [0.03, 0.06]}`, USD por 1K tokens de
+entrada y de salida) se calcula también el coste.
+"""
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+import json
+import logging
+import math
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+PIPELINES = ('two_stage', 'fused')
+
+
+@dataclass
+class Route:
+    name: str
+    when: Dict = field(default_factory=dict)
+    model: Optional[str] = None
+    draft_model: Optional[str] = None
+    formatter_model: Optional[str] = None
+    pipeline: Optional[str] = None
+    max_tokens: int = 1000
+    draft_max_tokens: int = 800
+
+    def matches(self, risk: str, query_chars: int, confidence: float) -> bool:
+        w = self.when
+        if 'risk' in w and risk not in w['risk']:
+            return False
+        if query_chars < w.get('min_query_chars', 0) or query_chars > w.get('max_query_chars', math.inf):
+            return False
+        return w.get('min_retrieval_confidence', -math.inf) <= confidence <= w.get('max_retrieval_confidence', math.inf)
+
+
+@dataclass
+class RouteDecision:
+    """Ruta resuelta para una petición, con los valores por defecto del entorno ya aplicados."""
+    route: str
+    pipeline: str
+    draft_model: str
+    formatter_model: str
+    max_tokens: int
+    draft_max_tokens: int
+    confidence: float
+
+    def as_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+def retrieval_confidence(retrieved: Sequence[dict]) -> float:
+    """Confianza en [0, 1] del mejor fragmento recuperado (0 sin contexto).
+
+    Usa el coseno denso cuando existe. Para resultados sólo BM25, cuya escala no
+    está acotada, aproxima con s / (s + 5).
+    """
+    best = 0.0
+    for r in retrieved:
+        dense = r.get('dense_score')
+        if dense is None and r.get('lexical_score') is None:
+            dense = r.get('score')  # búsqueda sólo densa: `score` es el coseno
+        if dense is not None:
+            value = float(dense)
+        else:
+            lexical = max(float(r.get('lexical_score') or 0.0), 0.0)
+            value = lexical / (lexical + 5.0)
+        best = max(best, min(max(value, 0.0), 1.0))
+    return best
+
+
+def default_routes() -> List[Route]:
+    """Consultas simples de riesgo bajo con buen contexto: modelo ligero y 500 tokens.
+    Riesgo alto y resto: configuración del entorno. Ninguna fija el pipeline (PIPELINE_MODE).
+
+    El modelo ligero es ROUTER_LIGHT_MODEL o, si no se define, DRAFT_MODEL; sin ninguno
+    de los dos, la ruta `simple` usa el modelo configurado (nunca uno no elegido)."""
+    light = os.getenv('ROUTER_LIGHT_MODEL') or os.getenv('DRAFT_MODEL') or None
+    return [
+        Route('high_risk', when={'risk': ['alto']}, max_tokens=1000),
+        Route('simple', when={'risk': ['bajo'], 'max_query_chars': int(os.getenv('ROUTER_SIMPLE_MAX_CHARS', '120')),
+                              'min_retrieval_confidence': float(os.getenv('ROUTER_SIMPLE_MIN_CONFIDENCE', '0.5'))},
+              model=light, max_tokens=500),
+        Route('default'),
+    ]
+
+
+def load_routes(raw: str) -> List[Route]:
+    routes = []
+    for spec in json.loads(raw):
+        route = Route(**spec)
+        if route.pipeline is not None and route.pipeline not in PIPELINES:
+            raise ValueError(f"Ruta {route.name}: pipeline desconocido {route.pipeline!r}")
+        routes.append(route)
+    if not routes:
+        raise ValueError('MODEL_ROUTES no define ninguna ruta')
+    return routes
+
+
+class ModelRouter:
+    def __init__(self, routes: List[Route], prices: Optional[Dict[str, Tuple[float, float]]] = None, window: int = 1000):
+        self.routes = routes
+        self.prices = prices or {}
+        self.window = window
+        self._lock = threading.Lock()
+        self._stats: Dict[str, dict] = {}
+
+    def select(self, risk: str, user_input: str, retrieved: Sequence[dict], model_default: str,
+               draft_model: str, formatter_model: str, pipeline: str) -> RouteDecision:
+        """Primera ruta cuyas condiciones se cumplen; los campos vacíos toman los valores recibidos."""
+        confidence = retrieval_confidence(retrieved)
+        route = next((r for r in self.routes if r.matches(risk, len(user_input), confidence)), None)
+        if route is None:
+            route = Route('default')
+        return RouteDecision(
+            route=route.name,
+            pipeline=route.pipeline or pipeline,
+            draft_model=route.draft_model or route.model or draft_model or model_default,
+            formatter_model=route.formatter_model or route.model or formatter_model or model_default,
+            max_tokens=route.max_tokens,
+            draft_max_tokens=route.draft_max_tokens,
+            confidence=round(confidence, 4),
+        )
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        price_in, price_out = self.prices.get(model, (0.0, 0.0))
+        return (prompt_tokens * price_in + completion_tokens * price_out) / 1000.0
+
+    def record(self, decision: RouteDecision, latency: float, usage: Dict[str, Tuple[int, int]]):
+        """Acumula latencia y tokens (modelo -> (entrada, salida)) de una petición de la ruta."""
+        with self._lock:
+            s = self._stats.setdefault(decision.route, {
+                'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0,
+                'models': {}, 'latencies': deque(maxlen=self.window),
+            })
+            s['requests'] += 1
+            s['latencies'].append(latency)
+            for model, (prompt_tokens, completion_tokens) in usage.items():
+                s['prompt_tokens'] += prompt_tokens
+                s['completion_tokens'] += completion_tokens
+                s['cost'] += self.cost(model, prompt_tokens, completion_tokens)
+                s['models'][model] = s['models'].get(model, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = {}
+            for name, s in self._stats.items():
+                entry = {k: v for k, v in s.items() if k != 'latencies'}
+                entry['models'] = dict(s['models'])
+                entry['cost'] = round(s['cost'], 6)
+                entry['cost_per_request'] = round(s['cost'] / s['requests'], 6)
+                values = sorted(s['latencies'])
+                entry['latency_p50'] = round(values[len(values) // 2], 4)
+                entry['latency_p95'] = round(values[min(len(values) - 1, int(len(values) * 0.95))], 4)
+                out[name] = entry
+            return {'routes': [r.name for r in self.routes], 'by_route': out}
+
+
+_ROUTER: Optional[ModelRouter] = None
+_ROUTER_LOCK = threading.Lock()
+
+
+def _load_prices() -> Dict[str, Tuple[float, float]]:
+    raw = os.getenv('MODEL_PRICES')
+    if not raw:
+        return {}
+    try:
+        return {model: (float(p[0]), float(p[1])) for model, p in json.loads(raw).items()}
+    except (ValueError, TypeError, IndexError):
+        logger.exception('MODEL_PRICES inválido; el coste se contabiliza como 0')
+        return {}
+
+
+def get_model_router() -> Optional[ModelRouter]:
+    """Router del proceso si MODEL_ROUTING=1; None por defecto (un solo modelo para todo).
+
+    Si MODEL_ROUTES / MODEL_ROUTES_PATH no son válidos se usan las rutas por defecto.
+    """
+    global _ROUTER
+    if os.getenv('MODEL_ROUTING', '0') != '1':
+        return None
+    if _ROUTER is None:
+        with _ROUTER_LOCK:
+            if _ROUTER is None:
+                routes = None
+                path = os.getenv('MODEL_ROUTES_PATH')
+                raw = Path(path).read_text(encoding='utf-8') if path and Path(path).exists() else os.getenv('MODEL_ROUTES')
+                if raw:
+                    try:
+                        routes = load_routes(raw)
+                    except (ValueError, TypeError):
+                        logger.exception('Políticas de enrutado inválidas; usando las rutas por defecto')
+                _ROUTER = ModelRouter(routes or default_routes(), _load_prices())
+                logger.info('Rutas de modelos: %s', ', '.join(r.name for r in _ROUTER.routes))
+    return _ROUTER
@@ -1,73 +1,472 @@
+"""Cliente LLM compartido por el proceso.
+
+Un único `AsyncOpenAI` vive en un event loop propio (hilo de fondo), con un
+pool de conexiones keep-alive. Los hilos del flujo de agentes lo usan mediante
+`complete`/`stream` y los endpoints async con `acomplete`. Todas las llamadas
+comparten:
+
+- concurrencia acotada (LLM_MAX_CONCURRENCY)
+- reintentos explícitos con backoff exponencial y jitter para 408/409/429/5xx
+  y errores de conexión (LLM_MAX_RETRIES), respetando `Retry-After`
+- un circuit breaker: tras LLM_BREAKER_FAILURES fallos seguidos las llamadas
+  fallan de inmediato durante LLM_BREAKER_RESET segundos
+- un plazo total para las llamadas bloqueantes (`LLMClient.call_deadline`)
+- métricas por modelo: latencia, tokens, reintentos y errores (`llm_stats`)
+
+OPENAI_BASE_URL permite apuntarlo a un servidor compatible (p. ej.
+benchmarks/fake_openai_server.py).
+"""
+import asyncio
+import concurrent.futures
 import os
 import logging
-from typing import Optional, Callable
+import queue
+import random
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Iterator, Optional
 
 logger = logging.getLogger(__name__)
 
-def _call_model_modern(prompt: str, model: str, temperature: float, max_tokens: Optional[int] = None) -> str:
-    from openai import OpenAI
-    client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-    try:
-        kwargs = {"model": model, "messages": [{"role": "user", "content": prompt}]}
+RETRYABLE_STATUS = {408, 409, 429}
+# Modelos de razonamiento que rechazan el parámetro `temperature`
+NO_TEMPERATURE_PREFIXES = ('o1', 'o3', 'o4', 'gpt-5')
+
+
+class CircuitOpenError(RuntimeError):
+    """El circuit breaker está abierto: el backend del LLM se considera caído."""
+
+
+class CircuitBreaker:
+    """Breaker de tres estados (cerrado, abierto, semiabierto) por fallos consecutivos."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            return 'half_open' if time.monotonic() - self._opened_at >= self.reset_timeout else 'open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            # semiabierto: deja pasar una única llamada de prueba
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning('Circuit breaker del LLM abierto tras %d fallos seguidos', self._failures)
+                self._opened_at = time.monotonic()
+
+
+class LLMMetrics:
+    """Contadores y latencias recientes por modelo."""
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._models: Dict[str, dict] = {}
+
+    def _model(self, model: str) -> dict:
+        if model not in self._models:
+            self._models[model] = {
+                'calls': 0, 'errors': 0, 'retries': 0, 'rejected': 0,
+                'prompt_tokens': 0, 'cached_prompt_tokens': 0, 'completion_tokens': 0,
+                'latencies': deque(maxlen=self.window), 'first_token': deque(maxlen=self.window),
+            }
+        return self._models[model]
+
+    def record_call(self, model: str, latency: float, prompt_tokens: int, completion_tokens: int,
+                    first_token: Optional[float] = None, cached_tokens: int = 0):
+        with self._lock:
+            m = self._model(model)
+            m['calls'] += 1
+            m['prompt_tokens'] += prompt_tokens
+            m['cached_prompt_tokens'] += cached_tokens
+            m['completion_tokens'] += completion_tokens
+            m['latencies'].append(latency)
+            if first_token is not None:
+                m['first_token'].append(first_token)
+
+    def incr(self, model: str, name: str):
+        with self._lock:
+            self._model(model)[name] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = {}
+            for model, m in self._models.items():
+                entry = {k: v for k, v in m.items() if not isinstance(v, deque)}
+                for name in ('latencies', 'first_token'):
+                    values = sorted(m[name])
+                    if values:
+                        prefix = 'latency' if name == 'latencies' else 'first_token'
+                        entry[f'{prefix}_p50'] = round(values[len(values) // 2], 4)
+                        entry[f'{prefix}_p95'] = round(values[min(len(values) - 1, int(len(values) * 0.95))], 4)
+                out[model] = entry
+            return out
+
+
+def _supports_temperature(model: str) -> bool:
+    mode = os.getenv('LLM_SEND_TEMPERATURE', 'auto')
+    if mode in ('0', '1'):
+        return mode == '1'
+    return not model.startswith(NO_TEMPERATURE_PREFIXES)
+
+
+def _messages(prompt: str, system: Optional[str] = None) -> list:
+    """Mensajes de chat: `system` es el prefijo estable (instrucciones) y `prompt` la parte variable."""
+    messages = [{"role": "system", "content": system}] if system else []
+    return messages + [{"role": "user", "content": prompt}]
+
+
+def _cached_tokens(usage) -> int:
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return getattr(details, 'cached_tokens', 0) or 0
+
+
+def _is_retryable(error: Exception) -> bool:
+    import openai
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+class LLMClient:
+    """Cliente async único con pool keep-alive, concurrencia acotada, reintentos y breaker."""
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None,
+                 max_concurrency: int = 8, max_connections: int = 20, timeout: float = 60.0,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_connections = max(self.max_concurrency, max_connections)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = LLMMetrics()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._start_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'LLMClient':
+        return cls(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            base_url=os.getenv('OPENAI_BASE_URL') or None,
+            max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', '8')),
+            max_connections=int(os.getenv('LLM_MAX_CONNECTIONS', '20')),
+            timeout=float(os.getenv('LLM_TIMEOUT', '60')),
+            max_retries=int(os.getenv('LLM_MAX_RETRIES', '3')),
+            breaker=CircuitBreaker(
+                failure_threshold=int(os.getenv('LLM_BREAKER_FAILURES', '5')),
+                reset_timeout=float(os.getenv('LLM_BREAKER_RESET', '30')),
+            ),
+        )
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        if self._loop is not None:
+            return self._loop
+        with self._start_lock:
+            if self._loop is None:
+                import httpx
+                from openai import AsyncOpenAI
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='llm-client', daemon=True).start()
+                http_client = httpx.AsyncClient(
+                    timeout=self.timeout,
+                    limits=httpx.Limits(max_connections=self.max_connections,
+                                        max_keepalive_connections=self.max_connections),
+                )
+                self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                           max_retries=0, http_client=http_client)
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._loop = loop
+        return self._loop
+
+    def _request_kwargs(self, prompt: str, model: str, temperature: float, max_tokens: Optional[int],
+                        system: Optional[str] = None) -> dict:
+        kwargs = {"model": model, "messages": _messages(prompt, system)}
         if max_tokens:
             kwargs["max_tokens"] = max_tokens
-        
-        try:
-            resp = client.chat.completions.create(**kwargs)
-        except Exception:
-            logger.debug('client.chat.completions.create failed without temperature, retrying with temperature', exc_info=True)
+        if _supports_temperature(model):
             kwargs["temperature"] = temperature
-            resp = client.chat.completions.create(**kwargs)
-
-        choices = getattr(resp, 'choices', None)
-        if choices:
-            c = choices[0]
-            if isinstance(c, dict):
-                return c.get('message', {}).get('content', '')
-            else:
-                return c.message.content
-    except Exception:
-        logger.exception('client.chat.completions.create failed')
-    return ''
-
-def _call_model_classic(prompt: str, model: str, temperature: float, max_tokens: Optional[int] = None) -> str:
+        return kwargs
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def _with_policies(self, model: str, attempt_fn):
+        """Ejecuta `attempt_fn()` bajo el semáforo, con reintentos y circuit breaker."""
+        if not self.breaker.allow():
+            self.metrics.incr(model, 'rejected')
+            raise CircuitOpenError('Circuit breaker del LLM abierto; se omite la llamada')
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    result = await attempt_fn()
+                self.breaker.record_success()
+                return result
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable(e):
+                    self.metrics.incr(model, 'errors')
+                    # sólo los fallos del backend (5xx, 429, red) cuentan para el breaker;
+                    # un 400 indica que el servidor responde
+                    if _is_retryable(getattr(e, 'error', e)):
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                    raise
+                delay = self._retry_delay(e, attempt)
+                self.metrics.incr(model, 'retries')
+                logger.warning('LLM %s: intento %d falló (%s); reintento en %.2fs', model, attempt + 1, e, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+                # otras llamadas pueden haber abierto el breaker mientras esperábamos
+                if self.breaker.state == 'open':
+                    self.metrics.incr(model, 'rejected')
+                    raise CircuitOpenError('Circuit breaker del LLM abierto; se cancelan los reintentos') from e
+
+    async def _complete(self, prompt: str, model: str, temperature: float, max_tokens: Optional[int],
+                        system: Optional[str] = None) -> str:
+        kwargs = self._request_kwargs(prompt, model, temperature, max_tokens, system)
+
+        async def attempt():
+            started = time.perf_counter()
+            resp = await self._client.chat.completions.create(**kwargs)
+            usage = getattr(resp, 'usage', None)
+            latency = time.perf_counter() - started
+            self.metrics.record_call(model, latency, getattr(usage, 'prompt_tokens', 0) or 0,
+                                     getattr(usage, 'completion_tokens', 0) or 0,
+                                     cached_tokens=_cached_tokens(usage))
+            logger.debug('LLM %s: %.2fs, usage=%s', model, latency, usage)
+            return (resp.choices[0].message.content or '') if resp.choices else ''
+
+        return await self._with_policies(model, attempt)
+
+    async def _stream(self, prompt: str, model: str, temperature: float, max_tokens: Optional[int],
+                      emit: Callable[[str], None], system: Optional[str] = None):
+        kwargs = self._request_kwargs(prompt, model, temperature, max_tokens, system)
+        kwargs["stream"] = True
+        if os.getenv('LLM_STREAM_USAGE', '1') == '1':
+            kwargs["stream_options"] = {"include_usage": True}
+        emitted = False
+
+        async def attempt():
+            nonlocal emitted
+            started = time.perf_counter()
+            first_token = None
+            usage = None
+            chunks = 0
+            try:
+                stream = await self._client.chat.completions.create(**kwargs)
+                async for chunk in stream:
+                    usage = getattr(chunk, 'usage', None) or usage
+                    if not chunk.choices:
+                        continue
+                    text = getattr(chunk.choices[0].delta, 'content', None)
+                    if text:
+                        if first_token is None:
+                            first_token = time.perf_counter() - started
+                        chunks += 1
+                        emitted = True
+                        emit(text)
+            except Exception as e:
+                # tras emitir texto ya no se puede reintentar sin duplicarlo
+                if emitted:
+                    raise _NoRetry(e) from e
+                raise
+            self.metrics.record_call(model, time.perf_counter() - started,
+                                     getattr(usage, 'prompt_tokens', 0) or 0,
+                                     getattr(usage, 'completion_tokens', 0) or chunks,
+                                     first_token=first_token, cached_tokens=_cached_tokens(usage))
+
+        try:
+            await self._with_policies(model, attempt)
+        except _NoRetry as e:
+            raise e.error
+
+    def _submit(self, coro):
+        loop = self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+
+    def call_deadline(self) -> float:
+        """Espera máxima de una llamada: todos los intentos con su timeout más los backoffs."""
+        return (self.max_retries + 1) * self.timeout + self.max_retries * self.backoff_max
+
+    def complete(self, prompt: str, model: str, temperature: float = 0.0, max_tokens: Optional[int] = None,
+                 system: Optional[str] = None) -> str:
+        """Llamada bloqueante (para hilos); comparte el cliente y las políticas del loop de fondo.
+
+        Lanza TimeoutError si la llamada supera `call_deadline()` (p. ej. esperando al semáforo).
+        """
+        future = self._submit(self._complete(prompt, model, temperature, max_tokens, system))
+        try:
+            return future.result(timeout=self.call_deadline())
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.metrics.incr(model, 'errors')
+            raise TimeoutError(f'La llamada al LLM {model} superó {self.call_deadline():.0f}s') from None
+
+    async def acomplete(self, prompt: str, model: str, temperature: float = 0.0, max_tokens: Optional[int] = None,
+                        system: Optional[str] = None) -> str:
+        """Llamada desde cualquier event loop (p. ej. un endpoint async de FastAPI)."""
+        return await asyncio.wrap_future(self._submit(self._complete(prompt, model, temperature, max_tokens, system)))
+
+    def stream(self, prompt: str, model: str, temperature: float = 0.0, max_tokens: Optional[int] = None,
+               system: Optional[str] = None) -> Iterator[str]:
+        """Generador bloqueante de fragmentos de texto a medida que llegan."""
+        chunks: 'queue.Queue' = queue.Queue()
+        done = object()
+        future = self._submit(self._stream(prompt, model, temperature, max_tokens, chunks.put, system))
+        future.add_done_callback(lambda _: chunks.put(done))
+        try:
+            while True:
+                item = chunks.get()
+                if item is done:
+                    break
+                yield item
+            future.result()
+        finally:
+            # si el consumidor abandona el stream (cliente desconectado), cancelar la petición
+            future.cancel()
+
+    def stats(self) -> dict:
+        return {
+            'circuit': self.breaker.state,
+            'max_concurrency': self.max_concurrency,
+            'models': self.metrics.stats(),
+        }
+
+
+class _NoRetry(Exception):
+    """Envuelve un error de streaming ocurrido tras emitir texto (no se puede reintentar)."""
+
+    def __init__(self, error: Exception):
+        super().__init__(str(error))
+        self.error = error
+
+
+_LLM_CLIENT: Optional[LLMClient] = None
+_LLM_CLIENT_LOCK = threading.Lock()
+
+
+def get_llm_client() -> LLMClient:
+    """Cliente LLM compartido por el proceso (un pool de conexiones, un breaker)."""
+    global _LLM_CLIENT
+    if _LLM_CLIENT is None:
+        with _LLM_CLIENT_LOCK:
+            if _LLM_CLIENT is None:
+                _LLM_CLIENT = LLMClient.from_env()
+    return _LLM_CLIENT
+
+
+def llm_stats() -> Optional[dict]:
+    """Métricas del cliente LLM, o None si aún no se ha creado."""
+    return _LLM_CLIENT.stats() if _LLM_CLIENT is not None else None
+
+
+def _call_model_classic(prompt: str, model: str, temperature: float, max_tokens: Optional[int] = None,
+                        system: Optional[str] = None) -> str:
     import openai
     openai.api_key = os.getenv('OPENAI_API_KEY')
-    kwargs = {"model": model, "messages": [{"role": "user", "content": prompt}]}
+    kwargs = {"model": model, "messages": _messages(prompt, system)}
     if max_tokens:
         kwargs["max_tokens"] = max_tokens
-    
-    try:
-        resp = openai.ChatCompletion.create(**kwargs)
-    except Exception:
-        logger.debug('openai.ChatCompletion.create failed without temperature, retrying with temperature', exc_info=True)
+    if _supports_temperature(model):
         kwargs["temperature"] = temperature
-        resp = openai.ChatCompletion.create(**kwargs)
+    resp = openai.ChatCompletion.create(**kwargs)
     return resp['choices'][0]['message']['content']
 
+
+def _has_modern_sdk() -> bool:
+    try:
+        from openai import AsyncOpenAI  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
 def get_call_model() -> Callable[[str, Optional[str], float, Optional[int]], str]:
-    """Construye y devuelve una función `call_model(prompt, model, temperature, max_tokens)`.
+    """Construye y devuelve una función `call_model(prompt, model, temperature, max_tokens, system)`.
+
+    `system` es el prefijo estable del prompt (instrucciones del agente); se envía
+    como mensaje de sistema para que el caché de prompts del proveedor lo reutilice.
 
-    La función detecta la librería `openai` instalada y utiliza la interfaz
-    disponible. Lanza RuntimeError si no se puede invocar la API o si falta la clave.
+    Usa el cliente compartido (`get_llm_client`) o, con la librería `openai`
+    clásica, `openai.ChatCompletion`. Lanza RuntimeError si falta la clave,
+    CircuitOpenError si el breaker está abierto, y propaga los errores de la
+    API una vez agotados los reintentos.
     """
 
-    def call_model(prompt: str, model: Optional[str] = None, temperature: float = 0.0, max_tokens: Optional[int] = None) -> str:
+    def call_model(prompt: str, model: Optional[str] = None, temperature: float = 0.0, max_tokens: Optional[int] = None,
+                   system: Optional[str] = None) -> str:
         model = model or os.getenv('LLM_MODEL', 'gpt-4')
-        key = os.getenv('OPENAI_API_KEY')
         logger.debug("call_model: model=%s prompt_len=%d max_tokens=%s", model, len(prompt), max_tokens)
-        if not key:
+        if not os.getenv('OPENAI_API_KEY'):
             raise RuntimeError('OPENAI_API_KEY no configurada - no es posible invocar el LLM')
+        if _has_modern_sdk():
+            return get_llm_client().complete(prompt, model, temperature, max_tokens, system)
+        return _call_model_classic(prompt, model, temperature, max_tokens, system)
 
-        try:
-            from openai import OpenAI
-            return _call_model_modern(prompt, model, temperature, max_tokens)
-        except ImportError:
-            try:
-                return _call_model_classic(prompt, model, temperature, max_tokens)
-            except Exception:
-                logger.exception('Fallback openai.ChatCompletion failed')
+    return call_model
 
-        raise RuntimeError('No fue posible invocar la API de OpenAI con la configuración actual')
 
-    return call_model
+def get_stream_model() -> Callable[..., Iterator[str]]:
+    """Como `get_call_model`, pero devuelve `stream_model(prompt, model, temperature, max_tokens, system)`,
+    un generador de fragmentos de texto a medida que el modelo los produce.
+
+    Con la librería `openai` clásica (sin streaming soportado aquí) se emite la
+    respuesta completa en un único fragmento.
+    """
+    call_model = get_call_model()
+
+    def stream_model(prompt: str, model: Optional[str] = None, temperature: float = 0.0, max_tokens: Optional[int] = None,
+                     system: Optional[str] = None) -> Iterator[str]:
+        model = model or os.getenv('LLM_MODEL', 'gpt-4')
+        if not os.getenv('OPENAI_API_KEY'):
+            raise RuntimeError('OPENAI_API_KEY no configurada - no es posible invocar el LLM')
+        if not _has_modern_sdk():
+            yield call_model(prompt, model=model, temperature=temperature, max_tokens=max_tokens, system=system)
+            return
+        yield from get_llm_client().stream(prompt, model, temperature, max_tokens, system)
+
+    return stream_model
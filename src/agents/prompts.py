@@ -0,0 +1,158 @@
+"""Registro de plantillas de prompts de los agentes (`kb/agents/*.md`).
+
+Las instrucciones se leen y compilan (sin bloques de código) una sola vez y se
+recargan cuando cambia el archivo. Los prompts se arman como prefijo estable
+(mensaje `system` con las instrucciones, idéntico entre peticiones) más sufijo
+variable (mensaje `user` con consulta y contexto). El prefijo estable hace posible
+que el caché de prompts del proveedor lo reutilice cuando el prompt es largo
+(≥1024 tokens); los aciertos reales aparecen en `cached_prompt_tokens`.
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Tamaño mínimo de prefijo que OpenAI cachea automáticamente
+PROVIDER_CACHE_MIN_TOKENS = 1024
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """Codificador de tiktoken, resuelto una vez; None si no está disponible (no se reintenta)."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception:
+        logger.info('tiktoken no disponible; se estiman ~4 caracteres por token')
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Tokens de `text` con tiktoken si está instalado; si no, ~4 caracteres por token."""
+    encoding = _get_encoding()
+    if encoding is not None:
+        try:
+            return len(encoding.encode(text))
+        except Exception:
+            pass
+    return max(1, len(text) // 4)
+
+
+def compile_template(text: str) -> str:
+    """Elimina los bloques de código (```) para no confundir los prompts."""
+    lines = []
+    skip = False
+    for ln in text.splitlines():
+        if ln.strip().startswith('```'):
+            skip = not skip
+            continue
+        if not skip:
+            lines.append(ln)
+    return '\n'.join(lines)
+
+
+@dataclass
+class PromptTemplate:
+    name: str
+    path: Path
+    mtime_ns: int
+    text: str
+    tokens: int
+    loaded_at: float
+
+
+class PromptRegistry:
+    """Plantillas compiladas de un directorio, con recarga en caliente por mtime."""
+
+    def __init__(self, directory: Path, reload_interval: float = 2.0):
+        self.directory = Path(directory)
+        self.reload_interval = reload_interval
+        self._templates: Dict[str, PromptTemplate] = {}
+        self._composed: Dict[Tuple, str] = {}
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self.reloads = 0
+        self._refresh(force=True)
+
+    def _refresh(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.reload_interval:
+            return
+        with self._lock:
+            if not force and now - self._checked_at < self.reload_interval:
+                return
+            self._checked_at = now
+            seen = set()
+            changed = False
+            for path in sorted(self.directory.glob('*.md')):
+                name = path.stem
+                seen.add(name)
+                try:
+                    mtime_ns = path.stat().st_mtime_ns
+                    current = self._templates.get(name)
+                    if current is not None and current.mtime_ns == mtime_ns:
+                        continue
+                    text = compile_template(path.read_text(encoding='utf-8'))
+                except OSError:
+                    logger.exception('No se pudo leer la plantilla %s', path)
+                    continue
+                if current is not None:
+                    self.reloads += 1
+                    logger.info('Plantilla de agente recargada: %s', name)
+                self._templates[name] = PromptTemplate(name, path, mtime_ns, text, count_tokens(text), time.time())
+                changed = True
+            for name in set(self._templates) - seen:
+                del self._templates[name]
+                changed = True
+            if changed:
+                self._composed.clear()
+
+    def get(self, name: str) -> str:
+        """Instrucciones compiladas de `name` (cadena vacía si no existe)."""
+        self._refresh()
+        template = self._templates.get(name)
+        return template.text if template is not None else ''
+
+    def compose(self, *parts: str) -> str:
+        """Prefijo estable: los textos `parts` unidos; se cachea hasta que alguna plantilla cambie."""
+        self._refresh()
+        composed = self._composed.get(parts)
+        if composed is None:
+            composed = '\n\n'.join(parts)
+            self._composed[parts] = composed
+        return composed
+
+    def stats(self) -> dict:
+        self._refresh()
+        return {
+            'reloads': self.reloads,
+            'templates': {
+                name: {
+                    'tokens': t.tokens,
+                    'chars': len(t.text),
+                    'provider_cacheable': t.tokens >= PROVIDER_CACHE_MIN_TOKENS,
+                    'loaded_at': t.loaded_at,
+                }
+                for name, t in sorted(self._templates.items())
+            },
+        }
+
+
+_REGISTRY: Optional[PromptRegistry] = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_prompt_registry(directory: Path) -> PromptRegistry:
+    """Registro del proceso para `directory` (PROMPT_RELOAD_INTERVAL: segundos entre comprobaciones)."""
+    global _REGISTRY
+    if _REGISTRY is None:
+        with _REGISTRY_LOCK:
+            if _REGISTRY is None:
+                _REGISTRY = PromptRegistry(directory, float(os.getenv('PROMPT_RELOAD_INTERVAL', '2')))
+    return _REGISTRY
@@ -0,0 +1,221 @@
+"""Clasificador local de riesgo (bajo/medio/alto) para el selector de riesgo.
+
+Regresión logística multinomial sobre n-gramas de palabras con hashing,
+entrenada con las decisiones del selector LLM registradas en
+`kb/db/risk_selector_log.jsonl`. Predecir cuesta unas decenas de
+microsegundos; `run_risk_selector` sólo llama al LLM cuando la confianza del
+modelo local no llega al umbral.
+
+Entrenamiento:
+    python src/agents/risk_classifier.py --log kb/db/risk_selector_log.jsonl
+Evaluación offline:
+    python benchmarks/risk_classifier_eval.py
+"""
+from pathlib import Path
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import zlib
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    from src.bm25 import tokenize
+except ImportError:
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    from bm25 import tokenize  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+LABELS = ('bajo', 'medio', 'alto')
+DB_DIR = Path(__file__).resolve().parent.parent.parent / 'kb' / 'db'
+DEFAULT_LOG_PATH = DB_DIR / 'risk_selector_log.jsonl'
+DEFAULT_MODEL_PATH = DB_DIR / 'risk_classifier.npz'
+
+
+def _bucket(feature: str, n_features: int) -> int:
+    return zlib.crc32(feature.encode('utf-8')) % n_features
+
+
+def featurize(text: str, n_features: int) -> np.ndarray:
+    """Índices (con repetición) de unigramas y bigramas de `text` en el espacio con hashing."""
+    tokens = tokenize(text)
+    feats = tokens + [f'{a}_{b}' for a, b in zip(tokens, tokens[1:])]
+    return np.fromiter((_bucket(f, n_features) for f in feats), dtype=np.int64, count=len(feats))
+
+
+class RiskClassifier:
+    """Regresión logística multinomial sobre features con hashing (bolsa de n-gramas)."""
+
+    def __init__(self, weights: np.ndarray, bias: np.ndarray, labels: Sequence[str] = LABELS):
+        self.weights = np.asarray(weights, dtype=np.float32)  # (n_features, n_labels)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.labels = tuple(labels)
+
+    @property
+    def n_features(self) -> int:
+        return self.weights.shape[0]
+
+    def predict_proba(self, text: str) -> np.ndarray:
+        idx = featurize(text, self.n_features)
+        logits = self.bias.copy()
+        if idx.size:
+            logits += self.weights[idx].sum(axis=0) / np.sqrt(idx.size)
+        logits -= logits.max()
+        exp = np.exp(logits)
+        return exp / exp.sum()
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """Devuelve (etiqueta, probabilidad de esa etiqueta)."""
+        proba = self.predict_proba(text)
+        best = int(np.argmax(proba))
+        return self.labels[best], float(proba[best])
+
+    @classmethod
+    def train(cls, texts: Sequence[str], labels: Sequence[str], n_features: int = 1 << 14,
+              epochs: int = 30, lr: float = 2.0, l2: float = 1e-4, batch_size: int = 64, seed: int = 0) -> 'RiskClassifier':
+        label_ids = np.array([LABELS.index(l) for l in labels], dtype=np.int64)
+        docs = [featurize(t, n_features) for t in texts]
+        weights = np.zeros((n_features, len(LABELS)), dtype=np.float32)
+        bias = np.zeros(len(LABELS), dtype=np.float32)
+        # pesos por clase inversos a su frecuencia: 'alto' suele ser minoritario
+        counts = np.bincount(label_ids, minlength=len(LABELS)).astype(np.float32)
+        class_weight = np.where(counts > 0, counts.sum() / (len(LABELS) * np.maximum(counts, 1)), 0.0)
+        rng = np.random.default_rng(seed)
+        for _ in range(epochs):
+            order = rng.permutation(len(docs))
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                logits = np.tile(bias, (len(batch), 1))
+                for row, i in enumerate(batch):
+                    if docs[i].size:
+                        logits[row] += weights[docs[i]].sum(axis=0) / np.sqrt(docs[i].size)
+                logits -= logits.max(axis=1, keepdims=True)
+                proba = np.exp(logits)
+                proba /= proba.sum(axis=1, keepdims=True)
+                grad = proba
+                grad[np.arange(len(batch)), label_ids[batch]] -= 1.0
+                grad *= class_weight[label_ids[batch], None] / len(batch)
+                bias -= lr * grad.sum(axis=0)
+                for row, i in enumerate(batch):
+                    if docs[i].size:
+                        np.add.at(weights, docs[i], -lr * grad[row] / np.sqrt(docs[i].size))
+            weights *= (1.0 - lr * l2)
+        return cls(weights, bias)
+
+    def save(self, path: Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(str(path), weights=self.weights, bias=self.bias, labels=np.array(self.labels, dtype=str))
+
+    @classmethod
+    def load(cls, path: Path) -> 'RiskClassifier':
+        data = np.load(str(path))
+        return cls(data['weights'], data['bias'], data['labels'].tolist())
+
+
+def _rotated(path: Path) -> Path:
+    return path.with_name(path.name + '.1')
+
+
+def load_labeled_log(path: Path = DEFAULT_LOG_PATH) -> Tuple[List[str], List[str]]:
+    """Lee el registro JSONL del selector (y su copia rotada `.1`); la última etiqueta de cada consulta prevalece."""
+    latest = {}
+    path = Path(path)
+    for part in (_rotated(path), path):
+        if not part.exists():
+            continue
+        with part.open(encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if rec.get('risk') in LABELS and rec.get('query'):
+                    latest[rec['query']] = rec['risk']
+    return list(latest), list(latest.values())
+
+
+_LOG_LOCK = threading.Lock()
+
+
+def log_selector_output(query: str, risk: str, path: Optional[Path] = None):
+    """Añade una decisión del selector LLM al registro de entrenamiento.
+
+    - RISK_SELECTOR_LOG: '1' lo activa (desactivado por defecto: guarda las consultas en claro)
+    - RISK_SELECTOR_LOG_PATH: archivo JSONL (por defecto kb/db/risk_selector_log.jsonl)
+    - RISK_SELECTOR_LOG_MAX_BYTES: al superarlo se rota a `.1`, que reemplaza a la copia anterior (5 MB)
+    """
+    if os.getenv('RISK_SELECTOR_LOG', '0') != '1':
+        return
+    path = Path(path or os.getenv('RISK_SELECTOR_LOG_PATH', str(DEFAULT_LOG_PATH)))
+    max_bytes = int(os.getenv('RISK_SELECTOR_LOG_MAX_BYTES', str(5 * 1024 * 1024)))
+    line = json.dumps({'query': query, 'risk': risk, 'ts': time.time()}, ensure_ascii=False) + '\n'
+    try:
+        with _LOG_LOCK:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if path.exists() and path.stat().st_size >= max_bytes:
+                os.replace(path, _rotated(path))
+            with path.open('a', encoding='utf-8') as f:
+                f.write(line)
+    except OSError:
+        logger.exception('No se pudo registrar la salida del selector de riesgo')
+
+
+_CLASSIFIER: Optional[RiskClassifier] = None
+_CLASSIFIER_MTIME: Optional[float] = None
+_CLASSIFIER_LOCK = threading.Lock()
+
+
+def get_risk_classifier() -> Optional[RiskClassifier]:
+    """Clasificador entrenado del proceso (se recarga si cambia el archivo), o None.
+
+    - RISK_CLASSIFIER: '0' lo desactiva
+    - RISK_CLASSIFIER_PATH: modelo .npz (por defecto kb/db/risk_classifier.npz)
+    """
+    global _CLASSIFIER, _CLASSIFIER_MTIME
+    if os.getenv('RISK_CLASSIFIER', '1') == '0':
+        return None
+    path = Path(os.getenv('RISK_CLASSIFIER_PATH', str(DEFAULT_MODEL_PATH)))
+    try:
+        mtime = path.stat().st_mtime
+    except OSError:
+        return None
+    if mtime != _CLASSIFIER_MTIME:
+        with _CLASSIFIER_LOCK:
+            if mtime != _CLASSIFIER_MTIME:
+                try:
+                    _CLASSIFIER = RiskClassifier.load(path)
+                    logger.info('Clasificador de riesgo local cargado desde %s', path)
+                except Exception:
+                    logger.exception('No se pudo cargar el clasificador de riesgo %s', path)
+                    _CLASSIFIER = None
+                _CLASSIFIER_MTIME = mtime
+    return _CLASSIFIER
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Entrena el clasificador local de riesgo con el registro del selector LLM')
+    parser.add_argument('--log', type=Path, default=DEFAULT_LOG_PATH)
+    parser.add_argument('--out', type=Path, default=DEFAULT_MODEL_PATH)
+    parser.add_argument('--features', type=int, default=1 << 14)
+    parser.add_argument('--epochs', type=int, default=30)
+    args = parser.parse_args()
+
+    texts, labels = load_labeled_log(args.log)
+    if len(texts) < 20:
+        print(f'Sólo hay {len(texts)} consultas etiquetadas en {args.log}; se necesitan al menos 20.')
+        sys.exit(1)
+    print(f'Entrenando con {len(texts)} consultas:', {l: labels.count(l) for l in LABELS})
+    model = RiskClassifier.train(texts, labels, n_features=args.features, epochs=args.epochs)
+    model.save(args.out)
+    print(f'Modelo guardado en {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Coalescencia de consultas idénticas en curso (single-flight).
+
+Cuando llegan a la vez muchas peticiones con el mismo mensaje (p. ej. desde un
+enlace de campaña), sólo la primera ejecuta el flujo de agentes; las demás
+esperan a que termine y reciben una copia de su resultado. La clave es la
+consulta normalizada (`normalize_query`). A diferencia de la caché de
+respuestas, aquí no se guarda nada: la entrada desaparece al terminar la
+ejecución.
+"""
+import copy
+import os
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Una ejecución por clave a la vez; las llamadas concurrentes comparten su resultado."""
+
+    def __init__(self, wait_timeout: Optional[float] = None):
+        self.wait_timeout = wait_timeout
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+        self.fallbacks = 0
+        self.max_waiters = 0
+
+    def begin(self, key: str) -> Tuple[_Call, bool]:
+        """Registra la ejecución de `key`: (llamada, True si esta petición debe ejecutarla)."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.followers += 1
+                self.max_waiters = max(self.max_waiters, call.waiters)
+                return call, False
+            call = self._calls[key] = _Call()
+            self.leaders += 1
+            return call, True
+
+    def finish(self, key: str, call: _Call, result: Any = None, error: Optional[BaseException] = None):
+        """Publica el resultado (o el error) del líder y libera la clave."""
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.result = result
+        call.error = error
+        call.done.set()
+
+    def wait(self, call: _Call) -> Optional[Any]:
+        """Copia del resultado del líder, o None si falló o no terminó a tiempo."""
+        if not call.done.wait(self.wait_timeout) or call.error is not None or call.result is None:
+            with self._lock:
+                self.fallbacks += 1
+            return None
+        return copy.deepcopy(call.result)
+
+    def do(self, key: str, fn: Callable, *args, **kwargs) -> Tuple[Any, bool]:
+        """Ejecuta `fn` o se une a la ejecución en curso de `key`: (resultado, compartido).
+
+        Si el líder falla o vence `wait_timeout`, el seguidor ejecuta `fn` por su cuenta.
+        """
+        call, leader = self.begin(key)
+        if not leader:
+            result = self.wait(call)
+            if result is not None:
+                return result, True
+            return fn(*args, **kwargs), False
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result)
+        return result, False
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.leaders + self.followers
+            # los seguidores que acabaron ejecutando su propio flujo no cuentan como coalescidos
+            coalesced = self.followers - self.fallbacks
+            return {
+                'requests': total,
+                'executions': total - coalesced,
+                'coalesced': coalesced,
+                'fallbacks': self.fallbacks,
+                'in_flight': len(self._calls),
+                'max_waiters': self.max_waiters,
+                'coalescing_ratio': round(coalesced / total, 4) if total else 0.0,
+            }
+
+
+_FLIGHT: Optional[SingleFlight] = None
+_FLIGHT_LOCK = threading.Lock()
+
+
+def get_single_flight() -> Optional[SingleFlight]:
+    """Coalescedor del proceso, o None si AGENT_COALESCE=0.
+
+    - AGENT_COALESCE_WAIT: segundos que un seguidor espera al líder antes de
+      ejecutar su propio flujo (por defecto 120)
+    """
+    global _FLIGHT
+    if os.getenv('AGENT_COALESCE', '1') == '0':
+        return None
+    if _FLIGHT is None:
+        with _FLIGHT_LOCK:
+            if _FLIGHT is None:
+                _FLIGHT = SingleFlight(float(os.getenv('AGENT_COALESCE_WAIT', '120')))
+    return _FLIGHT
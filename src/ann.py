@@ -0,0 +1,217 @@
+"""Índices de vecinos aproximados (ANN) para el retriever.
+
+Todos los índices trabajan sobre la matriz de embeddings ya normalizada del
+`VectorRetriever` (similitud coseno == producto interno) y exponen la misma
+interfaz: `build`, `save`, `load` y `search`. El parámetro `search_param`
+controla el compromiso recall/latencia de cada tipo (nprobe en IVF, ef en HNSW).
+"""
+from pathlib import Path
+import math
+import threading
+from typing import Optional, Tuple
+import numpy as np
+
+
+class IVFIndex:
+    """Índice invertido (IVF) con cuantizador grueso de k-means esférico.
+
+    Cada fragmento se asigna a su centroide más cercano; en búsqueda sólo se
+    puntúan las `nprobe` listas cuyos centroides son más similares a la query.
+    """
+    kind = 'ivf'
+    default_search_param = 16
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_ids: np.ndarray):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.list_ids = np.asarray(list_ids, dtype=np.int64)
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, nlist: Optional[int] = None, n_iter: int = 20, seed: int = 0) -> 'IVFIndex':
+        n = matrix.shape[0]
+        if n == 0:
+            raise ValueError('No se puede construir un índice IVF vacío')
+        nlist = nlist or max(1, int(4 * math.sqrt(n)))
+        nlist = min(nlist, n)
+        rng = np.random.default_rng(seed)
+        centroids = matrix[rng.choice(n, size=nlist, replace=False)].copy()
+        assign = np.zeros(n, dtype=np.int64)
+        for _ in range(n_iter):
+            assign = np.argmax(matrix @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = matrix[assign == c]
+                if len(members) == 0:
+                    # reubicar centroides vacíos en un punto aleatorio
+                    centroids[c] = matrix[rng.integers(n)]
+                    continue
+                mean = members.sum(axis=0)
+                norm = np.linalg.norm(mean)
+                centroids[c] = mean / norm if norm > 0 else mean
+        assign = np.argmax(matrix @ centroids.T, axis=1)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=nlist)
+        list_offsets = np.concatenate([[0], np.cumsum(counts)])
+        return cls(centroids, list_offsets, order)
+
+    def save(self, path: Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(str(path), centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids)
+
+    @classmethod
+    def load(cls, path: Path) -> 'IVFIndex':
+        data = np.load(str(path))
+        return cls(data['centroids'], data['list_offsets'], data['list_ids'])
+
+    def search(self, matrix: np.ndarray, query: np.ndarray, top_k: int, search_param: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        nprobe = min(search_param or self.default_search_param, self.nlist)
+        centroid_scores = self.centroids @ query
+        if nprobe < self.nlist:
+            probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        else:
+            probes = np.arange(self.nlist)
+        candidates = np.concatenate([
+            self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes
+        ])
+        if candidates.size == 0:
+            return candidates, np.zeros(0, dtype=np.float32)
+        scores = score_rows(matrix, query, candidates)
+        k = min(top_k, candidates.size)
+        if k < candidates.size:
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(candidates.size)
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return candidates[best], scores[best]
+
+
+class HNSWIndex:
+    """Grafo HNSW sobre `hnswlib` (dependencia opcional).
+
+    `ef` es estado del índice compartido entre hilos: `set_ef` y `knn_query` se
+    ejecutan bajo un mismo lock para que cada búsqueda use el suyo.
+    """
+    kind = 'hnsw'
+    default_search_param = 64
+
+    def __init__(self, index):
+        self.index = index
+        self._ef: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hnswlib():
+        try:
+            import hnswlib
+        except ImportError:
+            raise RuntimeError("Falta la dependencia 'hnswlib'. Instálala con: pip install hnswlib")
+        return hnswlib
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, M: int = 16, ef_construction: int = 200, seed: int = 0) -> 'HNSWIndex':
+        hnswlib = cls._hnswlib()
+        index = hnswlib.Index(space='ip', dim=matrix.shape[1])
+        index.init_index(max_elements=matrix.shape[0], M=M, ef_construction=ef_construction, random_seed=seed)
+        index.add_items(matrix, np.arange(matrix.shape[0]))
+        return cls(index)
+
+    def save(self, path: Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.index.save_index(str(path))
+
+    @classmethod
+    def load(cls, path: Path, dim: int) -> 'HNSWIndex':
+        hnswlib = cls._hnswlib()
+        index = hnswlib.Index(space='ip', dim=dim)
+        index.load_index(str(path))
+        return cls(index)
+
+    def search(self, matrix: np.ndarray, query: np.ndarray, top_k: int, search_param: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(top_k, self.index.get_current_count())
+        ef = max(search_param or self.default_search_param, k)
+        with self._lock:
+            if ef != self._ef:
+                self.index.set_ef(ef)
+                self._ef = ef
+            labels, distances = self.index.knn_query(query, k=k)
+        # hnswlib devuelve distancia 1 - <a, b> para el espacio 'ip'
+        return labels[0].astype(np.int64), (1.0 - distances[0]).astype(np.float32)
+
+
+ANN_INDEX_TYPES = {
+    IVFIndex.kind: IVFIndex,
+    HNSWIndex.kind: HNSWIndex,
+}
+
+_ANN_SUFFIXES = {
+    IVFIndex.kind: '.ivf.npz',
+    HNSWIndex.kind: '.hnsw.bin',
+}
+
+
+def ann_index_path(index_path: Path, kind: str, generation: Optional[str] = None) -> Path:
+    """Ruta del índice ANN persistido junto al índice principal (p. ej. index.<gen>.ivf.npz).
+
+    El índice ANN guarda posiciones de filas, así que se asocia a la generación
+    de datos del índice (ver `utils.index_layout`) para la que se construyó.
+    """
+    index_path = Path(index_path)
+    stem = index_path.name.split('.')[0]
+    prefix = f'{stem}.{generation}' if generation else stem
+    return index_path.with_name(prefix + _ANN_SUFFIXES[kind])
+
+
+def score_rows(matrix: np.ndarray, query: np.ndarray, rows: Optional[np.ndarray] = None, block_size: int = 16384) -> np.ndarray:
+    """Producto interno de `query` contra las filas de `matrix` (todas o `rows`).
+
+    Las matrices float32 se puntúan directamente (sin copiar un memmap); las
+    float16 se convierten a float32 por bloques para no duplicar el índice en RAM.
+    """
+    if rows is not None:
+        return matrix[rows].astype(np.float32, copy=False) @ query
+    if matrix.dtype == np.float32:
+        return matrix @ query
+    out = np.empty(matrix.shape[0], dtype=np.float32)
+    for start in range(0, matrix.shape[0], block_size):
+        block = matrix[start:start + block_size]
+        out[start:start + block.shape[0]] = block.astype(np.float32) @ query
+    return out
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+def build_ann_index(emb_arr: np.ndarray, index_path: Path, kind: str, generation: Optional[str] = None, **params) -> Path:
+    """Construye y persiste un índice ANN de tipo `kind` a partir de los embeddings."""
+    if kind not in ANN_INDEX_TYPES:
+        raise ValueError(f"Tipo de índice ANN desconocido: {kind}. Opciones: {', '.join(ANN_INDEX_TYPES)}")
+    ann = ANN_INDEX_TYPES[kind].build(normalize_rows(emb_arr), **params)
+    path = ann_index_path(index_path, kind, generation)
+    ann.save(path)
+    return path
+
+
+def load_ann_index(index_path: Path, kind: str, dim: int, generation: Optional[str] = None):
+    """Carga el índice ANN de tipo `kind` asociado a `index_path`, o None si no existe."""
+    if kind not in ANN_INDEX_TYPES:
+        raise ValueError(f"Tipo de índice ANN desconocido: {kind}. Opciones: {', '.join(ANN_INDEX_TYPES)}")
+    path = ann_index_path(index_path, kind, generation)
+    if not path.exists():
+        return None
+    if kind == HNSWIndex.kind:
+        return HNSWIndex.load(path, dim)
+    return ANN_INDEX_TYPES[kind].load(path)
+
+
+def existing_ann_kinds(index_path: Path, generation: Optional[str] = None) -> list:
+    """Tipos de índice ANN ya construidos para esa generación del índice."""
+    return [kind for kind in ANN_INDEX_TYPES if ann_index_path(index_path, kind, generation).exists()]
@@ -0,0 +1,126 @@
+"""Índice invertido BM25 para la recuperación léxica.
+
+Complementa al índice denso en consultas con nombres de fármacos, valores de
+laboratorio y siglas (HbA1c, MET, IMC) y permite responder sin llamar al
+backend de embeddings. Los pesos BM25 de cada posting se precalculan al
+construir el índice, así que una consulta se resuelve sumando pesos.
+"""
+from pathlib import Path
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+(?:[.,][0-9]+)*')
+
+STOPWORDS = frozenset("""
+a al algo algunas algunos ante antes como con contra cual cuando de del desde donde durante e el
+ella ellas ellos en entre era es esa esas ese eso esos esta estas este esto estos fue ha han hay
+la las le les lo los mas me mi mis mucho muy ni no nos o otra otro para pero poco por porque que
+quien se sea ser si sin sobre son su sus tambien te tiene tu tus un una uno unos y ya yo
+the of and to in is for on with as by an be are or at from this that
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Minúsculas, sin tildes, conservando siglas alfanuméricas y decimales (hba1c, 6.5)."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return [t for t in _TOKEN_RE.findall(text) if t not in STOPWORDS]
+
+
+class BM25Index:
+    """Postings en formato CSR: término -> (documentos, peso BM25 precalculado)."""
+
+    def __init__(self, terms: List[str], post_offsets: np.ndarray, post_docs: np.ndarray,
+                 post_weights: np.ndarray, n_docs: int):
+        self.vocab = {t: i for i, t in enumerate(terms)}
+        self.terms = terms
+        self.post_offsets = np.asarray(post_offsets, dtype=np.int64)
+        self.post_docs = np.asarray(post_docs, dtype=np.int32)
+        self.post_weights = np.asarray(post_weights, dtype=np.float32)
+        self.n_docs = n_docs
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    @classmethod
+    def build(cls, texts: Iterable[str], k1: float = 1.5, b: float = 0.75) -> 'BM25Index':
+        postings = {}
+        doc_lens = []
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lens.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_id, tf))
+        n_docs = len(doc_lens)
+        doc_lens = np.asarray(doc_lens, dtype=np.float32)
+        avgdl = float(doc_lens.mean()) if n_docs and doc_lens.mean() > 0 else 1.0
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        docs_parts, weight_parts = [], []
+        for i, term in enumerate(terms):
+            plist = postings[term]
+            docs = np.fromiter((d for d, _ in plist), dtype=np.int32, count=len(plist))
+            tf = np.fromiter((f for _, f in plist), dtype=np.float32, count=len(plist))
+            idf = math.log(1.0 + (n_docs - len(plist) + 0.5) / (len(plist) + 0.5))
+            norm = k1 * (1.0 - b + b * doc_lens[docs] / avgdl)
+            docs_parts.append(docs)
+            weight_parts.append((idf * tf * (k1 + 1.0) / (tf + norm)).astype(np.float32))
+            offsets[i + 1] = offsets[i] + len(plist)
+        post_docs = np.concatenate(docs_parts) if docs_parts else np.zeros(0, dtype=np.int32)
+        post_weights = np.concatenate(weight_parts) if weight_parts else np.zeros(0, dtype=np.float32)
+        return cls(terms, offsets, post_docs, post_weights, n_docs)
+
+    def search(self, query: str, top_k: int = 5) -> List[Tuple[int, float]]:
+        """Devuelve [(posición, score BM25)] de los `top_k` fragmentos con mayor puntuación."""
+        term_ids = [self.vocab[t] for t in set(tokenize(query)) if t in self.vocab]
+        if not term_ids or top_k <= 0:
+            return []
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for t in term_ids:
+            start, end = self.post_offsets[t], self.post_offsets[t + 1]
+            np.add.at(scores, self.post_docs[start:end], self.post_weights[start:end])
+        candidates = np.flatnonzero(scores)
+        k = min(top_k, candidates.size)
+        if k < candidates.size:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(int(i), float(scores[i])) for i in candidates]
+
+    def save(self, path: Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(str(path), terms=np.array(self.terms, dtype=str), post_offsets=self.post_offsets,
+                 post_docs=self.post_docs, post_weights=self.post_weights, n_docs=np.int64(self.n_docs))
+
+    @classmethod
+    def load(cls, path: Path) -> 'BM25Index':
+        data = np.load(str(path))
+        return cls(data['terms'].tolist(), data['post_offsets'], data['post_docs'],
+                   data['post_weights'], int(data['n_docs']))
+
+
+def bm25_index_path(index_path: Path, generation: Optional[str] = None) -> Path:
+    """Ruta del índice BM25 asociado a una generación del índice (index.<gen>.bm25.npz)."""
+    index_path = Path(index_path)
+    stem = index_path.name.split('.')[0]
+    prefix = f'{stem}.{generation}' if generation else stem
+    return index_path.with_name(prefix + '.bm25.npz')
+
+
+def load_bm25_index(index_path: Path, generation: Optional[str] = None) -> Optional[BM25Index]:
+    path = bm25_index_path(index_path, generation)
+    return BM25Index.load(path) if path.exists() else None
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """Fusiona listas ordenadas de posiciones con RRF: score = sum(1 / (k + rango))."""
+    fused = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            fused[doc] = fused.get(doc, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
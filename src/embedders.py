@@ -0,0 +1,289 @@
+"""Backends de embeddings usados por `utils.embed_texts`."""
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Límites por petición de la API de embeddings de OpenAI
+OPENAI_MAX_INPUTS_PER_REQUEST = 2048
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación barata de tokens (~4 caracteres por token en textos latinos)."""
+    return max(1, len(text) // 4)
+
+
+def pack_batches(texts: Sequence[str], max_tokens: int, max_items: int) -> List[List[int]]:
+    """Agrupa los índices de `texts` en lotes consecutivos que respetan el
+    presupuesto de tokens y el número máximo de entradas por petición."""
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_items):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+class OpenAIBatchEmbedder:
+    """Embeddings de OpenAI en lotes concurrentes con reintentos.
+
+    - Empaqueta los textos en lotes por presupuesto de tokens (`max_batch_tokens`).
+    - Mantiene hasta `concurrency` peticiones en vuelo con un único cliente
+      (y pool de conexiones) compartido.
+    - Reintenta 429, 5xx y errores de conexión con backoff exponencial con
+      jitter, respetando `Retry-After` cuando el servidor lo envía.
+    - Devuelve los vectores en el mismo orden que los textos de entrada.
+
+    `base_url` (o OPENAI_BASE_URL) permite apuntarlo a un servidor compatible,
+    por ejemplo un stub HTTP local en pruebas.
+    """
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None,
+                 concurrency: int = 4, max_batch_tokens: int = 100_000, max_batch_items: int = 512,
+                 max_retries: int = 6, backoff_base: float = 0.5, backoff_max: float = 30.0,
+                 timeout: float = 60.0):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=timeout)
+        self.concurrency = max(1, concurrency)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_items = min(max_batch_items, OPENAI_MAX_INPUTS_PER_REQUEST)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='embed')
+
+    @classmethod
+    def from_env(cls) -> 'OpenAIBatchEmbedder':
+        return cls(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            base_url=os.getenv('OPENAI_BASE_URL') or None,
+            concurrency=int(os.getenv('EMBEDDING_CONCURRENCY', '4')),
+            max_batch_tokens=int(os.getenv('EMBEDDING_BATCH_TOKENS', '100000')),
+            max_batch_items=int(os.getenv('EMBEDDING_BATCH_ITEMS', '512')),
+            max_retries=int(os.getenv('EMBEDDING_MAX_RETRIES', '6')),
+        )
+
+    def embed(self, texts: Sequence[str], model: str) -> List[List[float]]:
+        texts = list(texts)
+        batches = pack_batches(texts, self.max_batch_tokens, self.max_batch_items)
+        if len(batches) == 1:
+            results = [self._embed_batch([texts[i] for i in batches[0]], model)]
+        else:
+            futures = [self._pool.submit(self._embed_batch, [texts[i] for i in b], model) for b in batches]
+            results = [f.result() for f in futures]
+        out: List[Optional[List[float]]] = [None] * len(texts)
+        for batch, vectors in zip(batches, results):
+            for i, vec in zip(batch, vectors):
+                out[i] = vec
+        return out
+
+    def _embed_batch(self, batch: List[str], model: str) -> List[List[float]]:
+        attempt = 0
+        while True:
+            try:
+                resp = self.client.embeddings.create(model=model, input=batch)
+                data = sorted(resp.data, key=lambda item: item.index)
+                if len(data) != len(batch):
+                    raise RuntimeError(f"La API devolvió {len(data)} embeddings para {len(batch)} textos")
+                return [item.embedding for item in data]
+            except Exception as e:
+                if attempt >= self.max_retries or not self._is_retryable(e):
+                    raise
+                delay = self._retry_delay(e, attempt)
+                logger.warning('Embeddings: intento %d falló (%s); reintento en %.2fs', attempt + 1, e, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        import openai
+        if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+        return False
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        # backoff exponencial con jitter completo
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+_OPENAI_EMBEDDER: Optional[OpenAIBatchEmbedder] = None
+_EMBEDDER_LOCK = threading.Lock()
+
+
+def get_openai_embedder() -> OpenAIBatchEmbedder:
+    """Embedder de OpenAI compartido por el proceso (un cliente, un pool de conexiones)."""
+    global _OPENAI_EMBEDDER
+    if _OPENAI_EMBEDDER is None:
+        with _EMBEDDER_LOCK:
+            if _OPENAI_EMBEDDER is None:
+                _OPENAI_EMBEDDER = OpenAIBatchEmbedder.from_env()
+    return _OPENAI_EMBEDDER
+
+
+class LocalEmbedder:
+    """Modelo local de sentence-transformers compartido por el proceso.
+
+    - El modelo se carga una sola vez, de forma perezosa (o con `warm_up`).
+    - Las consultas cortas de varios hilos/peticiones simultáneas se agrupan
+      (micro-batching): un hilo de fondo espera hasta `batch_wait_ms` o hasta
+      reunir `max_batch` textos y los codifica en una sola pasada.
+    - `num_threads` limita los hilos de inferencia en CPU.
+    - `backend='onnx'` usa ONNX Runtime; con `quantized=True` carga la variante
+      int8 del modelo (`onnx_file`).
+    """
+
+    def __init__(self, model_name: str, backend: str = 'torch', quantized: bool = False,
+                 onnx_file: str = 'onnx/model_qint8_avx512_vnni.onnx', num_threads: Optional[int] = None,
+                 max_batch: int = 64, batch_wait_ms: float = 5.0):
+        self.model_name = model_name
+        self.backend = backend
+        self.quantized = quantized
+        self.onnx_file = onnx_file
+        self.num_threads = num_threads
+        self.max_batch = max(1, max_batch)
+        self.batch_wait = batch_wait_ms / 1000.0
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._queue: 'queue.Queue' = queue.Queue()
+        self._batcher: Optional[threading.Thread] = None
+        self._batcher_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, model_name: str) -> 'LocalEmbedder':
+        threads = os.getenv('LOCAL_EMBEDDING_THREADS')
+        return cls(
+            model_name,
+            backend=os.getenv('LOCAL_EMBEDDING_BACKEND', 'torch'),
+            quantized=os.getenv('LOCAL_EMBEDDING_QUANTIZE', '0') == '1',
+            onnx_file=os.getenv('LOCAL_EMBEDDING_ONNX_FILE', 'onnx/model_qint8_avx512_vnni.onnx'),
+            num_threads=int(threads) if threads else None,
+            max_batch=int(os.getenv('LOCAL_EMBEDDING_MAX_BATCH', '64')),
+            batch_wait_ms=float(os.getenv('LOCAL_EMBEDDING_BATCH_WAIT_MS', '5')),
+        )
+
+    @property
+    def name(self) -> str:
+        """Identificador de los vectores producidos (clave de la caché de embeddings)."""
+        if self.backend == 'onnx' and self.quantized:
+            return f'{self.model_name}@onnx-int8'
+        return self.model_name
+
+    def _get_model(self):
+        if self._model is not None:
+            return self._model
+        with self._model_lock:
+            if self._model is None:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                except ImportError:
+                    raise RuntimeError(
+                        "No se encontró OPENAI_API_KEY ni la dependencia 'sentence-transformers'. Instálala con: pip install sentence-transformers"
+                    )
+                if self.num_threads:
+                    # torch ya está importado (lo carga sentence_transformers): OMP_NUM_THREADS
+                    # no tendría efecto, el límite se fija en tiempo de ejecución
+                    try:
+                        import torch
+                        torch.set_num_threads(self.num_threads)
+                    except ImportError:
+                        pass
+                kwargs = {}
+                if self.backend == 'onnx':
+                    kwargs['backend'] = 'onnx'
+                    if self.quantized:
+                        kwargs['model_kwargs'] = {'file_name': self.onnx_file}
+                started = time.perf_counter()
+                self._model = SentenceTransformer(self.model_name, **kwargs)
+                logger.info('Modelo local de embeddings %s (%s) cargado en %.2fs',
+                            self.name, self.backend, time.perf_counter() - started)
+        return self._model
+
+    def warm_up(self):
+        self._get_model()
+
+    def encode(self, texts: Sequence[str]) -> List[List[float]]:
+        """Codifica directamente (sin micro-batching); adecuado para lotes grandes de ingesta."""
+        if not texts:
+            return []
+        emb_arr = self._get_model().encode(list(texts), batch_size=self.max_batch, show_progress_bar=False)
+        return emb_arr.tolist()
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        """Codifica `texts`; las peticiones pequeñas se agrupan con las de otros hilos."""
+        if len(texts) >= self.max_batch or self.batch_wait <= 0:
+            return self.encode(texts)
+        self._ensure_batcher()
+        future: Future = Future()
+        self._queue.put((list(texts), future))
+        return future.result()
+
+    def _ensure_batcher(self):
+        if self._batcher is not None and self._batcher.is_alive():
+            return
+        with self._batcher_lock:
+            if self._batcher is None or not self._batcher.is_alive():
+                self._batcher = threading.Thread(target=self._batch_loop, name='local-embedder', daemon=True)
+                self._batcher.start()
+
+    def _batch_loop(self):
+        while True:
+            pending = [self._queue.get()]
+            size = len(pending[0][0])
+            deadline = time.monotonic() + self.batch_wait
+            while size < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                pending.append(item)
+                size += len(item[0])
+            texts = [t for item_texts, _ in pending for t in item_texts]
+            try:
+                vectors = self.encode(texts)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for item_texts, future in pending:
+                future.set_result(vectors[start:start + len(item_texts)])
+                start += len(item_texts)
+
+
+_LOCAL_EMBEDDER: Optional[LocalEmbedder] = None
+
+
+def get_local_embedder(model_name: str) -> LocalEmbedder:
+    """Embedder local compartido por el proceso (el modelo se carga en el primer uso)."""
+    global _LOCAL_EMBEDDER
+    if _LOCAL_EMBEDDER is None:
+        with _EMBEDDER_LOCK:
+            if _LOCAL_EMBEDDER is None:
+                _LOCAL_EMBEDDER = LocalEmbedder.from_env(model_name)
+    return _LOCAL_EMBEDDER
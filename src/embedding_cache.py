@@ -0,0 +1,231 @@
+"""Caché persistente de embeddings en SQLite, compartida entre procesos.
+
+Las entradas se indexan por (modelo, sha256 del texto), de modo que la
+ingesta y las consultas en tiempo de ejecución nunca pagan dos veces el mismo
+embedding, incluso tras reiniciar o entre varios workers de uvicorn.
+"""
+from pathlib import Path
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = Path(__file__).parent.parent / 'kb' / 'db' / 'embedding_cache.sqlite3'
+DEFAULT_MAX_ENTRIES = 200_000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model TEXT NOT NULL,
+    text_hash TEXT NOT NULL,
+    dim INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (model, text_hash)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# SQLite limita el número de parámetros por sentencia
+_QUERY_BATCH = 500
+
+# `last_used` y los contadores de `stats` se acumulan en memoria y los escribe un hilo
+# de fondo cada tantos segundos (y `put_many`, `stats` y `close`): las búsquedas sólo leen
+DEFAULT_FLUSH_INTERVAL = 5.0
+_MAX_PENDING_TOUCHES = 10_000
+
+# al superar el máximo se expulsa hasta esta fracción, para no contar en cada inserción
+_EVICT_LOW_WATER = 0.95
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """Caché de embeddings acotada por número de entradas con expulsión LRU.
+
+    Lleva contadores de aciertos/fallos del proceso (`hits`, `misses`) y
+    acumulados entre procesos en la tabla `stats`.
+    """
+
+    def __init__(self, path: Path = DEFAULT_CACHE_PATH, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touched: Dict[Tuple[str, str], float] = {}
+        self._pending_hits = 0
+        self._pending_misses = 0
+        self._closed = False
+        self._flush_wakeup = threading.Event()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        # estimación de las entradas (por exceso: cuenta también los reemplazos); sólo se
+        # recuenta con COUNT(*) cuando supera el máximo
+        self._count = self._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        if flush_interval > 0:
+            threading.Thread(target=self._flush_loop, name='embedding-cache-flush', daemon=True).start()
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Devuelve un vector float32 por texto, o None si no está en caché."""
+        hashes = [text_hash(t) for t in texts]
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            unique = list(dict.fromkeys(hashes))
+            for i in range(0, len(unique), _QUERY_BATCH):
+                batch = unique[i:i + _QUERY_BATCH]
+                placeholders = ','.join('?' * len(batch))
+                rows = self._conn.execute(
+                    f'SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})',
+                    [model, *batch],
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32)
+            now = time.time()
+            for h in found:
+                self._touched[(model, h)] = now
+            result = [found.get(h) for h in hashes]
+            hits = sum(v is not None for v in result)
+            self.hits += hits
+            self.misses += len(result) - hits
+            self._pending_hits += hits
+            self._pending_misses += len(result) - hits
+            if len(self._touched) >= _MAX_PENDING_TOUCHES:
+                self._flush_wakeup.set()
+        return result
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        now = time.time()
+        rows = []
+        for t, v in zip(texts, vectors):
+            arr = np.asarray(v, dtype=np.float32)
+            rows.append((model, text_hash(t), arr.shape[0], arr.tobytes(), now))
+        with self._lock:
+            self._flush()
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (model, text_hash, dim, vector, last_used) VALUES (?, ?, ?, ?, ?)',
+                rows,
+            )
+            self._count += len(rows)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        if self._count <= self.max_entries:
+            return
+        # la estimación pasó del máximo: recuento real (incluye lo insertado por otros procesos)
+        self._count = self._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        if self._count <= self.max_entries:
+            return
+        excess = self._count - int(self.max_entries * _EVICT_LOW_WATER)
+        self._conn.execute(
+            'DELETE FROM embeddings WHERE (model, text_hash) IN '
+            '(SELECT model, text_hash FROM embeddings ORDER BY last_used LIMIT ?)',
+            (excess,),
+        )
+        self._count -= excess
+        logger.info('Caché de embeddings: %d entradas expulsadas (máximo %d)', excess, self.max_entries)
+
+    def _flush(self):
+        """Escribe los `last_used` y contadores acumulados en memoria (con el lock tomado; sin commit)."""
+        if self._touched:
+            self._conn.executemany(
+                'UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?',
+                [(ts, model, h) for (model, h), ts in self._touched.items()],
+            )
+            self._touched.clear()
+        if self._pending_hits or self._pending_misses:
+            self._conn.executemany(
+                'INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                [('hits', self._pending_hits), ('misses', self._pending_misses)],
+            )
+            self._pending_hits = self._pending_misses = 0
+
+    def _flush_loop(self):
+        while True:
+            self._flush_wakeup.wait(self.flush_interval)
+            self._flush_wakeup.clear()
+            with self._lock:
+                if self._closed:
+                    return
+                if not (self._touched or self._pending_hits or self._pending_misses):
+                    continue
+                try:
+                    self._flush()
+                    self._conn.commit()
+                except sqlite3.Error:
+                    logger.exception('Caché de embeddings: no se pudieron guardar los usos pendientes')
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._flush()
+            self._conn.commit()
+            entries = self._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+            totals = dict(self._conn.execute('SELECT name, value FROM stats').fetchall())
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'total_hits': totals.get('hits', 0),
+            'total_misses': totals.get('misses', 0),
+        }
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._flush_wakeup.set()
+            self._flush()
+            self._conn.commit()
+            self._conn.close()
+
+
+_CACHE: Optional[EmbeddingCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Caché del proceso, configurada por entorno.
+
+    - EMBEDDING_CACHE: '0' la desactiva
+    - EMBEDDING_CACHE_PATH: archivo SQLite (por defecto kb/db/embedding_cache.sqlite3)
+    - EMBEDDING_CACHE_MAX_ENTRIES: número máximo de vectores guardados
+    - EMBEDDING_CACHE_FLUSH_INTERVAL: segundos entre escrituras en segundo plano de `last_used`
+      y contadores (5; 0 sólo al guardar vectores y al cerrar)
+    """
+    global _CACHE
+    if os.getenv('EMBEDDING_CACHE', '1') == '0':
+        return None
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                try:
+                    _CACHE = EmbeddingCache(
+                        Path(os.getenv('EMBEDDING_CACHE_PATH', str(DEFAULT_CACHE_PATH))),
+                        int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', str(DEFAULT_MAX_ENTRIES))),
+                        float(os.getenv('EMBEDDING_CACHE_FLUSH_INTERVAL', str(DEFAULT_FLUSH_INTERVAL))),
+                    )
+                except Exception:
+                    logger.exception('No se pudo abrir la caché de embeddings; se continúa sin caché')
+                    return None
+    return _CACHE
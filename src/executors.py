@@ -0,0 +1,109 @@
+"""Pools de hilos acotados para sacar trabajo bloqueante del event loop.
+
+Los endpoints `async` de FastAPI comparten un único event loop por worker: una
+llamada síncrona (flujo de agentes con HTTP bloqueante a OpenAI) dentro de uno
+de ellos detiene todas las demás peticiones, incluido `/ping`. `run_blocking` ejecuta esa función en un pool propio de cada tipo de
+trabajo, con hilos y cola limitados: con la cola llena, la petición se rechaza
+en vez de acumularse. Los PDFs van a su propio pool de procesos
+(`src/pdf_jobs.py`).
+"""
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+import threading
+import time
+from typing import Any, Callable, Dict
+
+
+class ExecutorBusyError(RuntimeError):
+    """La cola del pool está llena; el endpoint debería responder 503."""
+
+
+class BoundedExecutor:
+    """ThreadPoolExecutor con un máximo de tareas pendientes (en ejecución + en cola)."""
+
+    def __init__(self, name: str, max_workers: int, max_pending: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{name}-exec')
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.max_queue_wait = 0.0
+
+    def _run(self, submitted: float, fn: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            self.running += 1
+            self.max_queue_wait = max(self.max_queue_wait, time.perf_counter() - submitted)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.pending -= 1
+                self.completed += 1
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise ExecutorBusyError(f'Pool {self.name} saturado ({self.pending} tareas pendientes)')
+            self.pending += 1
+        try:
+            future = self._pool.submit(self._run, time.perf_counter(), fn, *args, **kwargs)
+        except RuntimeError:
+            # pool apagado: deshacer la reserva
+            with self._lock:
+                self.pending -= 1
+            raise
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'running': self.running,
+                'queued': self.pending - self.running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'max_queue_wait': round(self.max_queue_wait, 4),
+            }
+
+
+# nombre -> (variable de hilos, hilos por defecto, variable de cola, pendientes por defecto)
+EXECUTOR_SETTINGS = {
+    'agent': ('AGENT_EXECUTOR_WORKERS', 32, 'AGENT_EXECUTOR_MAX_PENDING', 256),
+}
+
+_EXECUTORS: Dict[str, BoundedExecutor] = {}
+_EXECUTORS_LOCK = threading.Lock()
+
+
+def get_executor(name: str) -> BoundedExecutor:
+    executor = _EXECUTORS.get(name)
+    if executor is None:
+        with _EXECUTORS_LOCK:
+            executor = _EXECUTORS.get(name)
+            if executor is None:
+                workers_env, workers, pending_env, pending = EXECUTOR_SETTINGS[name]
+                executor = _EXECUTORS[name] = BoundedExecutor(
+                    name, int(os.getenv(workers_env, str(workers))), int(os.getenv(pending_env, str(pending))))
+    return executor
+
+
+async def run_blocking(name: str, fn: Callable, *args, **kwargs) -> Any:
+    """Ejecuta `fn(*args, **kwargs)` en el pool `name` (p. ej. 'agent') sin bloquear el event loop.
+
+    Lanza ExecutorBusyError si el pool ya tiene su máximo de tareas pendientes.
+    """
+    return await get_executor(name).run(fn, *args, **kwargs)
+
+
+def executor_stats() -> dict:
+    with _EXECUTORS_LOCK:
+        executors = dict(_EXECUTORS)
+    return {name: ex.stats() for name, ex in sorted(executors.items())}
@@ -1,68 +1,324 @@
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import hashlib
 import json
-from utils import chunk_text, embed_texts, save_index, extract_text_from_pdf
+import os
+from typing import Callable, Iterable, Iterator, List, Optional
+from utils import (IndexWriter, chunk_text, embed_texts, embedding_model_name, extract_text_from_pdf,
+                   index_exists, load_index, read_index_header)
+from ann import ANN_INDEX_TYPES, build_ann_index, existing_ann_kinds
+from bm25 import BM25Index, bm25_index_path
 import numpy as np
 
 KB_DIR = Path(__file__).parent.parent / 'kb'
 INDEX_PATH = KB_DIR / 'db' / 'index.npz'
+CHUNK_MAX_CHARS = 1000
 
 
-def load_documents(kb_dir: Path, papers_dir: Path = None):
-    """Cargar únicamente archivos markdown y PDF bajo `kb/papers/` para indexar."""
-    docs = []
-    if not papers_dir.exists():
-        return docs
-    
-    # MarkDown files
-    for p in papers_dir.rglob('*.md'):
+def iter_source_files(papers_dir: Path) -> Iterator[Path]:
+    """Archivos markdown y PDF a indexar, en orden estable."""
+    if not papers_dir or not papers_dir.exists():
+        return
+    for p in sorted(papers_dir.rglob('*.md')):
         if p.name.startswith('index'):
             continue
-        text = p.read_text(encoding='utf-8')
-        title = next((line.strip() for line in text.splitlines() if line.strip()), p.stem)
-        docs.append({'source': str(p.relative_to(kb_dir)), 'text': text, 'title': title})
+        yield p
+    yield from sorted(papers_dir.rglob('*.pdf'))
+
+
+def load_file_documents(path: Path, kb_dir: Path) -> List[dict]:
+    """Documentos de un archivo: el markdown completo o una entrada por página de PDF.
+
+    Si el archivo no se puede leer, propaga la excepción.
+    """
+    if path.suffix.lower() == '.md':
+        text = path.read_text(encoding='utf-8')
+        title = next((line.strip() for line in text.splitlines() if line.strip()), path.stem)
+        return [{'source': str(path.relative_to(kb_dir)), 'text': text, 'title': title}]
+    pages = extract_text_from_pdf(path)
+    docs = []
+    for i, page_text in enumerate(pages):
+        title = f"{path.stem} - page {i+1}"
+        source = str(path.relative_to(kb_dir)) + f"::page_{i+1}"
+        docs.append({'source': source, 'text': page_text, 'title': title})
+    return docs
 
-    # PDF files
-    for p in papers_dir.rglob('*.pdf'):
+
+def load_documents(kb_dir: Path, papers_dir: Path = None):
+    """Cargar únicamente archivos markdown y PDF bajo `kb/papers/` para indexar."""
+    docs = []
+    for p in iter_source_files(papers_dir):
         try:
-            pages = extract_text_from_pdf(p)
+            docs.extend(load_file_documents(p, kb_dir))
         except Exception as e:
-            print(f"Advertencia: no se pudo leer PDF {p}: {e}")
-            continue
-        for i, page_text in enumerate(pages):
-            title = f"{p.stem} - page {i+1}"
-            source = str(p.relative_to(kb_dir)) + f"::page_{i+1}"
-            docs.append({'source': source, 'text': page_text, 'title': title})
-            
-    return docs
+            print(f"Advertencia: no se pudo leer {p}: {e}")
     return docs
 
 
-def build_index(kb_dir: Path, papers_dir: Path, index_path: Path):
-    """Construir y guardar el índice de embeddings a partir de los documentos.
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
 
-    Lee los documentos, los divide en fragmentos, genera embeddings y guarda
-    el índice junto con los metadatos.
-    """
-    docs = load_documents(kb_dir, papers_dir)
-    chunks = []
+
+def text_sha256(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def chunk_documents(docs: List[dict], file_rel: str, file_hash: str) -> List[dict]:
+    """Fragmenta los documentos de un archivo y anota cada fragmento con sus hashes."""
     metadatas = []
     for d in docs:
-        parts = chunk_text(d['text'], max_chars=1000)
-        for i, p in enumerate(parts):
-            chunks.append(p)
+        for i, p in enumerate(chunk_text(d['text'], max_chars=CHUNK_MAX_CHARS)):
             metadatas.append({
                 'source': d['source'],
                 'title': d.get('title'),
                 'chunk_id': i,
+                'file': file_rel,
+                'file_hash': file_hash,
+                'chunk_hash': text_sha256(p),
                 'text': p,
-                'text_preview': p[:200]
             })
-    print(f"Generando embeddings para {len(chunks)} fragmentos...")
-    embeddings = embed_texts(chunks)
-    emb_arr = np.array(embeddings)
-    save_index(emb_arr, metadatas, index_path)
-    print(f"Índice guardado en {index_path}")
+    return metadatas
+
+
+class PreviousIndex:
+    """Índice existente visto como almacén de vectores reutilizables.
+
+    Permite recuperar todas las filas de un archivo sin cambios (por ruta y hash
+    de archivo) o el vector de un fragmento concreto (por hash de contenido).
+    """
+
+    def __init__(self, emb_arr: np.ndarray, metadatas, files: dict):
+        self.emb = emb_arr
+        self.metadatas = metadatas
+        self.files = files
+        self.rows_by_file = {}
+        self.row_by_hash = {}
+        for row in range(len(metadatas)):
+            rec = metadatas.records[row]
+            self.rows_by_file.setdefault(rec.get('file'), []).append(row)
+            if rec.get('chunk_hash'):
+                self.row_by_hash.setdefault(rec['chunk_hash'], row)
+
+    @classmethod
+    def load(cls, index_path: Path, model_name: str) -> Optional['PreviousIndex']:
+        if not index_exists(index_path):
+            return None
+        header = read_index_header(index_path)
+        if 'files' not in header:
+            print("El índice existente no tiene manifiesto de ingesta; se reconstruye completo.")
+            return None
+        if header.get('embedding_model') != model_name:
+            print(f"El índice existente usa el modelo {header.get('embedding_model')!r} "
+                  f"y el actual es {model_name!r}; se reconstruye completo.")
+            return None
+        emb_arr, metadatas = load_index(index_path)
+        return cls(emb_arr, metadatas, header['files'])
+
+
+def process_file(path: Path, kb_dir: Path, known_hash: Optional[str] = None) -> tuple:
+    """Trabajo de un proceso del pool: hash del archivo y, si cambió, sus fragmentos.
+
+    Devuelve (ruta relativa, hash, fragmentos); fragmentos es None cuando el
+    hash coincide con `known_hash` y el archivo puede copiarse del índice previo.
+    Si no se puede leer (permisos, borrado durante la ingesta, PDF corrupto), el
+    hash es None: la ingesta conserva lo que hubiera del archivo en el índice
+    previo y la próxima ingesta incremental lo vuelve a intentar.
+    """
+    file_rel = str(path.relative_to(kb_dir))
+    try:
+        file_hash = file_sha256(path)
+        if known_hash == file_hash:
+            return file_rel, file_hash, None
+        docs = load_file_documents(path, kb_dir)
+    except Exception as e:
+        print(f"Advertencia: no se pudo leer {path}: {e}")
+        return file_rel, None, None
+    return file_rel, file_hash, chunk_documents(docs, file_rel, file_hash)
+
+
+def bounded_ordered_map(executor, fn: Callable, items: Iterable[tuple], max_in_flight: int) -> Iterator:
+    """Como `executor.map`, pero consumiendo `items` de forma perezosa.
+
+    Mantiene como mucho `max_in_flight` tareas pendientes (una cola acotada) y
+    devuelve los resultados en el orden de entrada. Sin executor, procesa en el
+    hilo actual.
+    """
+    if executor is None:
+        for item in items:
+            yield fn(*item)
+        return
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, *item))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def embed_batch(batch: List[tuple]) -> tuple:
+    """Completa los vectores que faltan de un lote [(metadata, vector o None)]."""
+    metadatas = [m for m, _ in batch]
+    vectors = [v for _, v in batch]
+    pending = [i for i, v in enumerate(vectors) if v is None]
+    if pending:
+        for i, emb in zip(pending, embed_texts([metadatas[i]['text'] for i in pending])):
+            vectors[i] = emb
+    return metadatas, np.array([np.asarray(v, dtype=np.float32) for v in vectors]), len(pending)
+
+
+def build_index(kb_dir: Path, papers_dir: Path, index_path: Path, ann: Optional[str] = None,
+                ann_params: Optional[dict] = None, incremental: bool = False,
+                workers: Optional[int] = None, batch_size: int = 256, embed_workers: int = 2):
+    """Construir y guardar el índice de embeddings a partir de los documentos.
+
+    Lee los documentos, los divide en fragmentos, genera embeddings y guarda
+    el índice junto con los metadatos, más un índice léxico BM25 de los
+    mismos fragmentos. Si se indica `ann` ('ivf' o 'hnsw'), construye además
+    el índice aproximado y lo guarda junto a `index_path`.
+
+    La ingesta es un pipeline en streaming: un pool de `workers` procesos lee
+    y fragmenta los PDF, los fragmentos se agrupan en lotes de `batch_size` y
+    `embed_workers` hilos generan sus embeddings mientras los lotes ya listos se
+    escriben a disco. Las colas entre etapas están acotadas, así que la memoria
+    no depende del tamaño del corpus.
+
+    El índice guarda un manifiesto con el hash de cada archivo y de cada
+    fragmento. Con `incremental=True` los archivos sin cambios se copian del
+    índice existente sin volver a leerlos, sólo se generan embeddings para los
+    fragmentos nuevos o modificados y los archivos borrados desaparecen del
+    índice. El resultado se publica de forma atómica (ver `utils.IndexWriter`).
+    """
+    model_name = embedding_model_name()
+    previous = PreviousIndex.load(index_path, model_name) if incremental else None
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    files = {}
+    stats = {'reused_files': 0, 'reused_chunks': 0, 'embedded': 0, 'failed': 0, 'kept_files': 0}
+
+    def iter_rows(parsed) -> Iterator[tuple]:
+        for file_rel, file_hash, chunks in parsed:
+            if file_hash is None:
+                stats['failed'] += 1
+                if previous is None or file_rel not in previous.files:
+                    continue  # sin entrada en el manifiesto: se reintenta en la próxima ingesta
+                # legible en la ingesta anterior: se conservan sus fragmentos y su hash, así que
+                # si el archivo cambió se volverá a procesar
+                stats['kept_files'] += 1
+                files[file_rel] = previous.files[file_rel]
+                rows = previous.rows_by_file.get(file_rel, [])
+                stats['reused_chunks'] += len(rows)
+                for row in rows:
+                    yield previous.metadatas[row], previous.emb[row]
+                continue
+            files[file_rel] = file_hash
+            if chunks is None:
+                rows = previous.rows_by_file.get(file_rel, [])
+                stats['reused_files'] += 1
+                stats['reused_chunks'] += len(rows)
+                for row in rows:
+                    yield previous.metadatas[row], previous.emb[row]
+                continue
+            for m in chunks:
+                row = previous.row_by_hash.get(m['chunk_hash']) if previous is not None else None
+                if row is not None:
+                    stats['reused_chunks'] += 1
+                yield m, (previous.emb[row] if row is not None else None)
+
+    def iter_batches(rows) -> Iterator[tuple]:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield (batch,)
+                batch = []
+        if batch:
+            yield (batch,)
+
+    file_items = ((p, kb_dir, previous.files.get(str(p.relative_to(kb_dir))) if previous else None)
+                  for p in iter_source_files(papers_dir))
+    writer = IndexWriter(index_path)
+    parse_pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    embed_pool = ThreadPoolExecutor(max_workers=embed_workers) if embed_workers > 1 else None
+    try:
+        parsed = bounded_ordered_map(parse_pool, process_file, file_items, max_in_flight=2 * max(workers, 1))
+        batches = iter_batches(iter_rows(parsed))
+        for metadatas, emb_arr, n_embedded in bounded_ordered_map(embed_pool, embed_batch, batches,
+                                                                  max_in_flight=2 * max(embed_workers, 1)):
+            writer.add(emb_arr, metadatas)
+            stats['embedded'] += n_embedded
+            print(f"  {len(writer)} fragmentos procesados ({stats['embedded']} embeddings nuevos)")
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        for pool in (parse_pool, embed_pool):
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+    removed = sorted(set(previous.files) - set(files)) if previous is not None else []
+    if stats['failed']:
+        print(f"{stats['failed']} archivos no se pudieron leer ({stats['kept_files']} conservan los fragmentos "
+              f"del índice anterior); se reintentarán en la próxima ingesta.")
+    if previous is not None:
+        print(f"Incremental: {stats['reused_files']} archivos sin cambios, {stats['reused_chunks']} fragmentos "
+              f"reutilizados, {len(removed)} archivos eliminados")
+        if stats['reused_files'] + stats['kept_files'] == len(files) and not removed and not ann:
+            writer.abort()
+            print("El índice ya está al día.")
+            return
+    if not len(writer):
+        writer.abort()
+        print("No se encontraron fragmentos para indexar.")
+        return
+    print(f"Embeddings generados para {stats['embedded']} de {len(writer)} fragmentos.")
+
+    ann_kinds = [ann] if ann else existing_ann_kinds(index_path, read_index_header(index_path).get('generation'))
+
+    def write_sidecars(emb_arr, metadatas, generation: str):
+        # antes de publicar meta.json: los lectores nunca ven una generación sin BM25/ANN
+        bm25 = BM25Index.build(metadatas.text(i) for i in range(len(metadatas)))
+        bm25_path = bm25_index_path(index_path, generation)
+        bm25.save(bm25_path)
+        print(f"Índice BM25 ({len(bm25.terms)} términos) guardado en {bm25_path}")
+        for kind in ann_kinds:
+            params = (ann_params or {}) if kind == ann else {}
+            ann_path = build_ann_index(emb_arr, index_path, kind, generation=generation, **params)
+            print(f"Índice ANN '{kind}' guardado en {ann_path}")
+
+    writer.commit(header_extra={'embedding_model': model_name, 'files': files}, before_publish=write_sidecars)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Construye el índice de embeddings de kb/data_rag')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Reutilizar los embeddings de archivos y fragmentos sin cambios')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Procesos para leer y fragmentar PDFs (por defecto, número de CPUs; 1 = sin pool)')
+    parser.add_argument('--batch-size', type=int, default=256, help='Fragmentos por lote de embeddings')
+    parser.add_argument('--embed-workers', type=int, default=2, help='Lotes de embeddings en paralelo')
+    parser.add_argument('--ann', choices=sorted(ANN_INDEX_TYPES), default=None,
+                        help='Construir además un índice aproximado (ANN) junto a index.npz')
+    parser.add_argument('--nlist', type=int, default=None,
+                        help='IVF: número de listas (por defecto 4*sqrt(n))')
+    parser.add_argument('--hnsw-m', type=int, default=16, help='HNSW: vecinos por nodo')
+    parser.add_argument('--hnsw-ef-construction', type=int, default=200, help='HNSW: ef de construcción')
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    build_index(KB_DIR, KB_DIR / 'data_rag', INDEX_PATH)
\ No newline at end of file
+    args = parse_args()
+    if args.ann == 'ivf':
+        ann_params = {'nlist': args.nlist}
+    elif args.ann == 'hnsw':
+        ann_params = {'M': args.hnsw_m, 'ef_construction': args.hnsw_ef_construction}
+    else:
+        ann_params = {}
+    build_index(KB_DIR, KB_DIR / 'data_rag', INDEX_PATH, ann=args.ann, ann_params=ann_params,
+                incremental=args.incremental, workers=args.workers, batch_size=args.batch_size,
+                embed_workers=args.embed_workers)
\ No newline at end of file
@@ -0,0 +1,283 @@
+"""Cola de trabajos de generación de PDFs en un pool de procesos.
+
+`submit` registra el trabajo y vuelve en el acto con su id (el mismo que el
+`pdf_id` final); el PDF se renderiza en un proceso aparte (matplotlib, QR y
+xhtml2pdf no compiten con el event loop ni por el GIL) y, al terminar, se
+registra en `src/pdf_registry.py`. El cliente consulta el estado en
+`GET /api/pdf/jobs/{job_id}`.
+
+- Contrapresión: con `max_pending` trabajos sin terminar, `submit` lanza
+  ExecutorBusyError (el endpoint responde 503).
+- Reintentos: un fallo (incluida la caída de un proceso del pool) se reintenta
+  hasta `retries` veces con espera exponencial desde `retry_delay`.
+- Los trabajos terminados se conservan `ttl` segundos en memoria; después el
+  estado se deduce del registro de PDFs.
+"""
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from src.executors import ExecutorBusyError
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+def _render(*args) -> int:
+    # se ejecuta en los procesos del pool: matplotlib, qrcode y xhtml2pdf se cargan
+    # allí y no en el proceso de la app, que nunca importa src.pdf_render
+    from src.pdf_render import render_pdf_file
+
+    return render_pdf_file(*args)
+
+
+@dataclass
+class PDFJob:
+    job_id: str
+    html_content: str = field(repr=False)
+    title: str
+    description: str
+    percentage: float
+    view_url: str
+    status: str = QUEUED
+    attempts: int = 0
+    error: Optional[str] = None
+    result: Optional[dict] = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    inner: Optional[Future] = field(default=None, repr=False)
+    # se completa con los metadatos del PDF (o la excepción) tras el último intento
+    future: Future = field(default_factory=Future, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def as_dict(self) -> dict:
+        status = self.status
+        if status == QUEUED and self.inner is not None and self.inner.running():
+            status = RUNNING
+        out = {
+            'job_id': self.job_id,
+            'status': status,
+            'attempts': self.attempts,
+            'error': self.error,
+            'status_url': f'/api/pdf/jobs/{self.job_id}',
+        }
+        if self.result is not None:
+            out.update(self.result)
+        return out
+
+
+class PDFJobQueue:
+    def __init__(self, pdf_dir: Path, register, max_workers: int = 2, max_pending: int = 32, retries: int = 2,
+                 retry_delay: float = 1.0, ttl: float = 3600.0, start_method: str = 'spawn'):
+        """`register(pdf_id, title, description, filename) -> dict` guarda los metadatos del PDF terminado."""
+        self.pdf_dir = Path(pdf_dir)
+        self.register = register
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.ttl = ttl
+        self.start_method = start_method
+        self._jobs: Dict[str, PDFJob] = {}
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._closed = False
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.job_seconds = 0.0
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # se crea con el primer trabajo: los procesos no se lanzan si nunca se pide un PDF
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context(self.start_method))
+            return self._pool
+
+    def _reset_pool(self, broken: ProcessPoolExecutor):
+        with self._lock:
+            if self._pool is broken:
+                self._pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, job_id: str, html_content: str, title: str, description: str, percentage: float,
+               view_url: str) -> PDFJob:
+        """Encola el PDF `job_id`. Lanza ExecutorBusyError si ya hay `max_pending` trabajos sin terminar."""
+        job = PDFJob(job_id, html_content, title, description, percentage, view_url)
+        with self._lock:
+            self._prune()
+            if sum(1 for j in self._jobs.values() if not j.finished) >= self.max_pending:
+                self.rejected += 1
+                raise ExecutorBusyError(f'Cola de PDFs saturada ({self.max_pending} trabajos pendientes)')
+            self._jobs[job_id] = job
+            self.submitted += 1
+        self._dispatch(job)
+        return job
+
+    def _dispatch(self, job: PDFJob):
+        if self._closed:
+            self._finish(job, error=RuntimeError('La cola de PDFs está detenida'))
+            return
+        pool = self._get_pool()
+        job.attempts += 1
+        try:
+            inner = pool.submit(_render, job.html_content, job.title, job.percentage,
+                                str(self.pdf_dir / f'{job.job_id}.pdf'), job.view_url)
+        except (BrokenProcessPool, RuntimeError) as e:
+            # pool roto o apagado: cuenta como intento fallido
+            self._reset_pool(pool)
+            self._attempt_failed(job, e)
+            return
+        job.inner = inner
+        inner.add_done_callback(lambda f: self._on_done(job, pool, f))
+
+    def _on_done(self, job: PDFJob, pool: ProcessPoolExecutor, inner: Future):
+        if inner.cancelled():
+            # pool apagado (shutdown) o reemplazado (_reset_pool) con el trabajo aún en cola;
+            # inner.exception() lanzaría CancelledError dentro del callback y el trabajo no terminaría
+            if self._closed:
+                self._finish(job, error=RuntimeError('La cola de PDFs está detenida'))
+            else:
+                self._attempt_failed(job, RuntimeError('Trabajo cancelado al reiniciar el pool de PDFs'))
+            return
+        error = inner.exception()
+        if error is not None:
+            if isinstance(error, BrokenProcessPool):
+                self._reset_pool(pool)
+            self._attempt_failed(job, error)
+            return
+        try:
+            metadata = self.register(job.job_id, job.title, job.description, f'{job.job_id}.pdf')
+        except Exception as e:
+            logger.exception('No se pudo registrar el PDF %s', job.job_id)
+            # sin metadatos nadie podría servirlo ni borrarlo
+            (self.pdf_dir / f'{job.job_id}.pdf').unlink(missing_ok=True)
+            self._finish(job, error=e)
+            return
+        self._finish(job, result=metadata)
+
+    def _attempt_failed(self, job: PDFJob, error: BaseException):
+        if job.attempts <= self.retries:
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            logger.warning('PDF %s: intento %d fallido (%s); reintento en %.1fs', job.job_id, job.attempts, error, delay)
+            with self._lock:
+                self.retried += 1
+            job.status = QUEUED
+            timer = threading.Timer(delay, self._dispatch, (job,))
+            timer.daemon = True
+            timer.start()
+            return
+        logger.error('PDF %s: fallido tras %d intentos: %s', job.job_id, job.attempts, error)
+        self._finish(job, error=error)
+
+    def _finish(self, job: PDFJob, result: Optional[dict] = None, error: Optional[BaseException] = None):
+        job.result = result
+        job.error = None if error is None else str(error)
+        job.finished_at = time.time()
+        job.html_content = ''  # no retener el HTML de trabajos terminados
+        job.inner = None
+        job.status = DONE if error is None else FAILED
+        with self._lock:
+            self.job_seconds += job.finished_at - job.created_at
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+        if error is None:
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(error)
+
+    def _prune(self):
+        # llamado con el lock tomado
+        cutoff = time.time() - self.ttl
+        for job_id in [k for k, j in self._jobs.items() if j.finished and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[PDFJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    async def wait(self, job: PDFJob) -> dict:
+        """Espera sin bloquear el event loop a que termine `job`; devuelve sus metadatos o lanza su error."""
+        return await asyncio.wrap_future(job.future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            statuses: Dict[str, int] = {}
+            for job in self._jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+            return {
+                'workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'jobs': statuses,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'retried': self.retried,
+                'rejected': self.rejected,
+                # desde el alta hasta el PDF registrado, incluida la espera en cola y los reintentos
+                'job_seconds_avg': round(self.job_seconds / (self.completed + self.failed), 4)
+                if self.completed + self.failed else 0.0,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+_QUEUE: Optional[PDFJobQueue] = None
+_QUEUE_LOCK = threading.Lock()
+
+
+def get_pdf_job_queue(pdf_dir: Path) -> PDFJobQueue:
+    """Cola del proceso.
+
+    - PDF_JOB_WORKERS: procesos de renderizado (por defecto 2)
+    - PDF_JOB_MAX_PENDING: trabajos sin terminar antes de rechazar con 503 (32)
+    - PDF_JOB_RETRIES / PDF_JOB_RETRY_DELAY: reintentos (2) y espera inicial en segundos (1)
+    - PDF_JOB_TTL: segundos que se conserva en memoria un trabajo terminado (3600)
+    - PDF_JOB_START_METHOD: `spawn` (por defecto), `forkserver` o `fork`
+    """
+    global _QUEUE
+    if _QUEUE is None:
+        with _QUEUE_LOCK:
+            if _QUEUE is None:
+                from src.pdf_registry import get_pdf_registry
+
+                _QUEUE = PDFJobQueue(
+                    pdf_dir,
+                    lambda pdf_id, title, description, filename: get_pdf_registry().add(pdf_id, title, description, filename),
+                    max_workers=int(os.getenv('PDF_JOB_WORKERS', '2')),
+                    max_pending=int(os.getenv('PDF_JOB_MAX_PENDING', '32')),
+                    retries=int(os.getenv('PDF_JOB_RETRIES', '2')),
+                    retry_delay=float(os.getenv('PDF_JOB_RETRY_DELAY', '1')),
+                    ttl=float(os.getenv('PDF_JOB_TTL', '3600')),
+                    start_method=os.getenv('PDF_JOB_START_METHOD', 'spawn'),
+                )
+    return _QUEUE
+
+
+def shutdown_pdf_job_queue():
+    """Detiene los procesos de la cola, si se llegaron a crear (al apagar la app)."""
+    with _QUEUE_LOCK:
+        if _QUEUE is not None:
+            _QUEUE.shutdown()
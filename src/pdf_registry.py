@@ -0,0 +1,139 @@
+"""Registro de los PDFs generados, en SQLite.
+
+Sustituye a `data/pdf_metadata.json`, que se leía entero y se recorría en
+cada consulta y se reescribía en cada alta o baja (perdiendo entradas con
+escritores concurrentes). Cada PDF es una fila indexada por `pdf_id`: buscar
+uno es una consulta por clave primaria y cada alta o baja, una transacción.
+La primera vez que se abre el registro se importan las entradas del JSON
+antiguo.
+"""
+from datetime import datetime
+from pathlib import Path
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = Path(__file__).parent.parent / 'data'
+DEFAULT_REGISTRY_PATH = DATA_DIR / 'pdf_registry.sqlite3'
+LEGACY_JSON_PATH = DATA_DIR / 'pdf_metadata.json'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pdfs (
+    pdf_id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    description TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    created_at TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pdfs_created_at ON pdfs (created_at);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_COLUMNS = ('pdf_id', 'title', 'description', 'filename', 'created_at')
+
+
+def _record(row) -> dict:
+    rec = dict(zip(_COLUMNS, row))
+    rec['download_url'] = f"/api/pdf/{rec['pdf_id']}/download"
+    rec['view_url'] = f"/api/pdf/{rec['pdf_id']}/view"
+    return rec
+
+
+class PDFRegistry:
+    """Metadatos de PDFs: alta, consulta por id, listado y baja transaccionales."""
+
+    def __init__(self, path: Path = DEFAULT_REGISTRY_PATH, legacy_json: Optional[Path] = LEGACY_JSON_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        if legacy_json is not None:
+            self._migrate_json(Path(legacy_json))
+
+    def _migrate_json(self, json_path: Path):
+        """Importa una sola vez las entradas de `pdf_metadata.json` (el archivo no se modifica)."""
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE name = 'migrated_json'").fetchone():
+                return
+            entries = []
+            if json_path.exists():
+                try:
+                    entries = json.loads(json_path.read_text(encoding='utf-8'))
+                except (OSError, ValueError):
+                    logger.exception('No se pudo leer %s; no se migran metadatos', json_path)
+                    return
+            rows = [(e['pdf_id'], e.get('title', ''), e.get('description', ''), e.get('filename', f"{e['pdf_id']}.pdf"),
+                     e.get('created_at') or datetime.now().isoformat())
+                    for e in entries if isinstance(e, dict) and e.get('pdf_id')]
+            with self._conn:
+                self._conn.executemany('INSERT OR IGNORE INTO pdfs VALUES (?, ?, ?, ?, ?)', rows)
+                self._conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('migrated_json', ?)",
+                                   (f'{json_path} ({len(rows)} entradas)',))
+            if rows:
+                logger.info('Registro de PDFs: %d entradas migradas desde %s', len(rows), json_path)
+
+    def add(self, pdf_id: str, title: str, description: str, filename: str) -> dict:
+        row = (pdf_id, title, description, filename, datetime.now().isoformat())
+        with self._lock, self._conn:
+            self._conn.execute('INSERT INTO pdfs VALUES (?, ?, ?, ?, ?)', row)
+        return _record(row)
+
+    def get(self, pdf_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT pdf_id, title, description, filename, created_at FROM pdfs WHERE pdf_id = ?', (pdf_id,)
+            ).fetchone()
+        return _record(row) if row else None
+
+    def list(self) -> List[dict]:
+        """Todos los PDFs, del más antiguo al más reciente."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT pdf_id, title, description, filename, created_at FROM pdfs ORDER BY created_at'
+            ).fetchall()
+        return [_record(r) for r in rows]
+
+    def delete(self, pdf_id: str) -> Optional[dict]:
+        """Elimina la entrada y la devuelve, o None si no existía."""
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT pdf_id, title, description, filename, created_at FROM pdfs WHERE pdf_id = ?', (pdf_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('DELETE FROM pdfs WHERE pdf_id = ?', (pdf_id,))
+        return _record(row)
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM pdfs').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_REGISTRY: Optional[PDFRegistry] = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_pdf_registry() -> PDFRegistry:
+    """Registro del proceso (PDF_REGISTRY_PATH: archivo SQLite, por defecto data/pdf_registry.sqlite3)."""
+    global _REGISTRY
+    if _REGISTRY is None:
+        with _REGISTRY_LOCK:
+            if _REGISTRY is None:
+                _REGISTRY = PDFRegistry(Path(os.getenv('PDF_REGISTRY_PATH', str(DEFAULT_REGISTRY_PATH))))
+    return _REGISTRY
@@ -0,0 +1,404 @@
+"""Generación de los PDFs de informes: gráfico de riesgo, QR y conversión HTML -> PDF.
+
+Módulo independiente de la app web para que los procesos de la cola de PDFs
+(`src/pdf_jobs.py`) puedan importarlo sin cargar FastAPI ni el flujo de agentes.
+
+El gráfico de riesgo (una figura de matplotlib de 8x8 pulgadas a 200 dpi, la
+mayor parte del tiempo de CPU de un PDF) sólo depende del porcentaje, con un
+decimal, y del título. Los PNG ya generados se guardan en dos niveles: una LRU
+del proceso (CHART_CACHE_SIZE entradas) y un directorio compartido por todos
+los procesos y reinicios (CHART_CACHE_DIR, por defecto data/chart_cache; vacío
+lo desactiva). Cada título admite como mucho 1001 gráficos; como los títulos
+llegan de los clientes, el directorio se limita a CHART_CACHE_DIR_MAX_MB (256)
+y se vacían primero los PNG usados hace más tiempo (mtime).
+"""
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from typing import Optional, Tuple
+
+import matplotlib
+import matplotlib.pyplot as plt
+import qrcode
+from xhtml2pdf import pisa
+
+logger = logging.getLogger(__name__)
+
+
+def generate_qr_code(url: str) -> str:
+    """
+    Genera un código QR para la URL proporcionada y lo retorna como base64.
+
+    Args:
+        url: URL para la que se generará el código QR
+
+    Returns:
+        String base64 del código QR en formato PNG
+    """
+    # Crear código QR
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(url)
+    qr.make(fit=True)
+
+    # Generar imagen
+    img = qr.make_image(fill_color="black", back_color="white")
+
+    # Convertir a base64
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+    buffer.seek(0)
+    img_base64 = base64.b64encode(buffer.read()).decode()
+
+    return img_base64
+
+
+def generate_circular_chart(percentage: float, title: str = "Progreso") -> str:
+    """
+    Genera un gráfico circular (donut chart) para mostrar un porcentaje.
+
+    Args:
+        percentage: Valor del porcentaje (0-100)
+        title: Título del gráfico
+
+    Returns:
+        String base64 del gráfico en formato PNG
+    """
+    # el gráfico muestra el porcentaje con un decimal: misma imagen para todo el intervalo
+    key = (round(max(0.0, min(100.0, float(percentage))), 1), title)
+    png, source = _chart_cache_get(key), 'hits'
+    if png is None:
+        png, source = _chart_disk_get(key), 'disk_hits'
+        if png is None:
+            source = 'misses'
+            # pyplot mantiene estado global: un gráfico a la vez entre hilos
+            with _PLOT_LOCK:
+                png = _generate_circular_chart(*key)
+            _chart_disk_put(key, png)
+        _chart_cache_put(key, png)
+    with _CHART_CACHE_LOCK:
+        _CHART_STATS[source] += 1
+    return base64.b64encode(png).decode()
+
+
+_PLOT_LOCK = threading.Lock()
+
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', '128'))
+CHART_CACHE_DIR = os.getenv('CHART_CACHE_DIR', str(Path(__file__).parent.parent / 'data' / 'chart_cache'))
+CHART_CACHE_DIR_MAX_BYTES = int(float(os.getenv('CHART_CACHE_DIR_MAX_MB', '256')) * 1024 * 1024)
+# el directorio se recorre al primer guardado y después cada tantos gráficos nuevos
+_DISK_PRUNE_EVERY = 32
+_CHART_CACHE: "OrderedDict[Tuple[float, str], bytes]" = OrderedDict()
+_CHART_CACHE_LOCK = threading.Lock()
+_CHART_STATS = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+_DISK_PUTS = 0
+
+
+def _chart_cache_get(key: Tuple[float, str]) -> Optional[bytes]:
+    with _CHART_CACHE_LOCK:
+        png = _CHART_CACHE.get(key)
+        if png is not None:
+            _CHART_CACHE.move_to_end(key)
+        return png
+
+
+def _chart_cache_put(key: Tuple[float, str], png: bytes):
+    if CHART_CACHE_SIZE <= 0:
+        return
+    with _CHART_CACHE_LOCK:
+        _CHART_CACHE[key] = png
+        _CHART_CACHE.move_to_end(key)
+        while len(_CHART_CACHE) > CHART_CACHE_SIZE:
+            _CHART_CACHE.popitem(last=False)
+            _CHART_STATS['evictions'] += 1
+
+
+def _chart_path(key: Tuple[float, str]) -> Path:
+    percentage, title = key
+    digest = hashlib.sha256(title.encode('utf-8')).hexdigest()[:16]
+    return Path(CHART_CACHE_DIR) / f'{digest}_{percentage:05.1f}.png'
+
+
+def _chart_disk_get(key: Tuple[float, str]) -> Optional[bytes]:
+    if not CHART_CACHE_DIR:
+        return None
+    path = _chart_path(key)
+    try:
+        png = path.read_bytes()
+    except OSError:
+        return None
+    try:
+        os.utime(path)  # el mtime marca el último uso para la poda
+    except OSError:
+        pass
+    return png
+
+
+def _chart_disk_put(key: Tuple[float, str], png: bytes):
+    if not CHART_CACHE_DIR:
+        return
+    path = _chart_path(key)
+    tmp = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # escritura atómica: otro proceso nunca lee un PNG a medias
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(png)
+        os.replace(tmp, path)
+    except OSError:
+        logger.warning('No se pudo guardar el gráfico en %s', path, exc_info=True)
+        if tmp is not None:
+            Path(tmp).unlink(missing_ok=True)
+        return
+    global _DISK_PUTS
+    with _CHART_CACHE_LOCK:
+        prune = _DISK_PUTS % _DISK_PRUNE_EVERY == 0
+        _DISK_PUTS += 1
+    if prune:
+        _chart_disk_prune()
+
+
+def _chart_disk_prune():
+    """Borra los PNG menos usados hasta dejar el directorio en el 90% de CHART_CACHE_DIR_MAX_BYTES."""
+    entries = []
+    for path in Path(CHART_CACHE_DIR).glob('*.png'):
+        try:
+            st = path.stat()
+        except OSError:
+            continue  # borrado por otro proceso
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    if total <= CHART_CACHE_DIR_MAX_BYTES:
+        return
+    target = CHART_CACHE_DIR_MAX_BYTES * 0.9
+    removed = 0
+    for _, size, path in sorted(entries, key=lambda e: e[0]):
+        if total <= target:
+            break
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    with _CHART_CACHE_LOCK:
+        _CHART_STATS['disk_evictions'] += removed
+
+
+def chart_cache_stats() -> dict:
+    """Aciertos (memoria y disco), fallos y tamaño de la caché de gráficos de este proceso."""
+    with _CHART_CACHE_LOCK:
+        total = _CHART_STATS['hits'] + _CHART_STATS['disk_hits'] + _CHART_STATS['misses']
+        return {
+            **_CHART_STATS,
+            'entries': len(_CHART_CACHE),
+            'max_entries': CHART_CACHE_SIZE,
+            'bytes': sum(len(png) for png in _CHART_CACHE.values()),
+            'hit_ratio': round((_CHART_STATS['hits'] + _CHART_STATS['disk_hits']) / total, 4) if total else 0.0,
+        }
+
+
+def _generate_circular_chart(percentage: float, title: str) -> bytes:
+    """Dibuja el gráfico con matplotlib y devuelve el PNG."""
+    # Configurar matplotlib para no usar GUI
+    matplotlib.use('Agg')
+
+    remaining = 100 - percentage
+
+    # Crear figura más grande y con mejor aspecto
+    fig, ax = plt.subplots(figsize=(8, 8), facecolor='white')
+
+    # Determinar color basado en el porcentaje (semáforo de riesgo)
+    if percentage < 30:
+        main_color = '#10b981'  # Verde (bajo riesgo)
+        risk_label = 'Riesgo Bajo'
+    elif percentage < 60:
+        main_color = '#f59e0b'  # Amarillo/Naranja (riesgo medio)
+        risk_label = 'Riesgo Medio'
+    else:
+        main_color = '#ef4444'  # Rojo (riesgo alto)
+        risk_label = 'Riesgo Alto'
+
+    # Datos para el gráfico
+    sizes = [percentage, remaining]
+    colors = [main_color, '#f0f0f0']  # Color dinámico para riesgo, gris muy claro para restante
+
+    # Crear el gráfico circular (donut) sin explosión para aspecto más limpio
+    wedges, texts = ax.pie(
+        sizes,
+        colors=colors,
+        startangle=90,
+        wedgeprops=dict(width=0.3, edgecolor='white', linewidth=4)
+    )
+
+    # Agregar el porcentaje en el centro del círculo (arriba)
+    ax.text(0, 0.2, f'{percentage:.1f}%', 
+            ha='center', va='center', 
+            fontsize=48, fontweight='bold', 
+            color='#1f2937')
+
+    # Agregar etiqueta de nivel de riesgo en el centro del círculo (abajo)
+    ax.text(0, -0.2, risk_label, 
+            ha='center', va='center', 
+            fontsize=22, fontweight='600', 
+            color=main_color)
+
+    # Agregar título FUERA y debajo del círculo
+    ax.text(0, -1.6, title, 
+            ha='center', va='center', 
+            fontsize=20, fontweight='bold', 
+            color='#374151')
+
+    # Asegurar que el gráfico sea circular
+    ax.axis('equal')
+
+    # Guardar en buffer con mayor resolución
+    buffer = BytesIO()
+    plt.tight_layout(pad=0.5)
+    plt.savefig(buffer, format='PNG', dpi=200, bbox_inches='tight', 
+                facecolor='white', edgecolor='none')
+    plt.close(fig)
+
+    return buffer.getvalue()
+
+
+def add_chart_to_html(html_content: str, percentage: float, chart_title: str = "Nivel de Riesgo") -> str:
+    """
+    Agrega un gráfico circular al inicio del contenido HTML.
+
+    Args:
+        html_content: Contenido HTML original
+        percentage: Porcentaje para mostrar (0-100)
+        chart_title: Título del gráfico
+
+    Returns:
+        HTML con el gráfico agregado al inicio
+    """
+    # Generar gráfico circular
+    chart_base64 = generate_circular_chart(percentage, chart_title)
+
+    # HTML del gráfico centrado al inicio del documento
+    chart_html = f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="utf-8">
+        <style>
+            body {{
+                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
+                margin: 0;
+                padding: 20px;
+                background-color: #f9fafb;
+            }}
+            .chart-container {{
+                text-align: center;
+                margin: 40px auto 60px;
+                padding: 30px;
+                background-color: white;
+                border-radius: 12px;
+                box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
+                max-width: 600px;
+            }}
+            .chart-container img {{
+                max-width: 500px;
+                width: 100%;
+                height: auto;
+                margin: 0 auto;
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="chart-container">
+            <img src="data:image/png;base64,{chart_base64}" alt="Grafico de Riesgo">
+        </div>
+    """
+
+    # Limpiar el HTML original de etiquetas de documento si las tiene
+    content = html_content
+    if '<!DOCTYPE' in content:
+        # Extraer solo el contenido del body
+        import re
+        body_match = re.search(r'<body[^>]*>(.*?)</body>', content, re.DOTALL | re.IGNORECASE)
+        if body_match:
+            content = body_match.group(1)
+        else:
+            # Si no hay body, quitar html, head, body tags
+            content = re.sub(r'<html[^>]*>|</html>|<head[^>]*>.*?</head>|<body[^>]*>|</body>', '', content, flags=re.DOTALL | re.IGNORECASE)
+
+    # Combinar gráfico con contenido
+    return chart_html + content
+
+
+def add_qr_to_html(html_content: str, pdf_url: str) -> str:
+    """
+    Agrega un código QR al final del contenido HTML.
+
+    Args:
+        html_content: Contenido HTML original
+        pdf_url: URL completa del PDF para generar el QR
+
+    Returns:
+        HTML con el código QR agregado al final
+    """
+    # Generar código QR
+    qr_base64 = generate_qr_code(pdf_url)
+
+    # HTML del código QR centrado al final del documento
+    qr_html = f"""
+    <div style="page-break-before: avoid; margin-top: 50px; padding-top: 30px; border-top: 2px solid #e0e0e0; text-align: center;">
+        <h3 style="color: #666; font-size: 16px; margin-bottom: 20px;">Accede a este documento escaneando el código QR</h3>
+        <img src="data:image/png;base64,{qr_base64}" alt="QR Code" style="width: 200px; height: 200px; margin: 0 auto; display: block;">
+        <p style="margin-top: 15px; font-size: 12px; color: #888;">Escanea este código para ver el PDF en línea</p>
+    </div>
+    </body>
+    </html>
+    """
+
+    # Reemplazar el cierre de body y html con el QR incluido
+    if '</body>' in html_content and '</html>' in html_content:
+        html_content = html_content.replace('</body>', '').replace('</html>', '')
+        html_content += qr_html
+    else:
+        # Si no hay cierre de etiquetas, agregar al final
+        html_content += qr_html
+
+    return html_content
+
+
+def render_pdf_file(html_content: str, title: str, percentage: float, pdf_path: str, pdf_view_url: str) -> int:
+    """Genera el PDF (gráfico si `percentage` > 0, QR con `pdf_view_url`) en `pdf_path`.
+
+    Bloqueante. Devuelve el tamaño del archivo en bytes; lanza RuntimeError si
+    xhtml2pdf falla (sin dejar un PDF a medias).
+    """
+    pdf_path = Path(pdf_path)
+
+    # Agregar gráfico circular al inicio del HTML si se proporciona un porcentaje
+    if percentage > 0:
+        html_content = add_chart_to_html(html_content, percentage, f"{title} - Análisis")
+
+    # Agregar código QR al final del HTML
+    html_with_qr = add_qr_to_html(html_content, pdf_view_url)
+
+    # Convertir HTML a PDF usando xhtml2pdf
+    with open(pdf_path, "wb") as pdf_file:
+        pisa_status = pisa.CreatePDF(
+            html_with_qr.encode('utf-8'),
+            dest=pdf_file
+        )
+
+    if pisa_status.err:
+        pdf_path.unlink(missing_ok=True)
+        raise RuntimeError(f"Error al generar PDF: {pisa_status.err}")
+    return pdf_path.stat().st_size
@@ -0,0 +1,67 @@
+"""API en proceso para crear los PDFs de informes.
+
+La usan tanto los endpoints HTTP (`/api/pdf/create`, `/api/pdf/jobs`) como el
+coach al terminar una evaluación. Antes el coach hacía un POST a
+`http://localhost:8000/api/pdf/create`: serializaba el HTML, pasaba por la pila
+de red y ocupaba una segunda petición del mismo worker, y fallaba si la app
+escuchaba en otro puerto.
+
+La URL del QR necesita una base pública: PUBLIC_BASE_URL si está definida; si
+no, la de la petición HTTP (o `http://localhost:8000` fuera de una petición).
+"""
+from pathlib import Path
+import os
+import uuid
+from typing import Optional
+
+from src.pdf_jobs import PDFJob, get_pdf_job_queue
+from src.pdf_registry import get_pdf_registry
+
+PDF_DIR = Path(__file__).parent.parent / 'generated_pdfs'
+DEFAULT_BASE_URL = 'http://localhost:8000'
+
+
+def public_base_url(request_base_url: Optional[str] = None) -> str:
+    return (os.getenv('PUBLIC_BASE_URL') or request_base_url or DEFAULT_BASE_URL).rstrip('/')
+
+
+def submit_pdf(html_content: str, title: str = 'Documento', description: str = '', percentage: float = 0.0,
+               base_url: Optional[str] = None) -> PDFJob:
+    """Encola el PDF y devuelve su trabajo sin esperar (el `job_id` es el `pdf_id`).
+
+    Lanza ExecutorBusyError si la cola está llena.
+    """
+    pdf_id = str(uuid.uuid4())
+    view_url = f'{public_base_url(base_url)}/api/pdf/{pdf_id}/view'
+    return get_pdf_job_queue(PDF_DIR).submit(pdf_id, html_content, title, description, percentage, view_url)
+
+
+async def create_pdf(html_content: str, title: str = 'Documento', description: str = '', percentage: float = 0.0,
+                     base_url: Optional[str] = None) -> dict:
+    """Genera el PDF y espera a que esté registrado; devuelve sus metadatos."""
+    job = submit_pdf(html_content, title, description, percentage, base_url)
+    return await get_pdf_job_queue(PDF_DIR).wait(job)
+
+
+def get_pdf_job(job_id: str) -> Optional[PDFJob]:
+    return get_pdf_job_queue(PDF_DIR).get(job_id)
+
+
+def pdf_job_status(job_id: str) -> Optional[dict]:
+    """Estado del trabajo, o None si no existe.
+
+    Un trabajo que ya no está en memoria (olvidado tras PDF_JOB_TTL o encolado en
+    otro worker) se da por terminado si su PDF está en el registro.
+    """
+    job = get_pdf_job(job_id)
+    if job is not None:
+        return job.as_dict()
+    metadata = get_pdf_registry().get(job_id)
+    if metadata is None:
+        return None
+    return {'job_id': job_id, 'status': 'done', 'attempts': None, 'error': None,
+            'status_url': f'/api/pdf/jobs/{job_id}', **metadata}
+
+
+def pdf_job_stats() -> dict:
+    return get_pdf_job_queue(PDF_DIR).stats()
@@ -1,41 +1,274 @@
 from pathlib import Path
+import os
 import logging
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
 import numpy as np
 
 try:
     from src import utils
+    from src import ann as ann_indexes
+    from src.bm25 import load_bm25_index, reciprocal_rank_fusion
 except ImportError:
     import utils
+    import ann as ann_indexes
+    from bm25 import load_bm25_index, reciprocal_rank_fusion
 
 logger = logging.getLogger(__name__)
 
+INDEX_PATH = Path(__file__).parent.parent / 'kb' / 'db' / 'index.npz'
+
+
+class VectorRetriever:
+    """Índice vectorial residente en memoria.
+
+    Mantiene una matriz con las filas ya normalizadas, de modo que la
+    similitud coseno contra todos los fragmentos se resuelve con un único
+    producto matriz-vector y el top-k con `argpartition`. Si los embeddings
+    llegan normalizados desde disco (`normalized=True`), se usan tal cual, sin
+    copiar el memmap, y los workers comparten las páginas del índice.
+    """
+
+    def __init__(self, embeddings: np.ndarray, metadatas: Sequence[dict], ann=None,
+                 search_param: Optional[int] = None, normalized: bool = False):
+        embeddings = np.asarray(embeddings)
+        if embeddings.ndim != 2:
+            raise ValueError(f"Se esperaba una matriz 2D de embeddings, se obtuvo shape={embeddings.shape}")
+        if normalized and embeddings.dtype in (np.float32, np.float16):
+            self.matrix = embeddings
+        else:
+            self.matrix = ann_indexes.normalize_rows(embeddings)
+        self.metadatas = metadatas
+        # índice ANN opcional (src.ann); si es None se hace un escaneo exacto
+        self.ann = ann
+        self.search_param = search_param
+        # índice léxico opcional (src.bm25) para búsqueda híbrida o sin embeddings
+        self.bm25 = None
+
+    @classmethod
+    def from_path(cls, index_path: Path, ann_kind: Optional[str] = None) -> 'VectorRetriever':
+        """Carga el índice desde disco.
+
+        `ann_kind` selecciona el índice ANN persistido junto al índice ('ivf', 'hnsw');
+        'flat' fuerza el escaneo exacto y None usa el primero que exista. Cualquier
+        otro valor lanza ValueError.
+        """
+        if ann_kind not in (None, 'flat', *ann_indexes.ANN_INDEX_TYPES):
+            raise ValueError(f"Tipo de índice ANN desconocido: {ann_kind}. "
+                             f"Opciones: flat, {', '.join(ann_indexes.ANN_INDEX_TYPES)}")
+        emb_arr, metadatas = utils.load_index(index_path)
+        if emb_arr is None or not metadatas:
+            raise ValueError(f"Índice vacío en {index_path}")
+        header = getattr(metadatas, 'header', {})
+        retriever = cls(emb_arr, metadatas, normalized=header.get('normalized', False))
+        kinds = list(ann_indexes.ANN_INDEX_TYPES) if ann_kind is None else [ann_kind]
+        for kind in kinds:
+            if kind == 'flat':
+                break
+            ann = ann_indexes.load_ann_index(index_path, kind, retriever.dim, header.get('generation'))
+            if ann is not None:
+                retriever.ann = ann
+                break
+        retriever.bm25 = load_bm25_index(index_path, header.get('generation'))
+        return retriever
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.matrix.shape[1]
+
+    def search_vector(self, query_vector: Sequence[float], top_k: int = 5) -> List[Tuple[int, float]]:
+        """Devuelve [(posición, score)] de los `top_k` fragmentos más similares, ordenados."""
+        qv = np.asarray(query_vector, dtype=np.float32).ravel()
+        n = len(self)
+        if n == 0 or top_k <= 0:
+            return []
+        if qv.shape[0] != self.dim:
+            logger.warning('Dimensión de query (%d) distinta a la del índice (%d)', qv.shape[0], self.dim)
+            return []
+        q_norm = float(np.linalg.norm(qv))
+        if q_norm == 0.0:
+            return []
+        qv = qv / q_norm
+        if self.ann is not None:
+            idxs, scores = self.ann.search(self.matrix, qv, top_k, self.search_param)
+            return [(int(i), float(sc)) for i, sc in zip(idxs, scores)]
+        scores = ann_indexes.score_rows(self.matrix, qv)
+        k = min(top_k, n)
+        if k < n:
+            idxs = np.argpartition(-scores, k - 1)[:k]
+        else:
+            idxs = np.arange(n)
+        idxs = idxs[np.argsort(-scores[idxs], kind='stable')]
+        return [(int(i), float(scores[i])) for i in idxs]
+
+    def search(self, query_vector: Sequence[float], top_k: int = 5) -> List[dict]:
+        """Igual que `search_vector` pero devuelve copias de las metadatas con `score`."""
+        results = []
+        for i, score in self.search_vector(query_vector, top_k):
+            m = dict(self.metadatas[i])
+            m['score'] = score
+            results.append(m)
+        return results
+
+    def search_lexical(self, query: str, top_k: int = 5) -> List[dict]:
+        """Búsqueda sólo BM25 (no necesita embedding de la consulta)."""
+        if self.bm25 is None:
+            return []
+        results = []
+        for i, score in self.bm25.search(query, top_k):
+            m = dict(self.metadatas[i])
+            m['score'] = score
+            m['lexical_score'] = score
+            results.append(m)
+        return results
+
+    def search_hybrid(self, query: str, query_vector: Sequence[float], top_k: int = 5,
+                      candidates: Optional[int] = None, rrf_k: int = 60) -> List[dict]:
+        """Fusiona con RRF los rankings denso y BM25; `score` es la puntuación fusionada."""
+        if self.bm25 is None:
+            return self.search(query_vector, top_k)
+        candidates = candidates or max(4 * top_k, 20)
+        dense = self.search_vector(query_vector, candidates)
+        lexical = self.bm25.search(query, candidates)
+        dense_scores = dict(dense)
+        lexical_scores = dict(lexical)
+        fused = reciprocal_rank_fusion([[i for i, _ in dense], [i for i, _ in lexical]], k=rrf_k)
+        results = []
+        for i, score in fused[:top_k]:
+            m = dict(self.metadatas[i])
+            m['score'] = score
+            m['dense_score'] = dense_scores.get(i)
+            m['lexical_score'] = lexical_scores.get(i)
+            results.append(m)
+        return results
+
+
+_RETRIEVER: Optional[VectorRetriever] = None
+_RETRIEVER_LOCK = threading.Lock()
+
+
+def get_retriever(index_path: Path = INDEX_PATH) -> Optional[VectorRetriever]:
+    """Devuelve el retriever del proceso, cargándolo desde disco la primera vez.
+
+    Devuelve None si todavía no existe un índice construido.
+    """
+    global _RETRIEVER
+    if _RETRIEVER is not None:
+        return _RETRIEVER
+    with _RETRIEVER_LOCK:
+        if _RETRIEVER is None:
+            if not utils.index_exists(index_path):
+                logger.info('No se encontró índice en %s', index_path)
+                return None
+            # RETRIEVAL_ANN: 'flat' (exacto), 'ivf', 'hnsw' o vacío (autodetectar)
+            ann_kind = (os.getenv('RETRIEVAL_ANN') or '').strip().lower() or None
+            if ann_kind not in (None, 'flat', *ann_indexes.ANN_INDEX_TYPES):
+                logger.warning('RETRIEVAL_ANN desconocido %r; se usa la búsqueda exacta (flat)', ann_kind)
+                ann_kind = 'flat'
+            retriever = VectorRetriever.from_path(index_path, ann_kind=ann_kind)
+            search_param = os.getenv('RETRIEVAL_ANN_SEARCH')
+            if search_param:
+                retriever.search_param = int(search_param)
+            _RETRIEVER = retriever
+            logger.info('Índice cargado en memoria: %d fragmentos, dim=%d, ann=%s',
+                        len(retriever), retriever.dim, getattr(retriever.ann, 'kind', 'flat'))
+    return _RETRIEVER
+
+
+def reload_retriever(index_path: Path = INDEX_PATH) -> Optional[VectorRetriever]:
+    """Descarta el retriever en memoria y lo vuelve a cargar (p. ej. tras re-ingestar)."""
+    global _RETRIEVER
+    with _RETRIEVER_LOCK:
+        _RETRIEVER = None
+    return get_retriever(index_path)
+
+
+# Embedding de consultas con timeout: si el backend está lento o caído, la
+# recuperación continúa sólo con BM25. Tras varios fallos seguidos no se vuelve a
+# intentar durante un rato (modo degradado, sólo léxico).
+_EMBED_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix='query-embed')
+_EMBED_LOCK = threading.Lock()
+_EMBED_READY = False
+_EMBED_FAILURES = 0
+_EMBED_DOWN_UNTIL = 0.0
+
+
+def embed_query(query: str, timeout: Optional[float] = None) -> Optional[List[float]]:
+    """Embedding de la consulta, o None si el backend falla o tarda más de `timeout`.
+
+    Hasta el primer embedding correcto (carga del modelo, primera conexión) la espera
+    es RETRIEVAL_EMBED_WARMUP_TIMEOUT. Tras RETRIEVAL_EMBED_FAILURES fallos seguidos
+    se devuelve None sin llamar al backend durante RETRIEVAL_EMBED_COOLDOWN segundos.
+    """
+    global _EMBED_READY, _EMBED_FAILURES, _EMBED_DOWN_UNTIL
+    if time.monotonic() < _EMBED_DOWN_UNTIL:
+        return None
+    timeout = timeout if timeout is not None else float(os.getenv('RETRIEVAL_EMBED_TIMEOUT', '3'))
+    if not _EMBED_READY:
+        timeout = max(timeout, float(os.getenv('RETRIEVAL_EMBED_WARMUP_TIMEOUT', '30')))
+    future = _EMBED_POOL.submit(utils.embed_texts, [query])
+    try:
+        embedding = future.result(timeout=timeout)[0]
+    except Exception as e:
+        # si aún no había empezado, no ocupar un hilo del pool con una consulta ya descartada
+        future.cancel()
+        threshold = int(os.getenv('RETRIEVAL_EMBED_FAILURES', '3'))
+        cooldown = float(os.getenv('RETRIEVAL_EMBED_COOLDOWN', '30'))
+        with _EMBED_LOCK:
+            _EMBED_FAILURES += 1
+            failures = _EMBED_FAILURES
+            if failures >= threshold:
+                _EMBED_DOWN_UNTIL = time.monotonic() + cooldown
+                _EMBED_FAILURES = 0
+        if failures >= threshold:
+            logger.warning('Embedding de consulta no disponible tras %d fallos (%s); sólo búsqueda léxica durante %.0fs',
+                           failures, type(e).__name__, cooldown)
+        else:
+            logger.warning('Embedding de consulta no disponible (%s); esta consulta usa sólo búsqueda léxica',
+                           type(e).__name__)
+        return None
+    with _EMBED_LOCK:
+        _EMBED_READY = True
+        _EMBED_FAILURES = 0
+    return embedding
+
+
+def retrieve_hybrid(query: str, top_k: int = 5, mode: Optional[str] = None) -> List[dict]:
+    """Recupera fragmentos según RETRIEVAL_MODE:
+
+    - 'hybrid' (por defecto): denso + BM25 fusionados con RRF; si el embedding
+      de la consulta no está disponible a tiempo, sólo BM25.
+    - 'lexical': sólo BM25, sin llamar al backend de embeddings.
+    - 'dense': sólo similitud coseno (equivale a `retrieve_relevant`).
+
+    Sin índice BM25 construido, se usa siempre la búsqueda densa.
+    """
+    mode = mode or os.getenv('RETRIEVAL_MODE', 'hybrid')
+    retriever = get_retriever()
+    if retriever is None:
+        return []
+    if retriever.bm25 is None or mode == 'dense':
+        return retrieve_relevant(query, top_k=top_k)
+    if mode == 'lexical':
+        return retriever.search_lexical(query, top_k)
+    q_emb = embed_query(query)
+    if q_emb is None:
+        return retriever.search_lexical(query, top_k)
+    return retriever.search_hybrid(query, q_emb, top_k)
+
+
 def retrieve_relevant(query: str, top_k: int = 5) -> List[dict]:
-    """Recupera los `top_k` fragmentos más similares desde el índice (kb/db/index.npz).
+    """Recupera los `top_k` fragmentos más similares desde el índice residente (kb/db/).
 
     Devuelve lista de metadatas con clave adicional `score` (cosine similarity).
     """
-    index_path = Path(__file__).parent.parent / 'kb' / 'db' / 'index.npz'
-    if not index_path.exists():
-        logger.info('No se encontró índice en %s', index_path)
+    retriever = get_retriever()
+    if retriever is None:
         return []
-    emb_arr, metadatas = utils.load_index(index_path)
-    if emb_arr is None or not metadatas:
-        return []
-
     q_emb = utils.embed_texts([query])[0]
-    emb_matrix = np.array(emb_arr)
-    qv = np.array(q_emb)
-
-    def cos(a, b):
-        denom = (np.linalg.norm(a) * np.linalg.norm(b))
-        return float(np.dot(a, b) / denom) if denom != 0 else 0.0
-
-    scores = [cos(qv, emb_matrix[i]) for i in range(len(emb_matrix))]
-    idxs = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:top_k]
-    results = []
-    for i in idxs:
-        m = dict(metadatas[i])
-        m['score'] = scores[i]
-        results.append(m)
-    return results
+    return retriever.search(q_emb, top_k=top_k)
@@ -0,0 +1,8 @@
+"""Serialización de eventos en formato Server-Sent Events (`/api/chat/stream`, `/api/coach/stream`)."""
+import json
+from typing import Any, Dict
+
+
+def sse_event(event: Dict[str, Any]) -> str:
+    """Serializa un evento del flujo de agentes; `event['type']` es el nombre del evento SSE."""
+    return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
@@ -1,8 +1,20 @@
-from typing import List
+from typing import Callable, List, Optional, Sequence
 from pathlib import Path
+import importlib.util
 import os
 import json
+import mmap
+import struct
+import logging
+import tempfile
+import uuid
 import numpy as np
+try:
+    from src.embedding_cache import get_embedding_cache
+    from src.embedders import get_local_embedder, get_openai_embedder
+except ImportError:
+    from embedding_cache import get_embedding_cache
+    from embedders import get_local_embedder, get_openai_embedder
 try:
     # Cargar variables del .env del proyecto (si existe)
     from dotenv import load_dotenv
@@ -35,6 +47,8 @@ except Exception:
         # Si todo falla, no hacemos nada; el proceso puede depender de variables ya definidas
         pass
 
+logger = logging.getLogger(__name__)
+
 
 def chunk_text(text: str, max_chars: int = 1000) -> List[str]:
     """Divide el texto en fragmentos de aproximadamente `max_chars` caracteres.
@@ -77,20 +91,9 @@ def _embed_openai(texts: List[str], model: str) -> List[List[float]]:
         raise RuntimeError("Falta la dependencia 'openai'. Instálala con: pip install openai")
 
     try:
-        from openai import OpenAI
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        batch_size = 100
-        embeddings = []
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i+batch_size]
-            resp = client.embeddings.create(model=model, input=batch)
-            for item in getattr(resp, 'data', []):
-                if isinstance(item, dict):
-                    embeddings.append(item.get('embedding'))
-                else:
-                    embeddings.append(getattr(item, 'embedding', None))
-        return embeddings
-    except Exception:
+        from openai import OpenAI  # noqa: F401
+    except ImportError:
+        # SDK clásico (openai<1.0): lotes secuenciales
         openai.api_key = os.getenv('OPENAI_API_KEY')
         batch_size = 100
         embeddings = []
@@ -100,17 +103,30 @@ def _embed_openai(texts: List[str], model: str) -> List[List[float]]:
             for item in resp['data']:
                 embeddings.append(item['embedding'])
         return embeddings
+    return get_openai_embedder().embed(texts, model)
+
+LOCAL_EMBEDDING_MODEL = os.getenv('LOCAL_EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+
 
 def _embed_sentence_transformer(texts: List[str]) -> List[List[float]]:
-    try:
-        from sentence_transformers import SentenceTransformer
-    except ImportError:
-        raise RuntimeError(
-            "No se encontró OPENAI_API_KEY ni la dependencia 'sentence-transformers'. Instálala con: pip install sentence-transformers"
-        )
-    model_local = SentenceTransformer('all-MiniLM-L6-v2')
-    emb_arr = model_local.encode(texts, show_progress_bar=False)
-    return emb_arr.tolist()
+    return get_local_embedder(LOCAL_EMBEDDING_MODEL).embed(texts)
+
+def warm_up_embedder():
+    """Carga por adelantado el modelo local de embeddings si es el backend activo y está instalado."""
+    if os.getenv('OPENAI_API_KEY'):
+        return
+    if importlib.util.find_spec('sentence_transformers') is None:
+        logger.info('sentence-transformers no está instalado; no se precarga el modelo local de embeddings')
+        return
+    get_local_embedder(LOCAL_EMBEDDING_MODEL).warm_up()
+
+
+def embedding_model_name(model: str = None) -> str:
+    """Nombre del modelo que usará `embed_texts` con la configuración actual."""
+    if os.getenv('OPENAI_API_KEY'):
+        return model or os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small')
+    return get_local_embedder(LOCAL_EMBEDDING_MODEL).name
+
 
 def embed_texts(texts: List[str], model: str = None):
     """Generar embeddings para una lista de textos.
@@ -120,8 +136,37 @@ def embed_texts(texts: List[str], model: str = None):
     - Si no hay API key, cae en un fallback local usando sentence-transformers
       (requiere instalación de `sentence-transformers`).
 
+    Los vectores ya calculados se sirven desde la caché persistente
+    (src.embedding_cache), indexada por (modelo, hash del texto); sólo los
+    textos que faltan se envían al backend.
+
     Devuelve una lista de vectores (listas de floats).
     """
+    cache = get_embedding_cache()
+    if cache is None or not texts:
+        return _embed_backend(texts, model)
+    model_name = embedding_model_name(model)
+    try:
+        cached = cache.get_many(model_name, texts)
+    except Exception:
+        # la caché es una optimización: si falla la lectura, todo cuenta como fallo
+        logger.exception('No se pudieron leer embeddings de la caché')
+        cached = [None] * len(texts)
+    missing = [i for i, v in enumerate(cached) if v is None]
+    if missing:
+        unique = list(dict.fromkeys(texts[i] for i in missing))
+        fresh = _embed_backend(unique, model)
+        try:
+            cache.put_many(model_name, unique, fresh)
+        except Exception:
+            logger.exception('No se pudieron guardar embeddings en la caché')
+        by_text = dict(zip(unique, fresh))
+        for i in missing:
+            cached[i] = by_text[texts[i]]
+    return [v.tolist() if isinstance(v, np.ndarray) else list(v) for v in cached]
+
+
+def _embed_backend(texts: List[str], model: str = None):
     openai_key = os.getenv('OPENAI_API_KEY')
     model = model or os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small')
     if openai_key:
@@ -130,45 +175,300 @@ def embed_texts(texts: List[str], model: str = None):
         return _embed_sentence_transformer(texts)
 
 
-def save_index(emb_arr: np.ndarray, metadatas: List[dict], index_path: Path):
-    """Guardar el índice en formato .npz con embeddings y metadatos.
+INDEX_FORMAT_VERSION = 1
+
 
-    - embeddings: array numpy (n_fragments, dim)
-    - metadatas: lista de dicts con metadata por fragmento
-    - index_path: Path al archivo .npz destino
+def index_layout(index_path: Path, generation: Optional[str] = None) -> dict:
+    """Rutas de los archivos que forman el índice en disco.
+
+    `index_path` (p. ej. kb/db/index.npz) identifica el índice; los archivos se
+    derivan de su nombre base:
+
+    - index.meta.json:         cabecera y metadatas compactas (sin el texto)
+    - index.<gen>.vectors.npy: embeddings normalizados (float32 o float16), abribles con mmap
+    - index.<gen>.offsets.npy: offsets (int64, n+1) de cada texto dentro de texts.bin
+    - index.<gen>.texts.bin:   textos de los fragmentos en UTF-8, concatenados
+
+    `generation` identifica el conjunto de archivos de datos al que apunta la
+    cabecera de index.meta.json; reemplazar ese único archivo publica un índice
+    nuevo de forma atómica.
     """
     index_path = Path(index_path)
-    index_path.parent.mkdir(parents=True, exist_ok=True)
-    # Guardar embeddings y metadatas (serializadas)
-    meta_json = json.dumps(metadatas, ensure_ascii=False)
-    np.savez_compressed(str(index_path), embeddings=emb_arr, metadatas=meta_json)
-    print(f"Índice guardado en {index_path}")
+    stem = index_path.name.split('.')[0]
+    prefix = f'{stem}.{generation}' if generation else stem
+    return {
+        'vectors': index_path.with_name(f'{prefix}.vectors.npy'),
+        'offsets': index_path.with_name(f'{prefix}.offsets.npy'),
+        'texts': index_path.with_name(f'{prefix}.texts.bin'),
+        'meta': index_path.with_name(f'{stem}.meta.json'),
+    }
+
+
+def index_exists(index_path: Path) -> bool:
+    """True si existe el índice en formato mmap o el .npz heredado."""
+    return index_layout(index_path)['meta'].exists() or Path(index_path).exists()
+
+
+def atomic_write(path: Path, write_fn):
+    """Escribe `path` a través de un archivo temporal y `os.replace` para que
+    los lectores nunca vean un archivo a medio escribir."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_fn(f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class MetadataStore(Sequence):
+    """Metadatas de los fragmentos con el texto leído bajo demanda.
+
+    Las metadatas compactas (source, title, chunk_id...) viven en memoria; el
+    texto se decodifica desde `texts.bin` (mapeado en memoria) sólo cuando se
+    accede a un fragmento concreto.
+    """
+
+    def __init__(self, records: List[dict], offsets: np.ndarray, texts_path: Path, header: Optional[dict] = None):
+        self.records = records
+        self.offsets = offsets
+        self.header = header or {}
+        self._blob = b''
+        if Path(texts_path).stat().st_size > 0:
+            with open(texts_path, 'rb') as f:
+                self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
+    def __len__(self) -> int:
+        return len(self.records)
 
-def load_index(index_path: Path):
-    """Cargar embeddings y metadatas desde un .npz guardado por save_index.
+    def text(self, i: int) -> str:
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return bytes(self._blob[start:end]).decode('utf-8')
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        m = dict(self.records[i])
+        text = self.text(i)
+        m['text'] = text
+        m['text_preview'] = text[:200]
+        return m
+
+
+# Cabecera .npy v1.0 de tamaño fijo: permite escribir los vectores en streaming
+# y completar el shape al final sin reescribir los datos.
+_NPY_HEADER_LEN = 128
+
+
+def _npy_header(dtype: np.dtype, shape: tuple) -> bytes:
+    body_len = _NPY_HEADER_LEN - 10
+    body = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), shape)
+    body = body.ljust(body_len - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', body_len) + body.encode('latin1')
+
+
+class IndexWriter:
+    """Escritura en streaming de un índice en el formato mmap (ver `index_layout`).
+
+    Los vectores y textos se vuelcan a disco lote a lote (`add`), por lo que la
+    memoria no crece con el tamaño del corpus salvo por las metadatas compactas.
+    `commit` publica la generación nueva reemplazando index.meta.json; `abort`
+    descarta los archivos a medio escribir. Los índices derivados (BM25, ANN) se
+    escriben en `commit(before_publish=...)`, antes de publicar: un lector que ve
+    la cabecera nueva encuentra ya todos los archivos de su generación.
+    """
+
+    def __init__(self, index_path: Path, dtype: Optional[str] = None):
+        self.index_path = Path(index_path)
+        self.dtype = np.dtype(dtype or os.getenv('INDEX_DTYPE', 'float32'))
+        self.generation = uuid.uuid4().hex[:12]
+        self.paths = index_layout(self.index_path, self.generation)
+        self.paths['meta'].parent.mkdir(parents=True, exist_ok=True)
+        self.dim: Optional[int] = None
+        self.records: List[dict] = []
+        self._offsets = [0]
+        self._tmp = {key: self.paths[key].with_name(self.paths[key].name + '.tmp') for key in ('vectors', 'texts')}
+        self._vectors_f = open(self._tmp['vectors'], 'wb')
+        self._vectors_f.write(b'\0' * _NPY_HEADER_LEN)
+        self._texts_f = open(self._tmp['texts'], 'wb')
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def add(self, emb_arr: np.ndarray, metadatas: Sequence[dict]):
+        """Añade un lote de embeddings (se normalizan) con sus metadatas (incluyen `text`)."""
+        if not metadatas:
+            return
+        emb = np.asarray(emb_arr, dtype=np.float32).reshape(len(metadatas), -1)
+        if self.dim is None:
+            self.dim = emb.shape[1]
+        elif emb.shape[1] != self.dim:
+            raise ValueError(f"Dimensión de embeddings inconsistente: {emb.shape[1]} != {self.dim}")
+        norms = np.linalg.norm(emb, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self._vectors_f.write(np.ascontiguousarray(emb / norms, dtype=self.dtype).tobytes())
+        for m in metadatas:
+            data = (m.get('text') or '').encode('utf-8')
+            self._texts_f.write(data)
+            self._offsets.append(self._offsets[-1] + len(data))
+            self.records.append({k: v for k, v in m.items() if k not in ('text', 'text_preview')})
+
+    def commit(self, header_extra: Optional[dict] = None,
+               before_publish: Optional[Callable[[np.ndarray, 'MetadataStore', str], None]] = None) -> str:
+        """Cierra los archivos, los publica y devuelve el identificador de la generación.
+
+        `before_publish(embeddings, metadatas, generation)` se llama con la generación
+        ya escrita pero aún sin publicar; si falla, se borran sus archivos y el índice
+        publicado no cambia.
+        """
+        shape = (len(self.records), self.dim or 0)
+        self._vectors_f.seek(0)
+        self._vectors_f.write(_npy_header(self.dtype, shape))
+        for f in (self._vectors_f, self._texts_f):
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        os.replace(self._tmp['vectors'], self.paths['vectors'])
+        os.replace(self._tmp['texts'], self.paths['texts'])
+        offsets = np.asarray(self._offsets, dtype=np.int64)
+        atomic_write(self.paths['offsets'], lambda f: np.save(f, offsets))
+        if before_publish is not None:
+            try:
+                before_publish(np.load(str(self.paths['vectors']), mmap_mode='r'),
+                               MetadataStore(self.records, offsets, self.paths['texts']), self.generation)
+            except BaseException:
+                prefix = f"{self.index_path.name.split('.')[0]}.{self.generation}."
+                for p in self.index_path.parent.glob(prefix + '*'):
+                    p.unlink(missing_ok=True)
+                raise
+        header = dict(header_extra or {})
+        header.update({
+            'version': INDEX_FORMAT_VERSION,
+            'generation': self.generation,
+            'count': shape[0],
+            'dim': shape[1],
+            'dtype': self.dtype.name,
+            'normalized': True,
+        })
+        # publicar: la cabecera de meta.json apunta a la generación recién escrita
+        meta = json.dumps({'header': header, 'records': self.records}, ensure_ascii=False)
+        atomic_write(self.paths['meta'], lambda f: f.write(meta.encode('utf-8')))
+        _remove_stale_generations(self.index_path, self.generation)
+        print(f"Índice guardado en {self.paths['meta'].parent} ({shape[0]} fragmentos, {self.dtype.name})")
+        return self.generation
+
+    def abort(self):
+        for f in (self._vectors_f, self._texts_f):
+            if not f.closed:
+                f.close()
+        for p in self._tmp.values():
+            if p.exists():
+                p.unlink()
+
+
+def save_index(emb_arr: np.ndarray, metadatas: List[dict], index_path: Path, dtype: Optional[str] = None,
+               header_extra: Optional[dict] = None):
+    """Guardar el índice en el formato mmap (ver `index_layout`).
+
+    - embeddings: array numpy (n_fragments, dim); se guardan normalizados
+    - metadatas: lista de dicts con metadata por fragmento (incluye `text`)
+    - index_path: Path que identifica el índice (p. ej. kb/db/index.npz)
+    - dtype: 'float32' (por defecto, o INDEX_DTYPE) o 'float16' para reducir a la mitad disco y page cache
+    - header_extra: datos adicionales para la cabecera (p. ej. el manifiesto de ingesta)
+
+    Los datos se escriben en una generación nueva y se publican reemplazando
+    index.meta.json; los lectores ven el índice anterior o el nuevo, nunca una mezcla.
+    Devuelve el identificador de la generación escrita.
+    """
+    writer = IndexWriter(index_path, dtype=dtype)
+    try:
+        emb = np.asarray(emb_arr, dtype=np.float32)
+        if emb.ndim == 2 and emb.shape[0] == len(metadatas):
+            writer.dim = emb.shape[1]
+        writer.add(emb, metadatas)
+        return writer.commit(header_extra)
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def _remove_stale_generations(index_path: Path, keep: str):
+    """Borra archivos de datos de generaciones anteriores.
+
+    Los procesos que ya los tengan mapeados en memoria siguen leyéndolos
+    (el inodo vive hasta que se cierra el último mapeo).
+    """
+    index_path = Path(index_path)
+    stem = index_path.name.split('.')[0]
+    # se conservan todos los archivos de la generación publicada, también BM25 y ANN
+    current = f'{stem}.{keep}.'
+    for suffix in ('vectors.npy', 'offsets.npy', 'texts.bin', 'ivf.npz', 'hnsw.bin', 'bm25.npz'):
+        for p in index_path.parent.glob(f'{stem}.*.{suffix}'):
+            if not p.name.startswith(current):
+                try:
+                    p.unlink()
+                except OSError:
+                    logger.warning('No se pudo borrar %s', p)
+
+
+def read_index_header(index_path: Path) -> dict:
+    """Cabecera del índice (vacía si no existe o si es un .npz heredado)."""
+    meta_path = index_layout(index_path)['meta']
+    if not meta_path.exists():
+        return {}
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('header', {})
+
+
+def load_index(index_path: Path, mmap_mode: Optional[str] = 'r'):
+    """Cargar embeddings y metadatas guardados por save_index.
+
+    En el formato mmap los embeddings se abren con `np.load(mmap_mode='r')`
+    (compartidos entre procesos vía page cache) y las metadatas se devuelven
+    como `MetadataStore`. Si sólo existe el .npz heredado, se lee ese.
+
+    Devuelve (embeddings: np.ndarray, metadatas: Sequence[dict])
+    """
+    meta_path = index_layout(index_path)['meta']
+    if meta_path.exists():
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        header = meta.get('header', {})
+        paths = index_layout(index_path, header.get('generation'))
+        emb = np.load(str(paths['vectors']), mmap_mode=mmap_mode)
+        offsets = np.load(str(paths['offsets']), mmap_mode=mmap_mode)
+        records = meta.get('records', [])
+        if emb.shape[0] != len(records) or offsets.shape[0] != len(records) + 1:
+            raise ValueError(f"Índice inconsistente en {meta_path.parent}: "
+                             f"{emb.shape[0]} vectores, {len(records)} metadatas")
+        return emb, MetadataStore(records, offsets, paths['texts'], header)
+    return load_index_npz(index_path)
+
+
+def load_index_npz(index_path: Path):
+    """Cargar embeddings y metadatas desde el .npz heredado (formato anterior).
 
     Devuelve (embeddings: np.ndarray, metadatas: list)
     """
     index_path = Path(index_path)
     if not index_path.exists():
         raise FileNotFoundError(f"No se encontró índice en {index_path}")
-    data = np.load(str(index_path), allow_pickle=True)
-    emb = data.get('embeddings')
-    meta_raw = data.get('metadatas')
+    data = np.load(str(index_path), allow_pickle=False)
+    emb = data['embeddings'] if 'embeddings' in data.files else None
     metadatas = []
-    if meta_raw is not None:
+    if 'metadatas' in data.files:
+        meta_raw = data['metadatas']
         try:
-            if isinstance(meta_raw, (bytes, bytearray)):
-                meta_str = meta_raw.decode('utf-8')
-            else:
-                meta_str = str(meta_raw.tolist()) if hasattr(meta_raw, 'tolist') else str(meta_raw)
-            metadatas = json.loads(meta_str)
+            metadatas = json.loads(str(meta_raw.tolist()))
         except (json.JSONDecodeError, UnicodeDecodeError):
-            try:
-                metadatas = eval(meta_raw)
-            except Exception:
-                metadatas = []
+            logger.error('Metadatas ilegibles en %s', index_path)
+            metadatas = []
     return emb, metadatas
 
 
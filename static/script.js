@@ -78,48 +78,206 @@ function showChat() {
 }
 
 // Función para enviar al coach (centralizada)
+// Usa el endpoint SSE para mostrar la respuesta a medida que se genera; si el
+// streaming no está disponible (la petición ni siquiera empezó a emitir eventos),
+// recurre al endpoint JSON. Un fallo posterior no se reintenta: el servidor ya
+// pudo procesar el turno (p. ej. una respuesta de la evaluación).
 async function sendToCoach(message) {
+    const requestBody = {
+        query: message
+    };
+    
+    // Si hay una sesión activa, incluir session_id
+    if (currentSessionId) {
+        requestBody.session_id = currentSessionId;
+    }
+    
     try {
-        const requestBody = {
-            query: message
-        };
-        
-        // Si hay una sesión activa, incluir session_id
-        if (currentSessionId) {
-            requestBody.session_id = currentSessionId;
+        await streamFromCoach(requestBody);
+    } catch (streamError) {
+        if (!streamError.streamUnavailable) {
+            console.error('Error en el streaming:', streamError);
+            removeTypingIndicator();
+            addMessage('Lo siento, ha ocurrido un error. Por favor, intenta nuevamente.', 'bot');
+            return;
         }
-        
-        const response = await fetch('/api/coach', {
+        console.warn('Streaming no disponible, usando /api/coach:', streamError);
+        try {
+            const response = await fetch('/api/coach', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify(requestBody)
+            });
+            
+            const data = await response.json();
+            renderCoachResponse(data);
+            
+        } catch (error) {
+            console.error('Error:', error);
+            removeTypingIndicator();
+            addMessage('Lo siento, ha ocurrido un error. Por favor, intenta nuevamente.', 'bot');
+        }
+    }
+}
+
+// Error de streaming antes de recibir ningún evento: se puede repetir por /api/coach
+function streamUnavailableError(message) {
+    const error = new Error(message);
+    error.streamUnavailable = true;
+    return error;
+}
+
+// Lee los eventos SSE de /api/coach/stream y actualiza la burbuja del bot
+async function streamFromCoach(requestBody) {
+    let response;
+    try {
+        response = await fetch('/api/coach/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'Accept': 'text/event-stream',
             },
             body: JSON.stringify(requestBody)
         });
+    } catch (error) {
+        throw streamUnavailableError(`Fallo de red: ${error.message}`);
+    }
+    const contentType = response.headers.get('Content-Type') || '';
+    if (!response.ok || !response.body || !contentType.startsWith('text/event-stream')) {
+        throw streamUnavailableError(`HTTP ${response.status} (${contentType || 'sin Content-Type'})`);
+    }
+    
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let bubble = null;
+    let streamedText = '';
+    let finished = false;
+    
+    try {
+        while (!finished) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
         
-        const data = await response.json();
-        
-        // Si la respuesta incluye session_id, guardarlo
-        if (data.session_id) {
-            currentSessionId = data.session_id;
+            // Los eventos SSE se separan por una línea en blanco
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                const dataLine = rawEvent.split('\n').find(line => line.startsWith('data: '));
+                if (!dataLine) continue;
+                const event = JSON.parse(dataLine.slice(6));
+            
+                if (event.type === 'token') {
+                    if (!bubble) {
+                        removeTypingIndicator();
+                        bubble = addMessage('', 'bot').querySelector('[data-raw]');
+                        bubble.style.whiteSpace = 'pre-wrap';
+                    }
+                    // Texto en bruto mientras llega; el HTML final se pinta en 'done'
+                    streamedText += event.text;
+                    bubble.textContent = streamedText;
+                    const chatMessages = document.getElementById('chat-messages');
+                    chatMessages.scrollTop = chatMessages.scrollHeight;
+                } else if (event.type === 'done') {
+                    finished = true;
+                    if (bubble) {
+                        bubble.style.whiteSpace = '';
+                        bubble.innerHTML = decodeHtmlEntities(event.final);
+                        handleCoachMetadata(event);
+                    } else {
+                        renderCoachResponse(event);
+                    }
+                } else if (event.type === 'error') {
+                    throw new Error(event.detail || 'Error en el streaming');
+                }
+            }
         }
-        
-        // Remover indicador de escritura
-        removeTypingIndicator();
-        
-        // Agregar respuesta del bot
-        addMessage(data.final, 'bot', data);
-        
-        // Si es una pregunta de evaluación, mostrar progreso
-        if (data.is_question && data.question_progress) {
-            addProgressIndicator(data.question_progress);
+        if (!finished) {
+            throw new Error('El streaming terminó sin respuesta final');
         }
-        
     } catch (error) {
-        console.error('Error:', error);
-        removeTypingIndicator();
-        addMessage('Lo siento, ha ocurrido un error. Por favor, intenta nuevamente.', 'bot');
+        // Descartar la respuesta parcial; el llamador muestra el error
+        if (bubble) {
+            bubble.closest('.chat-message').remove();
+        }
+        throw error;
+    }
+}
+
+// Pinta una respuesta completa del coach (JSON o evento 'done')
+function renderCoachResponse(data) {
+    // Remover indicador de escritura
+    removeTypingIndicator();
+    
+    // Agregar respuesta del bot
+    addMessage(data.final, 'bot', data);
+    handleCoachMetadata(data);
+}
+
+function handleCoachMetadata(data) {
+    // Si la respuesta incluye session_id, guardarlo
+    if (data.session_id) {
+        currentSessionId = data.session_id;
+    }
+    
+    // Si es una pregunta de evaluación, mostrar progreso
+    if (data.is_question && data.question_progress) {
+        addProgressIndicator(data.question_progress);
     }
+    
+    // Si el informe PDF se está generando en segundo plano, esperar al enlace
+    if (data.details && data.details.pdf_job) {
+        pollPdfJob(data.details.pdf_job);
+    }
+}
+
+// Consulta el trabajo del PDF hasta que termina y sustituye el aviso por el enlace de descarga
+async function pollPdfJob(job, interval = 1500, maxAttempts = 120) {
+    for (let attempt = 0; attempt < maxAttempts; attempt++) {
+        await new Promise(resolve => setTimeout(resolve, interval));
+        let status;
+        try {
+            const response = await fetch(job.status_url || `/api/pdf/jobs/${job.job_id}`);
+            if (!response.ok) continue;
+            status = await response.json();
+        } catch (error) {
+            continue;  // error de red puntual: se reintenta en la siguiente vuelta
+        }
+        if (status.status === 'done') {
+            showPdfLink(job.job_id, status.download_url);
+            return;
+        }
+        if (status.status === 'failed') {
+            break;
+        }
+    }
+    showPdfLink(job.job_id, null);
+}
+
+function showPdfLink(jobId, downloadUrl) {
+    const box = document.querySelector(`[data-pdf-job="${jobId}"]`);
+    if (!box) return;
+    if (!downloadUrl) {
+        box.innerHTML = `
+            <h3 style="margin: 0 0 10px 0; color: #1e40af;">📄 Informe no disponible</h3>
+            <p style="margin: 0;">No se pudo generar el PDF. Tus resultados siguen disponibles en esta conversación.</p>
+        `;
+        return;
+    }
+    box.innerHTML = `
+        <h3 style="margin: 0 0 10px 0; color: #1e40af;">📄 Tu Informe está Listo</h3>
+        <p style="margin: 0 0 15px 0;">Hemos generado un PDF completo con tu evaluación y recomendaciones personalizadas.</p>
+        <div>
+            <a href="${escapeHtml(downloadUrl)}" 
+               style="display: inline-block; padding: 12px 24px; background-color: #3b82f6; color: white; text-decoration: none; border-radius: 8px; font-weight: 600; font-size: 16px;">
+                ⬇️ Descargar Informe en PDF
+            </a>
+        </div>
+    `;
 }
 
 // Función para enviar mensajes
@@ -178,6 +336,7 @@ function addMessage(text, sender) {
     
     chatMessages.appendChild(messageDiv);
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    return messageDiv;
 }
 
 // Mostrar indicador de escritura